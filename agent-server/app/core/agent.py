@@ -4,7 +4,7 @@ from typing import List
 from sqlmodel import Session
 from app.db import engine
 from app.models import AgentConfig, InteractionLog
-from openai import OpenAI
+from app.core.llm_pool import get_openai_client
 from app.settings import get_settings
 from app.schemas.response import AgentResponse, Action
 from app.tools.registry import registry
@@ -12,7 +12,7 @@ from app.tools.registry import registry
 class Agent:
     def __init__(self, agent_id: Optional[int] = None):
         self.settings = get_settings()
-        self.client = OpenAI(api_key=self.settings.OPENAI_API_KEY)
+        self.client = get_openai_client(self.settings.OPENAI_API_KEY)
         self.agent_id = agent_id
         
         # Load agent config
@@ -0,0 +1,41 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import httpx
+from openai import OpenAI
+
+# Mirrors src/llm_pool.py (the Modal app); agent-server ships as its own deployable.
+MAX_CLIENTS = int(os.environ.get("OPENAI_POOL_MAX_CLIENTS", 32))
+MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONCURRENCY_PER_KEY", 16))
+
+_clients: "OrderedDict[str, OpenAI]" = OrderedDict() # sha256(api_key) -> client; raw keys are never stored
+_lock = threading.Lock()
+
+
+def get_openai_client(api_key: str) -> OpenAI:
+    """One keep-alive client per API key (LRU), shared by every Agent instance."""
+    key = hashlib.sha256(api_key.encode()).hexdigest()
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+
+        client = OpenAI(
+            api_key=api_key,
+            http_client=httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS * 2,
+                    max_keepalive_connections=MAX_CONNECTIONS,
+                    keepalive_expiry=120
+                ),
+                timeout=float(os.environ.get("OPENAI_TIMEOUT", 60))
+            )
+        )
+        _clients[key] = client
+        # Evicted clients are dropped, not closed: another request may still be using them
+        while len(_clients) > MAX_CLIENTS:
+            _clients.popitem(last=False)
+        return client
@@ -0,0 +1,63 @@
+-- Conversation snapshot: lead + summary + last N messages + message counter in ONE round trip.
+-- Run this in the SQL Editor of your Agent Supabase project.
+-- SupabaseClient.get_conversation_snapshot falls back to a combined select if this function is missing.
+
+-- The lead insert below relies on ON CONFLICT (client_id, phone). setup_agent_db.sql declares that
+-- key; databases built from supabase_schema.sql only have unique(phone). If this fails, merge the
+-- duplicate leads first (see fix_data_and_restore_fk.py).
+create unique index if not exists idx_leads_client_phone_unique on leads(client_id, phone);
+
+create or replace function get_conversation_snapshot(
+    p_client_id text,
+    p_phone text,
+    p_name text default null,
+    p_limit int default 10
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_lead leads;
+    v_created boolean := false;
+    v_messages jsonb;
+    v_returned int;
+    v_count bigint;
+begin
+    select * into v_lead from leads where client_id = p_client_id and phone = p_phone;
+
+    if not found then
+        insert into leads (client_id, phone, name, status)
+        values (p_client_id, p_phone, p_name, 'active')
+        on conflict (client_id, phone) do update set name = coalesce(leads.name, excluded.name)
+        returning * into v_lead;
+        v_created := true;
+    end if;
+
+    select coalesce(jsonb_agg(to_jsonb(m) order by m.created_at), '[]'::jsonb), count(*)
+      into v_messages, v_returned
+      from (
+        select id, role, content, created_at
+          from messages
+         where client_id = p_client_id and lead_id = v_lead.id
+         order by created_at desc
+         limit p_limit
+      ) m;
+
+    -- Prefer the counter maintained by trg_leads_track_messages (update_schema_phase4.py).
+    -- Otherwise only pay for a full count when the window is full.
+    if (to_jsonb(v_lead) ->> 'message_count') is not null then
+        v_count := (to_jsonb(v_lead) ->> 'message_count')::bigint;
+    elsif v_returned < p_limit then
+        v_count := v_returned;
+    else
+        select count(*) into v_count from messages where lead_id = v_lead.id;
+    end if;
+
+    return jsonb_build_object(
+        'lead', to_jsonb(v_lead),
+        'messages', v_messages,
+        'message_count', v_count,
+        'created', v_created
+    );
+end;
+$$;
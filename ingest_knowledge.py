@@ -0,0 +1,54 @@
+"""
+Ingests documents into a tenant's knowledge_base (chunk + embed + upsert).
+
+Usage:
+    python ingest_knowledge.py <client_id> manual.pdf faq.txt politicas.md
+    python ingest_knowledge.py <client_id> faq.txt --title "FAQ Pousada" --max-tokens 300
+
+Needs SUPABASE_URL / SUPABASE_SERVICE_KEY (admin DB) to resolve the tenant's database
+and API key from agent_configs. --openai-key (or OPENAI_API_KEY) overrides the key.
+Unchanged chunks are skipped, so re-running on the same files costs no embedding calls.
+"""
+import os
+import sys
+import asyncio
+import argparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from src.ingestion import build_ingestor
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("client_id")
+    parser.add_argument("paths", nargs="+", help=".pdf, .txt or .md files")
+    parser.add_argument("--title", help="Title for a single document (defaults to the file name)")
+    parser.add_argument("--openai-key", default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument("--max-tokens", type=int, default=400)
+    parser.add_argument("--overlap", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    ingestor = await build_ingestor(
+        args.client_id,
+        openai_api_key=args.openai_key,
+        max_tokens=args.max_tokens,
+        overlap=args.overlap,
+        max_concurrency=args.concurrency
+    )
+
+    for path in args.paths:
+        title = args.title if args.title and len(args.paths) == 1 else os.path.basename(path)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if path.lower().endswith(".pdf"):
+            stats = await ingestor.ingest_pdf(args.client_id, data, title)
+        else:
+            stats = await ingestor.ingest_document(args.client_id, title, data.decode("utf-8"))
+        print(f"✅ {title}: {stats}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
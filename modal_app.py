@@ -9,14 +9,19 @@ image = modal.Image.debian_slim().pip_install(
     "psycopg2-binary",
     "python-dateutil",
     "openai",
-    "tiktoken"
+    "tiktoken",
+    "httpx",
+    "PyPDF2"
 ).add_local_dir("src", remote_path="/root/src")
 
 
 app = modal.App("agente-serv-whatsapp")
 
-# Persistent Dict for storing conversation context waiting for tools
+# Persistent Dict for storing conversation context waiting for tools.
+# Accessed through src.context_store (compressed blobs with TTL), never directly.
 agent_contexts = modal.Dict.from_name("agent_contexts", create_if_missing=True)
+# Cache invalidation versions shared by every container (src.cache_sync)
+cache_versions = modal.Dict.from_name("cache_versions", create_if_missing=True)
 
 @app.function(
     image=image,
@@ -26,17 +31,51 @@ agent_contexts = modal.Dict.from_name("agent_contexts", create_if_missing=True)
 )
 @modal.asgi_app()
 def fastapi_app():
-    from fastapi import FastAPI, HTTPException
+    from fastapi import FastAPI, HTTPException, Depends, Header
+    from fastapi.responses import StreamingResponse
     from pydantic import BaseModel
-    from typing import Optional, Dict, Any
+    from typing import Optional, Dict, Any, List
     import os
+    import re
+    import json
+    import time
+    import hmac
+    import asyncio
     
     # Imports from src must be inside to work with the mount
     from src.orchestrator import Orchestrator
-    from src.database import SupabaseClient
+    from src.client_pool import supabase_pool
+    from src.config_cache import agent_config_cache
+    from src.write_buffer import write_buffer
+    from src.rag_cache import rag_cache
+    from src.llm_pool import openai_pool
+    from src.context_store import ContextStore, ModalDictBackend
+    from src.summarizer import summary_queue
+    from src.followup_queue import follow_up_queue
+    from src.coalescer import turn_coalescer
+    from src.lead_locks import lead_locks
     from src import tools # Import tools module if we want to use it
     
+    from src.cache_sync import invalidation_bus, ModalDictStore
+
     api = FastAPI()
+    invalidation_bus.attach(ModalDictStore(cache_versions))
+
+    def require_admin(x_admin_token: Optional[str] = Header(None)):
+        # Shared secret (ADMIN_API_TOKEN in supabase-secrets) for /metrics and /admin/*; unset = locked
+        expected = os.environ.get("ADMIN_API_TOKEN")
+        if not expected or not x_admin_token or not hmac.compare_digest(x_admin_token, expected):
+            raise HTTPException(status_code=401, detail="Invalid admin token")
+    context_store = ContextStore(ModalDictBackend(agent_contexts))
+
+    @api.on_event("shutdown")
+    async def drain_write_buffer():
+        # Flush queued assistant messages / token usage before the container goes away
+        await write_buffer.drain()
+        # Follow-up jobs scheduled by the last replies
+        await follow_up_queue.drain()
+        # Then fold pending conversations into their summaries
+        await summary_queue.drain()
 
     class WebhookRequest(BaseModel):
         client_id: str
@@ -45,12 +84,21 @@ def fastapi_app():
         lead_name: Optional[str] = None
         openai_api_key: Optional[str] = None
 
+    class ToolResultItem(BaseModel):
+        tool_call_id: str
+        tool_name: Optional[str] = None
+        tool_result: Dict[str, Any]
+
     class ToolResultRequest(BaseModel):
         context_id: str
         client_id: str
         lead_phone: str
-        tool_name: str
-        tool_result: Dict[str, Any]
+        # Single result (legacy): tool_call_id defaults to the first pending call
+        tool_name: Optional[str] = None
+        tool_result: Optional[Dict[str, Any]] = None
+        tool_call_id: Optional[str] = None
+        # Batch: any subset of the pending calls; resume happens once all have arrived
+        results: Optional[List[ToolResultItem]] = None
 
     class SaveMessageRequest(BaseModel):
         client_id: str = "default"
@@ -63,21 +111,84 @@ def fastapi_app():
         phone: str
         limit: int = 10
 
+    class InvalidateConfigRequest(BaseModel): # Also used for the RAG cache
+        client_id: Optional[str] = None
+
     @api.get("/health")
     async def health():
         return {"status": "healthy"}
 
+    @api.get("/metrics", dependencies=[Depends(require_admin)])
+    async def metrics():
+        return {
+            "agent_config_cache": agent_config_cache.stats(),
+            "supabase_pool": supabase_pool.stats(),
+            "write_buffer": write_buffer.stats(),
+            "rag_cache": rag_cache.stats(),
+            "openai_pool": openai_pool.stats(),
+            "summary_queue": summary_queue.stats(),
+            "follow_up_queue": follow_up_queue.stats(),
+            "turn_coalescer": turn_coalescer.stats(),
+            "lead_locks": lead_locks.stats(),
+            "invalidation_bus": invalidation_bus.stats()
+        }
+
+    @api.post("/admin/config-cache/invalidate", dependencies=[Depends(require_admin)])
+    async def invalidate_config_cache(req: InvalidateConfigRequest):
+        # Called by the dashboard after editing an agent_config.
+        # Omitting client_id flushes every tenant. Immediate in this container; the others
+        # drop the entry within CACHE_SYNC_INTERVAL seconds (shared version in cache_versions).
+        removed = await agent_config_cache.broadcast_invalidate(req.client_id)
+        return {"success": True, "client_id": req.client_id, "removed": removed}
+
+    @api.post("/admin/rag-cache/invalidate", dependencies=[Depends(require_admin)])
+    async def invalidate_rag_cache(req: InvalidateConfigRequest):
+        # Called by the dashboard after knowledge_base rows change.
+        removed = await rag_cache.broadcast_invalidate(req.client_id)
+        return {"success": True, "client_id": req.client_id, "removed": removed}
+
+    async def suspend_for_tool(req: WebhookRequest, result: dict) -> dict:
+        import uuid
+
+        # Generate Context ID
+        context_id = str(uuid.uuid4())
+        
+        # Store Context in Modal Dict
+        context_data = {
+            "client_id": req.client_id,
+            "lead_phone": req.lead_phone,
+            "messages": result.get("messages"),
+            "tool_call_id": result.get("tool_call_id"),
+            "tool_name": result.get("tool_name"),
+            "tool_calls": [
+                {"tool_call_id": c["tool_call_id"], "tool_name": c["tool_name"]}
+                for c in result.get("tool_calls") or []
+            ],
+            "lead_id": result.get("lead_id"),
+            # Model steps before the suspension; logged together with the resumed reply
+            "usage": {key: result.get(key, 0) for key in ("tokens_used", "prompt_tokens", "completion_tokens", "cached_tokens")}
+        }
+        size = await context_store.save(context_id, context_data)
+        print(f"[CONTEXT] Suspended {context_id}: {size} bytes compressed")
+        
+        return {
+            "success": True,
+            "type": "tool_call",
+            "tool_name": result.get("tool_name"),
+            "tool_params": result.get("tool_params"),
+            "tool_calls": result.get("tool_calls") or [],
+            "context_id": context_id,
+            "message": "Aguardando execução de tool externa..."
+        }
+
     @api.post("/webhook/execute")
     async def webhook_execute(req: WebhookRequest):
         try:
-            url = os.environ["SUPABASE_URL"]
-            key = os.environ["SUPABASE_SERVICE_KEY"]
-            import uuid
-            
-            db_client = SupabaseClient(url, key)
+            db_client = supabase_pool.get_admin()
             orchestrator = Orchestrator(db_client)
             
-            result = await orchestrator.execute_agent(
+            # Bursts from the same lead are merged into one turn (src/coalescer.py)
+            result = await orchestrator.execute_coalesced(
                 client_id=req.client_id,
                 lead_phone=req.lead_phone,
                 message=req.message,
@@ -86,27 +197,7 @@ def fastapi_app():
             )
             
             if result.get("success") and result.get("type") == "tool_call":
-                # Generate Context ID
-                context_id = str(uuid.uuid4())
-                
-                # Store Context in Modal Dict
-                context_data = {
-                    "client_id": req.client_id,
-                    "lead_phone": req.lead_phone,
-                    "messages": result.get("messages"),
-                    "tool_call_id": result.get("tool_call_id"),
-                    "tool_name": result.get("tool_name")
-                }
-                agent_contexts[context_id] = context_data
-                
-                return {
-                    "success": True,
-                    "type": "tool_call",
-                    "tool_name": result.get("tool_name"),
-                    "tool_params": result.get("tool_params"),
-                    "context_id": context_id,
-                    "message": "Aguardando execução de tool externa..."
-                }
+                return await suspend_for_tool(req, result)
 
             return result
         except Exception as e:
@@ -121,11 +212,71 @@ def fastapi_app():
                 "error_type": "internal_error"
             }
 
+    SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+    def sse(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+    @api.post("/webhook/execute/stream")
+    async def webhook_execute_stream(req: WebhookRequest):
+        """
+        Server-Sent Events version of /webhook/execute.
+        Events: "delta" (raw tokens), "sentence" (complete sentences, ready to send to WhatsApp),
+        "tool_call_delta", and a final "done" whose payload matches /webhook/execute plus ttfb_ms.
+        """
+        received = time.perf_counter()
+
+        async def events():
+            orchestrator = Orchestrator(supabase_pool.get_admin())
+            ttfb_ms = None
+            pending = ""
+            try:
+                async for event in orchestrator.stream_agent(
+                    client_id=req.client_id,
+                    lead_phone=req.lead_phone,
+                    message=req.message,
+                    lead_name=req.lead_name,
+                    openai_api_key=req.openai_api_key
+                ):
+                    if event["type"] == "done":
+                        result = event["result"]
+                        if pending.strip():
+                            yield sse("sentence", {"content": pending.strip()})
+                        if result.get("success") and result.get("type") == "tool_call":
+                            result = await suspend_for_tool(req, result)
+                        result["ttfb_ms"] = ttfb_ms
+                        result["stream_total_ms"] = round((time.perf_counter() - received) * 1000, 1)
+                        print(f"[TIMING] stream {req.client_id}: ttfb={ttfb_ms}ms total={result['stream_total_ms']}ms")
+                        yield sse("done", result)
+                        return
+
+                    if ttfb_ms is None:
+                        ttfb_ms = round((time.perf_counter() - received) * 1000, 1)
+                    yield sse(event["type"], {k: v for k, v in event.items() if k != "type"})
+
+                    if event["type"] == "delta":
+                        pending += event["content"]
+                        parts = SENTENCE_END.split(pending)
+                        for sentence in parts[:-1]:
+                            if sentence.strip():
+                                yield sse("sentence", {"content": sentence.strip()})
+                        pending = parts[-1]
+            except Exception as e:
+                import traceback
+                print(f"WEBHOOK STREAM ERROR: {traceback.format_exc()}")
+                yield sse("done", {"success": False, "error": str(e), "error_type": "internal_error"})
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
     @api.post("/webhook/tool-result")
     async def tool_result(req: ToolResultRequest):
         try:
             # Retrieve Context
-            context_data = agent_contexts.get(req.context_id)
+            context_data = await context_store.load(req.context_id)
             if not context_data:
                 return {"success": False, "error": "Context not found or expired"}
             
@@ -133,28 +284,69 @@ def fastapi_app():
             if context_data['client_id'] != req.client_id or context_data['lead_phone'] != req.lead_phone:
                 return {"success": False, "error": "Context mismatch"}
 
-            url = os.environ["SUPABASE_URL"]
-            key = os.environ["SUPABASE_SERVICE_KEY"]
-            
-            db_client = SupabaseClient(url, key)
+            # Contexts stored before batching only know one call
+            pending_calls = context_data.get('tool_calls') or [
+                {"tool_call_id": context_data['tool_call_id'], "tool_name": context_data.get('tool_name')}
+            ]
+            names = {c['tool_call_id']: c['tool_name'] for c in pending_calls}
+
+            items = list(req.results or [])
+            if req.tool_result is not None:
+                items.append(ToolResultItem(
+                    tool_call_id=req.tool_call_id or context_data['tool_call_id'],
+                    tool_name=req.tool_name,
+                    tool_result=req.tool_result
+                ))
+            unknown = [item.tool_call_id for item in items if item.tool_call_id not in names]
+            if unknown:
+                return {"success": False, "error": f"Unknown tool_call_id(s): {unknown}"}
+
+            # One key per result, so concurrent callbacks for the same context don't overwrite each other
+            await asyncio.gather(*(
+                context_store.put_result(req.context_id, item.tool_call_id, {
+                    "tool_call_id": item.tool_call_id,
+                    "tool_name": item.tool_name or names[item.tool_call_id],
+                    "tool_result": item.tool_result
+                })
+                for item in items
+            ))
+
+            tool_results = await context_store.get_results(req.context_id, names)
+            missing = [call_id for call_id, found in zip(names, tool_results) if found is None]
+            if missing:
+                return {
+                    "success": True,
+                    "type": "waiting_tool_results",
+                    "context_id": req.context_id,
+                    "pending_tool_call_ids": missing
+                }
+
+            # Only the callback that completes the batch resumes the conversation
+            if not await context_store.claim(req.context_id):
+                return {"success": True, "type": "already_resuming", "context_id": req.context_id}
+
+            db_client = supabase_pool.get_admin()
             orchestrator = Orchestrator(db_client)
             
             # Resume Execution
-            result = await orchestrator.resume_agent(
-                client_id=req.client_id,
-                lead_phone=req.lead_phone,
-                messages=context_data['messages'],
-                tool_call_id=context_data['tool_call_id'],
-                tool_name=req.tool_name,
-                tool_result=req.tool_result
-            )
+            try:
+                result = await orchestrator.resume_agent(
+                    client_id=req.client_id,
+                    lead_phone=req.lead_phone,
+                    messages=context_data['messages'],
+                    tool_results=tool_results,
+                    lead_id=context_data.get('lead_id'),
+                    usage=context_data.get('usage')
+                )
+            except Exception:
+                await context_store.release(req.context_id)
+                raise
             
-            # Clean up context if successful final message
+            # Clean up context if successful final message; otherwise allow a retry
             if result.get("success") and result.get("type") == "message":
-                try:
-                    agent_contexts.pop(req.context_id)
-                except:
-                    pass
+                await context_store.delete(req.context_id, names.keys())
+            else:
+                await context_store.release(req.context_id)
 
             return result
 
@@ -164,9 +356,7 @@ def fastapi_app():
     @api.post("/test/save")
     async def test_save(req: SaveMessageRequest):
         try:
-            url = os.environ["SUPABASE_URL"]
-            key = os.environ["SUPABASE_SERVICE_KEY"]
-            db = SupabaseClient(url, key)
+            db = supabase_pool.get_admin()
             
             lead = await db.get_or_create_lead(req.client_id, req.phone)
             if not lead:
@@ -180,9 +370,7 @@ def fastapi_app():
     @api.post("/test/get")
     async def test_get(req: GetHistoryRequest):
         try:
-            url = os.environ["SUPABASE_URL"]
-            key = os.environ["SUPABASE_SERVICE_KEY"]
-            db = SupabaseClient(url, key)
+            db = supabase_pool.get_admin()
             
             lead = await db.get_or_create_lead(req.client_id, req.phone)
             if not lead:
@@ -203,15 +391,40 @@ def fastapi_app():
     ]
 )
 async def run_scheduler():
-    import os
-    from src.database import SupabaseClient
+    from src.client_pool import supabase_pool
     from src.scheduler import FollowUpScheduler
     
-    url = os.environ["SUPABASE_URL"]
-    key = os.environ["SUPABASE_SERVICE_KEY"]
-    
     # Initialize Admin DB
-    admin_db = SupabaseClient(url, key)
+    admin_db = supabase_pool.get_admin()
     
     scheduler = FollowUpScheduler(admin_db)
     await scheduler.run_check()
+
+    # Suspended tool contexts that were never resumed
+    from src.context_store import ContextStore, ModalDictBackend
+    swept = await ContextStore(ModalDictBackend(agent_contexts)).sweep()
+    print(f"[CONTEXT] Swept {swept} expired agent context entries")
+
+@app.function(
+    image=image,
+    timeout=1800,
+    secrets=[
+        modal.Secret.from_name("supabase-secrets")
+    ]
+)
+async def ingest_knowledge(client_id: str, title: str, text: str = None, pdf_bytes: bytes = None, metadata: dict = None):
+    """
+    Chunks, embeds and upserts one document into the tenant's knowledge_base.
+    Pass either `text` or `pdf_bytes`. Unchanged chunks are skipped.
+    """
+    from src.ingestion import build_ingestor
+    from src.cache_sync import invalidation_bus, ModalDictStore
+
+    # So the rag_cache invalidation at the end reaches the webhook containers
+    invalidation_bus.attach(ModalDictStore(cache_versions))
+    ingestor = await build_ingestor(client_id)
+    if pdf_bytes:
+        stats = await ingestor.ingest_pdf(client_id, pdf_bytes, title, metadata)
+    else:
+        stats = await ingestor.ingest_document(client_id, title, text or "", metadata)
+    return {"success": True, "client_id": client_id, "title": title, **stats}
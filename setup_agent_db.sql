@@ -14,6 +14,11 @@ create table if not exists leads (
     updated_at timestamp with time zone default now(),
     last_followup_minutes int default 0,
     conversation_summary text,
+    summary_watermark timestamp with time zone, -- (created_at, id) of the last summarized message (src/summarizer.py)
+    summary_watermark_id uuid,
+    message_count int not null default 0, -- maintained by trg_leads_track_messages
+    last_message_at timestamp with time zone,
+    last_message_role text,
     unique(client_id, phone)
 );
 
@@ -36,6 +41,7 @@ create table if not exists token_usage (
     model text not null,
     tokens_in int default 0,
     tokens_out int default 0,
+    tokens_cached int default 0, -- Prompt-cache hits (part of tokens_in)
     tokens_used int generated always as (tokens_in + tokens_out) stored,
     cost float default 0,
     estimated_cost float default 0, -- Legacy support
@@ -51,6 +57,7 @@ create table if not exists knowledge_base (
     category text,
     metadata jsonb default '{}',
     embedding vector(1536),
+    content_hash text, -- sha256 of (client_id, source, content); set by src/ingestion.py
     created_at timestamp with time zone default now(),
     updated_at timestamp with time zone default now()
 );
@@ -61,8 +68,12 @@ create table if not exists follow_ups (
     client_id text not null,
     lead_id uuid references leads(id) on delete cascade,
     scheduled_at timestamp with time zone not null,
-    status text default 'pending', -- 'pending', 'sent', 'cancelled'
+    status text default 'pending', -- 'pending', 'sent', 'cancelled', 'failed'
     content text,
+    rule_minutes int, -- follow-up rule this job fires (followup_mode = 'queue')
+    locked_until timestamp with time zone, -- lease of the worker sending it
+    attempts int not null default 0,
+    sent_at timestamp with time zone,
     created_at timestamp with time zone default now()
 );
 
@@ -84,7 +95,222 @@ create table if not exists agent_learnings (
 create index if not exists idx_leads_client_phone on leads(client_id, phone);
 create index if not exists idx_messages_lead_id on messages(lead_id);
 create index if not exists idx_messages_client_id on messages(client_id);
+create index if not exists idx_messages_lead_created on messages(lead_id, created_at, id); -- summarizer keyset
 create index if not exists idx_kb_client_id on knowledge_base(client_id);
+create unique index if not exists idx_kb_client_content_hash on knowledge_base(client_id, content_hash);
+create index if not exists idx_kb_client_source on knowledge_base(client_id, (metadata->>'source'));
 create index if not exists idx_follow_ups_pending on follow_ups(status, scheduled_at);
+create index if not exists idx_follow_ups_due on follow_ups(client_id, scheduled_at) where status = 'pending';
+create index if not exists idx_follow_ups_lead_pending on follow_ups(lead_id) where status = 'pending';
+create index if not exists idx_leads_followup_candidates on leads(status, last_message_role, last_message_at);
 create index if not exists idx_learnings_client on agent_learnings(client_id);
 create index if not exists idx_learnings_phone on agent_learnings(client_id, lead_phone);
+
+-- 9. Per-lead message counter (see update_schema_phase4.py for existing databases)
+create or replace function leads_track_messages() returns trigger
+language plpgsql as $$
+begin
+    if TG_OP = 'INSERT' then
+        update leads set
+            message_count = message_count + 1,
+            last_message_at = greatest(coalesce(last_message_at, new.created_at), new.created_at),
+            last_message_role = case
+                when last_message_at is null or new.created_at >= last_message_at then new.role
+                else last_message_role
+            end
+        where id = new.lead_id;
+        return new;
+    elsif TG_OP = 'DELETE' then
+        update leads set message_count = greatest(message_count - 1, 0)
+        where id = old.lead_id;
+        return old;
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists trg_leads_track_messages on messages;
+create trigger trg_leads_track_messages
+after insert or delete on messages
+for each row execute function leads_track_messages();
+
+-- 10. Vector search over knowledge_base (rag_mode = 'vector', see update_knowledge_base_vector.sql)
+create index if not exists idx_knowledge_base_embedding on knowledge_base using ivfflat (embedding vector_cosine_ops);
+
+create or replace function search_knowledge_base(
+    query_embedding vector(1536),
+    filter_client_id text,
+    match_threshold float default 0.5,
+    match_count int default 5
+)
+returns table (id uuid, title text, content text, metadata jsonb, similarity float)
+language plpgsql
+as $$
+begin
+    return query
+    select kb.id, kb.title, kb.content, kb.metadata, 1 - (kb.embedding <=> query_embedding) as similarity
+    from knowledge_base kb
+    where kb.client_id = filter_client_id
+      and kb.embedding is not null
+      and 1 - (kb.embedding <=> query_embedding) > match_threshold
+    order by kb.embedding <=> query_embedding
+    limit match_count;
+end;
+$$;
+
+-- 11. Follow-up job queue (followup_mode = 'queue', see update_follow_ups_queue.sql)
+-- Assistant reply: the lead's pending job is replaced by the first rule's
+create or replace function schedule_follow_up(
+    p_client_id text,
+    p_lead_id uuid,
+    p_rule_minutes int,
+    p_scheduled_at timestamp with time zone
+)
+returns void
+language plpgsql
+as $$
+begin
+    update follow_ups set status = 'cancelled'
+    where lead_id = p_lead_id and status = 'pending';
+
+    insert into follow_ups (client_id, lead_id, rule_minutes, scheduled_at)
+    values (p_client_id, p_lead_id, p_rule_minutes, p_scheduled_at);
+end;
+$$;
+
+-- Leases up to p_limit due jobs. SKIP LOCKED lets concurrent workers claim disjoint rows;
+-- the lease hides claimed rows until they are marked sent/failed or the worker dies.
+create or replace function claim_follow_ups(
+    p_client_id text,
+    p_limit int default 100,
+    p_lease_seconds int default 300
+)
+returns table (id uuid, lead_id uuid, rule_minutes int, scheduled_at timestamp with time zone, attempts int, phone text, name text)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+    -- Leads closed or converted since the job was scheduled get no follow-up (same rule as scan mode)
+    update follow_ups f
+    set status = 'cancelled', locked_until = null
+    from leads l
+    where l.id = f.lead_id
+      and f.client_id = p_client_id
+      and f.status = 'pending'
+      and f.scheduled_at <= now()
+      and l.status is distinct from 'active';
+
+    return query
+    with due as (
+        select f.id
+        from follow_ups f
+        join leads l on l.id = f.lead_id
+        where f.client_id = p_client_id
+          and f.status = 'pending'
+          and f.rule_minutes is not null
+          and f.scheduled_at <= now()
+          and (f.locked_until is null or f.locked_until < now())
+          and l.status = 'active'
+        order by f.scheduled_at
+        limit p_limit
+        for update of f skip locked
+    ), claimed as (
+        update follow_ups f
+        set locked_until = now() + make_interval(secs => p_lease_seconds),
+            attempts = f.attempts + 1
+        from due
+        where f.id = due.id
+        returning f.id, f.lead_id, f.rule_minutes, f.scheduled_at, f.attempts
+    )
+    select c.id, c.lead_id, c.rule_minutes, c.scheduled_at, c.attempts, l.phone, l.name
+    from claimed c
+    join leads l on l.id = c.lead_id;
+end;
+$$;
+
+-- 12. Atomic get-or-create for leads (see update_leads_upsert.sql)
+-- Existing lead: one index lookup, no write. New lead: INSERT ... ON CONFLICT DO NOTHING,
+-- and a concurrent insert that won the race is read back. Always one round trip.
+create or replace function upsert_lead(
+    p_client_id text,
+    p_phone text,
+    p_name text default null
+)
+returns leads
+language plpgsql
+as $$
+declare
+    v_lead leads;
+begin
+    select * into v_lead from leads where client_id = p_client_id and phone = p_phone;
+    if found then
+        return v_lead;
+    end if;
+
+    insert into leads (client_id, phone, name, status)
+    values (p_client_id, p_phone, p_name, 'active')
+    on conflict (client_id, phone) do nothing
+    returning * into v_lead;
+
+    if not found then
+        select * into v_lead from leads where client_id = p_client_id and phone = p_phone;
+    end if;
+    return v_lead;
+end;
+$$;
+
+-- 13. Conversation snapshot: lead + summary + last N messages in one round trip (see create_conversation_snapshot.sql)
+create or replace function get_conversation_snapshot(
+    p_client_id text,
+    p_phone text,
+    p_name text default null,
+    p_limit int default 10
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_lead leads;
+    v_created boolean := false;
+    v_messages jsonb;
+    v_returned int;
+    v_count bigint;
+begin
+    select * into v_lead from leads where client_id = p_client_id and phone = p_phone;
+
+    if not found then
+        insert into leads (client_id, phone, name, status)
+        values (p_client_id, p_phone, p_name, 'active')
+        on conflict (client_id, phone) do update set name = coalesce(leads.name, excluded.name)
+        returning * into v_lead;
+        v_created := true;
+    end if;
+
+    select coalesce(jsonb_agg(to_jsonb(m) order by m.created_at), '[]'::jsonb), count(*)
+      into v_messages, v_returned
+      from (
+        select id, role, content, created_at
+          from messages
+         where client_id = p_client_id and lead_id = v_lead.id
+         order by created_at desc
+         limit p_limit
+      ) m;
+
+    -- Prefer the counter maintained by trg_leads_track_messages (update_schema_phase4.py).
+    -- Otherwise only pay for a full count when the window is full.
+    if (to_jsonb(v_lead) ->> 'message_count') is not null then
+        v_count := (to_jsonb(v_lead) ->> 'message_count')::bigint;
+    elsif v_returned < p_limit then
+        v_count := v_returned;
+    else
+        select count(*) into v_count from messages where lead_id = v_lead.id;
+    end if;
+
+    return jsonb_build_object(
+        'lead', to_jsonb(v_lead),
+        'messages', v_messages,
+        'message_count', v_count,
+        'created', v_created
+    );
+end;
+$$;
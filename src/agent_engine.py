@@ -1,6 +1,8 @@
-from openai import OpenAI, AsyncOpenAI
 import json
+import asyncio
 from .tools_registry import ToolsRegistry
+from .llm_pool import openai_pool
+from .prompt_builder import build_messages
 
 class AgentEngine:
     INTERNAL_TOOLS = [
@@ -8,9 +10,28 @@ class AgentEngine:
         "search_knowledge_base", 
         "analyze_lead_profile"
     ]
+    MAX_STEPS = 4 # Model calls per turn (agent_configs.max_tool_steps)
 
-    def __init__(self, tools_registry: ToolsRegistry):
+    def __init__(self, tools_registry: ToolsRegistry, client_id: str = None, max_concurrency: int = None):
         self.tools_registry = tools_registry
+        self.client_id = client_id
+        # Per-tenant cap on in-flight LLM calls (agent_configs.llm_max_concurrency). Always explicit,
+        # so clearing the config puts the key back on the pool default
+        self.max_concurrency = max_concurrency or openai_pool.max_concurrency
+
+    async def _complete(self, openai_api_key: str, **kwargs):
+        """chat.completions.create on the pooled client, bounded by the tenant's semaphore for the key."""
+        client = openai_pool.get(openai_api_key)
+        async with openai_pool.limit(openai_api_key, self.client_id, self.max_concurrency):
+            return await client.chat.completions.create(**kwargs)
+
+    async def _stream_completion(self, openai_api_key: str, **kwargs):
+        """Streaming variant of _complete; the slot is held until the stream is drained."""
+        client = openai_pool.get(openai_api_key)
+        async with openai_pool.limit(openai_api_key, self.client_id, self.max_concurrency):
+            stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+            async for chunk in stream:
+                yield chunk
 
     def _normalize_date(self, date_str: str) -> str:
         """
@@ -55,28 +76,7 @@ class AgentEngine:
              pass
         return date_str
 
-    async def _should_use_rag(self, message: str) -> bool:
-        triggers = [
-            'informação', 'política', 'regra', 'como funciona',
-            'horário', 'preço', 'aceita', 'pode', 'permite',
-            'cancelamento', 'pagamento', 'checkout', 'check-in', 'café'
-        ]
-        msg_lower = message.lower()
-        if any(t in msg_lower for t in triggers):
-            return True
-        if any(msg_lower.startswith(q) for q in ['qual', 'quando', 'como', 'onde', 'quem']):
-            return True
-        return False
-        
-    async def execute(self, system_prompt: str, user_message: str, tool_names: list, context: dict, openai_api_key: str, model: str = 'gpt-4o-mini', temperature: float = 0.7, max_tokens: int = 1000):
-        # ... (Existing execute code start) ...
-
-        if not openai_api_key:
-             return {"success": False, "error": "OpenAI API Key provided is empty"}
-
-        client = AsyncOpenAI(api_key=openai_api_key)
-        
-        # 1. Prepare Tools
+    def _prepare_tools(self, tool_names: list) -> list:
         # Parse enabled tools (tool_names can be list of strings or dicts from config)
         dynamic_tools_conf = [t for t in tool_names if isinstance(t, dict)]
         static_tool_names = [t for t in tool_names if isinstance(t, str)]
@@ -91,193 +91,287 @@ class AgentEngine:
         
         # Filter definitions
         tool_definitions = [t for t in all_defs if t['function']['name'] in allowed_names]
+        return tool_definitions
+
+    def _build_messages(self, system_prompt: str, user_message: str, context: dict) -> list:
+        return build_messages(
+            system_prompt,
+            user_message,
+            summary=context.get("memory_summary", ""),
+            dynamic_context=context.get("dynamic_context", ""),
+            recent_messages=context.get("recent_messages"),
+            volatile_context=context.get("volatile_context", ""),
+            history_str=context.get("history_str", "")
+        )
+
+    def _parse_tool_args(self, tool_name: str, arguments: str, context: dict) -> dict:
+        try:
+            tool_args = json.loads(arguments)
+        except:
+            tool_args = {}
         
-        # 2. Prepare Messages
-        messages = [
-            {"role": "system", "content": system_prompt},
-        ]
-        
-        # Inject memory summary (Layer 1: compressed old context)
-        if context.get("memory_summary"):
-            messages.append({"role": "system", "content": f"RESUMO DA CONVERSA ANTERIOR:\n{context['memory_summary']}"})
-        
-        # Inject recent messages as real chat messages (Layer 2: detailed recent)
-        if context.get("recent_messages"):
-            for msg in context["recent_messages"]:
-                messages.append({"role": msg["role"], "content": msg["content"]})
-        elif context.get("history_str"):
-            # Fallback for backward compatibility (resume_agent)
-            messages.append({"role": "system", "content": f"Contexto da conversa:\n{context['history_str']}"})
-        
-        messages.append({"role": "user", "content": user_message})
+        # Setup Context (Client ID)
+        if 'client_id' in context:
+            tool_args['client_id'] = context.get('client_id')
+
+        # --- DATE NORMALIZATION ---
+        if tool_name in ["disponibilidade", "check_availability", "reservar"]:
+            for key in ["data_inicio", "data_fim", "checkin", "checkout", "date"]:
+                if key in tool_args:
+                    tool_args[key] = self._normalize_date(tool_args[key])
+        # --------------------------
+        return tool_args
+
+    @staticmethod
+    def _new_usage() -> dict:
+        return {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
+
+    @staticmethod
+    def _add_usage(usage: dict, step_usage) -> None:
+        if not step_usage:
+            return
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            usage[key] += getattr(step_usage, key, 0) or 0
+        # Prompt-cache hits (prefix reused by the provider)
+        details = getattr(step_usage, "prompt_tokens_details", None)
+        usage["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+    @staticmethod
+    def _message_result(content: str, usage: dict) -> dict:
+        return {
+            "success": True,
+            "type": "message",
+            "response": content,
+            "tokens_used": usage["total_tokens"],
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "cached_tokens": usage["cached_tokens"]
+        }
+
+    def _tool_choice(self, tool_definitions: list, step: int, max_steps: int, usage: dict, token_budget: int = None):
+        """'auto' while the loop may continue; 'none' on the last step or once the token budget is spent."""
+        if not tool_definitions:
+            return None
+        if step >= max_steps - 1 or (token_budget and usage["total_tokens"] >= token_budget):
+            return "none"
+        return "auto"
+
+    async def _run_internal_tools(self, calls: list) -> list:
+        """Runs every internal tool call of one model turn concurrently; returns tool messages in call order."""
+        outputs = await asyncio.gather(
+            *[self.tools_registry.execute_tool(call["name"], **call["args"]) for call in calls],
+            return_exceptions=True
+        )
+        tool_messages = []
+        for call, output in zip(calls, outputs):
+            if isinstance(output, Exception):
+                print(f"[ERROR] Internal tool {call['name']} failed: {output}")
+                output = f"Erro ao executar {call['name']}: {output}"
+            tool_messages.append({
+                "tool_call_id": call["id"],
+                "role": "tool",
+                "name": call["name"],
+                "content": str(output)
+            })
+        return tool_messages
+
+    async def _handle_tool_calls(self, calls: list, content: str, messages: list, context: dict, usage: dict):
+        """
+        Applies one model turn's tool calls ([{"id", "name", "arguments"}]) to `messages`.
+        Internal tools run here; returns the tool_call result listing every external call
+        when n8n has to run some, or None when the loop should call the model again.
+        """
+        for call in calls:
+            call["args"] = self._parse_tool_args(call["name"], call["arguments"], context)
+        internal = [c for c in calls if c["name"] in self.INTERNAL_TOOLS]
+        external = [c for c in calls if c["name"] not in self.INTERNAL_TOOLS]
+
+        # Plain dicts (not SDK objects) so the suspended state stays serializable
+        messages.append({
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [
+                {"id": c["id"], "type": "function", "function": {"name": c["name"], "arguments": c["arguments"]}}
+                for c in internal + external
+            ]
+        })
+
+        if internal:
+            print(f"[DEBUG] Executing {len(internal)} internal tool(s) concurrently: {[c['name'] for c in internal]}")
+            messages.extend(await self._run_internal_tools(internal))
+
+        if not external:
+            return None
+
+        # External Tools -> Return every pending call to N8N in one suspension.
+        # tool_name/tool_params/tool_call_id mirror the first call for older flows.
+        call = external[0]
+        print(f"[DEBUG] Returning {len(external)} tool_call(s) for external execution: {[c['name'] for c in external]}")
+        import uuid
+        return {
+            "success": True, # Wrapper expects success field
+            "type": "tool_call",
+            "tool_name": call["name"],
+            "tool_params": call["args"],
+            "tool_call_id": call["id"],
+            "tool_calls": [
+                {"tool_call_id": c["id"], "tool_name": c["name"], "tool_params": c["args"]}
+                for c in external
+            ],
+            "context_id": str(uuid.uuid4()), # Unique ID for this suspension
+            "messages": messages, # Save state
+            "tokens_used": usage["total_tokens"],
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "cached_tokens": usage["cached_tokens"]
+        }
+
+    async def execute(self, system_prompt: str, user_message: str, tool_names: list, context: dict, openai_api_key: str, model: str = 'gpt-4o-mini', temperature: float = 0.7, max_tokens: int = 1000,
+                      max_steps: int = None, token_budget: int = None):
+        """
+        Bounded agent loop: each step is one model call, and all internal tool calls of a
+        step run concurrently before the next one. Ends on a text answer or an external tool
+        call (suspends for n8n). On the last step (max_steps) or once token_budget is spent
+        tools are disabled, so the model has to answer. Usage is summed across steps.
+        """
+        if not openai_api_key:
+             return {"success": False, "error": "OpenAI API Key provided is empty"}
 
-        tokens_total = 0
+        max_steps = max(1, max_steps or self.MAX_STEPS)
+        tool_definitions = self._prepare_tools(tool_names)
+        messages = self._build_messages(system_prompt, user_message, context)
+        usage = self._new_usage()
 
-        # --- AUTO RAG CHECK ---
-        if await self._should_use_rag(user_message):
-            try:
-                # Check if search_knowledge_base is available/internal
-                rag_results = await self.tools_registry.execute_tool("search_knowledge_base", query=user_message, client_id=context.get('client_id'))
-                if rag_results:
-                     system_prompt += f"\n\nINFORMAÇÕES RELEVANTES (RAG):\n{rag_results}\n"
-            except Exception as e:
-                print(f"[WARN] Auto-RAG failed: {e}")
-        # --- END AUTO RAG ---
+        # Retrieval for the prompt runs in the Orchestrator's RAG stage (when rag_enabled),
+        # before the system prompt is built; results are shared through ToolsRegistry.retrieve
 
         try:
-            # 3. Call OpenAI
-            print(f"[DEBUG] Calling OpenAI with {len(tool_definitions)} tools: {[t['function']['name'] for t in tool_definitions]}")
-            
-            response = await client.chat.completions.create(
-                model=model,
-                messages=messages,
-                tools=tool_definitions if tool_definitions else None,
-                tool_choice="auto" if tool_definitions else None,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            
-            response_message = response.choices[0].message
-            tokens_total += response.usage.total_tokens
+            for step in range(max_steps):
+                tool_choice = self._tool_choice(tool_definitions, step, max_steps, usage, token_budget)
+                print(f"[DEBUG] Step {step + 1}/{max_steps}: calling OpenAI with {len(tool_definitions)} tools (tool_choice={tool_choice})")
 
-            print(f"[DEBUG] OpenAI finish_reason: {response.choices[0].finish_reason}")
-            print(f"[DEBUG] Has tool_calls: {bool(response_message.tool_calls)}")
-            
-            # 4. Handle Response
-            if response_message.tool_calls:
-                # Append assistant message with tool calls
-                messages.append(response_message)
-                
-                tool_call = response_message.tool_calls[0] # Handle primary tool call
-                tool_name = tool_call.function.name
-                try:
-                    tool_args = json.loads(tool_call.function.arguments)
-                except:
-                    tool_args = {}
-                
-                # Setup Context (Client ID)
-                if 'client_id' in context:
-                    tool_args['client_id'] = context.get('client_id')
-
-                # --- DATE NORMALIZATION ---
-                if tool_name in ["disponibilidade", "check_availability", "reservar"]:
-                    for key in ["data_inicio", "data_fim", "checkin", "checkout", "date"]:
-                        if key in tool_args:
-                            tool_args[key] = self._normalize_date(tool_args[key])
-                # --------------------------
-
-                print(f"[DEBUG] Tool selected: {tool_name}, Args: {tool_args}")
-
-                # A. Internal Tool -> Execute & Loop
-                if tool_name in self.INTERNAL_TOOLS:
-                    print(f"[DEBUG] Executing internal tool: {tool_name}")
-                    
-                    # Execute via Registry
-                    tool_output = await self.tools_registry.execute_tool(tool_name, **tool_args)
-                    
-                    # Append result
-                    messages.append({
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": tool_name,
-                        "content": str(tool_output)
-                    })
-                    
-                # Recurse (Second Call)
-                    print(f"[DEBUG] Recursively calling OpenAI with tool result...")
-                    final_response = await client.chat.completions.create(
-                        model=model,
-                        messages=messages,
-                        tools=tool_definitions if tool_definitions else None, # Keep tools available? Usually yes.
-                        temperature=temperature,
-                        max_tokens=max_tokens
-                    )
-                    tokens_total += final_response.usage.total_tokens
-                    
-                    # Accumulate usage roughly (this is simplified as we executed twice)
-                    # We should probably return the *last* response usage or sum them?
-                    # For simplicity, returning the total accumulated so far for total, 
-                    # but for breakdown, we might loose the first call's breakdown if we don't track it.
-                    # Let's track cumulative for now if needed, but Orchestrator expects single call stats usually.
-                    # Since we return a single "message", let's return the totals.
-                    
-                    # Note: response.usage from first call + final_response.usage
-                    p_tokens = response.usage.prompt_tokens + final_response.usage.prompt_tokens
-                    c_tokens = response.usage.completion_tokens + final_response.usage.completion_tokens
-
-                    return {
-                        "success": True,
-                        "type": "message",
-                        "response": final_response.choices[0].message.content,
-                        "tokens_used": tokens_total,
-                        "prompt_tokens": p_tokens,
-                        "completion_tokens": c_tokens
-                    }
-
-                # B. External Tool -> Return Payload for N8N
-                else:
-                    print(f"[DEBUG] Returning tool_call for external execution: {tool_name}")
-                    import uuid
-                    return {
-                        "success": True, # Wrapper expects success field
-                        "type": "tool_call",
-                        "tool_name": tool_name,
-                        "tool_params": tool_args,
-                        "tool_call_id": tool_call.id,
-                        "context_id": str(uuid.uuid4()), # Unique ID for this suspension
-                        "messages": messages, # Save state
-                        "tokens_used": tokens_total,
-                        "prompt_tokens": response.usage.prompt_tokens,
-                        "completion_tokens": response.usage.completion_tokens
-                    }
-
-            # 5. No Tool Call -> Return Message
-            print(f"[DEBUG] No tool call, returning direct message")
-            return {
-                "success": True,
-                "type": "message",
-                "response": response_message.content,
-                "tokens_used": tokens_total,
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens
-            }
+                response = await self._complete(
+                    openai_api_key,
+                    model=model,
+                    messages=messages,
+                    tools=tool_definitions if tool_definitions else None,
+                    tool_choice=tool_choice,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                self._add_usage(usage, response.usage)
+                response_message = response.choices[0].message
+                print(f"[DEBUG] OpenAI finish_reason: {response.choices[0].finish_reason}")
+
+                if not response_message.tool_calls:
+                    return self._message_result(response_message.content, usage)
+
+                calls = [
+                    {"id": tc.id, "name": tc.function.name, "arguments": tc.function.arguments}
+                    for tc in response_message.tool_calls
+                ]
+                suspended = await self._handle_tool_calls(calls, response_message.content, messages, context, usage)
+                if suspended:
+                    return suspended
+
+            return {"success": False, "error": f"Agent loop ended after {max_steps} steps without an answer"}
 
         except Exception as e:
             print(f"[ERROR] AgentEngine error: {str(e)}")
             return {"success": False, "error": f"Error in AgentEngine: {str(e)}"}
 
-    async def resume(self, messages: list, tool_call_id: str, tool_name: str, tool_result: dict, openai_api_key: str, model: str = 'gpt-4o-mini', temperature: float = 0.7, max_tokens: int = 1000):
+    async def stream(self, system_prompt: str, user_message: str, tool_names: list, context: dict, openai_api_key: str, model: str = 'gpt-4o-mini', temperature: float = 0.7, max_tokens: int = 1000,
+                     max_steps: int = None, token_budget: int = None):
         """
-        Resume execution after an external tool result is received.
+        Streaming counterpart of execute(), same bounded loop. Async generator of events:
+        - {"type": "delta", "content": str}: answer text as the model produces it
+        - {"type": "tool_call_delta", "index", "id", "name", "arguments"}: a tool call being
+          assembled; "arguments" is the JSON accumulated so far
+        - {"type": "done", "result": dict}: always last, same shape execute() returns
+        """
+        if not openai_api_key:
+            yield {"type": "done", "result": {"success": False, "error": "OpenAI API Key provided is empty"}}
+            return
+
+        max_steps = max(1, max_steps or self.MAX_STEPS)
+        tool_definitions = self._prepare_tools(tool_names)
+        messages = self._build_messages(system_prompt, user_message, context)
+        usage = self._new_usage()
+
+        try:
+            for step in range(max_steps):
+                content_parts = []
+                calls = {}
+                async for chunk in self._stream_completion(
+                    openai_api_key,
+                    model=model,
+                    messages=messages,
+                    tools=tool_definitions if tool_definitions else None,
+                    tool_choice=self._tool_choice(tool_definitions, step, max_steps, usage, token_budget),
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                ):
+                    self._add_usage(usage, chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content_parts.append(delta.content)
+                        yield {"type": "delta", "content": delta.content}
+                    for tc in delta.tool_calls or []:
+                        call = calls.setdefault(tc.index, {"id": None, "name": "", "arguments": ""})
+                        if tc.id:
+                            call["id"] = tc.id
+                        if tc.function and tc.function.name:
+                            call["name"] += tc.function.name
+                        if tc.function and tc.function.arguments:
+                            call["arguments"] += tc.function.arguments
+                        yield {"type": "tool_call_delta", "index": tc.index, **call}
+
+                content = "".join(content_parts)
+                if not calls:
+                    yield {"type": "done", "result": self._message_result(content, usage)}
+                    return
+
+                suspended = await self._handle_tool_calls([calls[i] for i in sorted(calls)], content, messages, context, usage)
+                if suspended:
+                    yield {"type": "done", "result": suspended}
+                    return
+
+            yield {"type": "done", "result": {"success": False, "error": f"Agent loop ended after {max_steps} steps without an answer"}}
+
+        except Exception as e:
+            print(f"[ERROR] AgentEngine stream error: {str(e)}")
+            yield {"type": "done", "result": {"success": False, "error": f"Error in AgentEngine: {str(e)}"}}
+
+    async def resume(self, messages: list, tool_results: list, openai_api_key: str, model: str = 'gpt-4o-mini', temperature: float = 0.7, max_tokens: int = 1000):
+        """
+        Resume execution once every external tool result of a suspension is in.
+        tool_results: [{"tool_call_id", "tool_name", "tool_result"}], one per pending call.
         """
         if not openai_api_key:
              return {"success": False, "error": "OpenAI API Key provided is empty"}
 
-        client = AsyncOpenAI(api_key=openai_api_key)
-        
-        # Add the tool result to messages
-        messages.append({
-            "tool_call_id": tool_call_id,
-            "role": "tool",
-            "name": tool_name,
-            "content": json.dumps(tool_result) # OpenAI expects string for tool content
-        })
+        # Add the tool results to messages
+        for item in tool_results:
+            messages.append({
+                "tool_call_id": item["tool_call_id"],
+                "role": "tool",
+                "name": item["tool_name"],
+                "content": json.dumps(item["tool_result"]) # OpenAI expects string for tool content
+            })
         
         try:
              # Follow up call to LLM
-            final_response = await client.chat.completions.create(
+            final_response = await self._complete(
+                openai_api_key,
                 model=model,
                 messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens
             )
-            return {
-                "success": True,
-                "type": "message",
-                "response": final_response.choices[0].message.content,
-                "tokens_used": final_response.usage.total_tokens,
-                "prompt_tokens": final_response.usage.prompt_tokens,
-                "completion_tokens": final_response.usage.completion_tokens
-            }
+            usage = self._new_usage()
+            self._add_usage(usage, final_response.usage)
+            return self._message_result(final_response.choices[0].message.content, usage)
         except Exception as e:
             return {"success": False, "error": f"OpenAI Error on resume: {str(e)}"}
@@ -0,0 +1,76 @@
+import os
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+
+class ModalDictStore:
+    """Version store on a modal.Dict shared by every container of the app."""
+
+    def __init__(self, modal_dict):
+        self.dict = modal_dict
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.dict.get.aio(key)
+
+    async def put(self, key: str, value: str):
+        await self.dict.put.aio(key, value)
+
+
+class InvalidationBus:
+    """
+    Cross-container invalidation for the in-process caches (agent configs, RAG results).
+
+    publish(scope, client_id) writes a fresh random version under "<scope>:<client_id>"
+    ("<scope>:*" for every tenant) in a shared store. version(scope, client_id) returns the
+    (tenant, global) pair; a cache that sees it change drops what it holds for that tenant.
+    Versions are read through a local cache of CACHE_SYNC_INTERVAL seconds (default 5), so a
+    hot tenant costs one store read per interval and other containers catch up within it.
+    Without a store (tests, local runs) invalidation stays local to the container.
+    """
+
+    def __init__(self, store=None, interval: float = None):
+        self.store = store
+        self.interval = interval if interval is not None else float(os.environ.get("CACHE_SYNC_INTERVAL", 5))
+        self._seen: Dict[str, Tuple[Optional[str], float]] = {} # key -> (version, read_at)
+        self.reads = 0
+        self.errors = 0
+
+    def attach(self, store):
+        self.store = store
+        self._seen.clear()
+
+    async def _read(self, key: str) -> Optional[str]:
+        seen = self._seen.get(key)
+        now = time.monotonic()
+        if seen and now - seen[1] < self.interval:
+            return seen[0]
+        if self.store is None:
+            return seen[0] if seen else None
+        try:
+            self.reads += 1
+            version = await self.store.get(key)
+        except Exception as e:
+            # Keep serving the last known version; caches still expire by TTL
+            self.errors += 1
+            print(f"[CacheSync] Failed to read {key}: {e}")
+            return seen[0] if seen else None
+        self._seen[key] = (version, now)
+        return version
+
+    async def version(self, scope: str, client_id: str) -> Tuple[Optional[str], Optional[str]]:
+        return await self._read(f"{scope}:{client_id}"), await self._read(f"{scope}:*")
+
+    async def publish(self, scope: str, client_id: Optional[str] = None):
+        key = f"{scope}:{client_id or '*'}"
+        version = uuid.uuid4().hex
+        self._seen[key] = (version, time.monotonic())
+        if self.store is not None:
+            await self.store.put(key, version)
+
+    def stats(self) -> Dict[str, int]:
+        return {"shared": self.store is not None, "reads": self.reads, "errors": self.errors}
+
+
+# One bus per container; modal_app.py attaches the shared store
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,83 @@
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Tuple
+from .database import SupabaseClient
+
+
+class SupabaseClientPool:
+    """
+    Long-lived registry of SupabaseClient instances, one per (url, key hash).
+
+    Each SupabaseClient keeps its own HTTP session, so reusing it means reusing
+    keep-alive connections to that tenant's PostgREST instead of paying client
+    construction + a cold TLS handshake on every message.
+
+    Tenants are evicted LRU-first once the pool is full, and any tenant idle for
+    longer than idle_seconds is dropped on the next access. Evicted clients are only
+    forgotten, never closed: in-flight turns, the write buffer, the summary queue or the
+    scheduler may still hold them, and their sessions go away with the last reference.
+    """
+
+    def __init__(self, max_clients: int = None, idle_seconds: float = None):
+        self.max_clients = max_clients or int(os.environ.get("SUPABASE_POOL_MAX_CLIENTS", 64))
+        self.idle_seconds = idle_seconds or float(os.environ.get("SUPABASE_POOL_IDLE_SECONDS", 900))
+        self._clients: "OrderedDict[Tuple[str, str], Tuple[SupabaseClient, float]]" = OrderedDict()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _key(url: str, key: str) -> Tuple[str, str]:
+        # Never keep raw service keys around as dict keys
+        return (url.strip().rstrip("/"), hashlib.sha256(key.strip().encode()).hexdigest())
+
+    def get(self, url: str, key: str) -> SupabaseClient:
+        pool_key = self._key(url, key)
+        now = time.monotonic()
+        self._evict_idle(now)
+
+        entry = self._clients.get(pool_key)
+        if entry:
+            client = entry[0]
+            self._clients[pool_key] = (client, now)
+            self._clients.move_to_end(pool_key)
+            self.reused += 1
+            return client
+
+        client = SupabaseClient(url.strip(), key.strip())
+        self._clients[pool_key] = (client, now)
+        self.created += 1
+
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+            self.evicted += 1
+
+        return client
+
+    def get_admin(self) -> SupabaseClient:
+        """Admin (central) database client, from the container's secrets."""
+        return self.get(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"])
+
+    def _evict_idle(self, now: float):
+        # Entries are kept in LRU order, so idle ones are always at the front
+        while self._clients:
+            pool_key, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            self._clients.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._clients),
+            "max_clients": self.max_clients,
+            "created": self.created,
+            "reused": self.reused,
+            "evicted": self.evicted
+        }
+
+
+# One registry per container
+supabase_pool = SupabaseClientPool()
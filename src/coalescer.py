@@ -0,0 +1,118 @@
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+class TurnCoalescer:
+    """
+    Debounce/merge layer in front of Orchestrator.execute_agent, keyed by lead_key(client_id, phone).
+
+    WhatsApp users send bursts ("oi", "tudo bem?", "queria reservar"). Messages from the same
+    lead are collected until the lead has been quiet for `window` seconds (capped at
+    COALESCE_MAX_WAIT_SECONDS after the first one), then answered by ONE turn on the merged
+    text. The request that brought the last message gets the turn's result; each earlier one
+    returns {"type": "coalesced"} as soon as a newer message supersedes it.
+
+    Turns of the same key never overlap: while one runs, new messages gather into the next
+    batch, which starts once the running turn is done. With a window of 0 nothing waits;
+    only messages that arrive during a running turn are merged.
+    """
+
+    def __init__(self, window: float = None, max_wait: float = None):
+        self.window = window if window is not None else float(os.environ.get("COALESCE_WINDOW_SECONDS", 0))
+        self.max_wait = max_wait if max_wait is not None else float(os.environ.get("COALESCE_MAX_WAIT_SECONDS", 10))
+        self._batches: Dict[Hashable, Dict[str, Any]] = {}
+        self._locks: Dict[Hashable, List] = {} # key -> [asyncio.Lock, holders + waiters]
+        self.turns = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def merge(messages: List[str]) -> str:
+        return "\n".join(m.strip() for m in messages if m and m.strip())
+
+    def _superseded(self, batch: dict) -> dict:
+        return {
+            "success": True,
+            "type": "coalesced",
+            "response": None,
+            "pending_messages": len(batch["messages"])
+        }
+
+    async def submit(self, key: Hashable, message: str, run: Callable[[str], Awaitable[dict]], window: Optional[float] = None) -> dict:
+        """Adds `message` to the key's open batch. `run(merged_message)` executes the turn."""
+        window = self.window if window is None else window
+        now = time.monotonic()
+        batch = self._batches.get(key)
+
+        if batch:
+            previous = batch["future"]
+            batch["messages"].append(message)
+            if not previous.done():
+                previous.set_result(self._superseded(batch))
+            self.coalesced += 1
+            batch["future"] = asyncio.get_running_loop().create_future()
+            batch["run"] = run
+            batch["due"] = min(now + window, batch["deadline"])
+            batch["wake"].set()
+        else:
+            batch = {
+                "messages": [message],
+                "run": run,
+                "future": asyncio.get_running_loop().create_future(),
+                "due": now + window,
+                "deadline": now + self.max_wait,
+                "wake": asyncio.Event()
+            }
+            self._batches[key] = batch
+            batch["task"] = asyncio.create_task(self._flush(key, batch))
+
+        return await batch["future"]
+
+    async def _flush(self, key: Hashable, batch: dict):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # The lead's previous turn finishes first; its messages keep merging meanwhile
+            async with entry[0]:
+                while (delay := batch["due"] - time.monotonic()) > 0:
+                    batch["wake"].clear()
+                    try:
+                        await asyncio.wait_for(batch["wake"].wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+
+                # Closed: messages from now on open the next batch
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+
+                future = batch["future"]
+                merged = self.merge(batch["messages"])
+                if len(batch["messages"]) > 1:
+                    print(f"[Coalesce] {key}: {len(batch['messages'])} messages in one turn")
+                self.turns += 1
+                try:
+                    result = await batch["run"](merged)
+                    if isinstance(result, dict):
+                        result["coalesced_messages"] = len(batch["messages"])
+                    if not future.done():
+                        future.set_result(result)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "open_batches": len(self._batches),
+            "active_leads": len(self._locks),
+            "turns": self.turns,
+            "coalesced": self.coalesced
+        }
+
+
+# One coalescer per container
+turn_coalescer = TurnCoalescer()
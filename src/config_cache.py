@@ -0,0 +1,115 @@
+import os
+import copy
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+from .cache import TTLCache
+from .cache_sync import invalidation_bus
+
+_NOT_FOUND = object()
+
+
+class AgentConfigCache:
+    """
+    Process-wide cache for agent_configs rows, keyed by client_id.
+
+    - Positive entries live for AGENT_CONFIG_CACHE_TTL seconds (default 60).
+    - Unknown tenants are cached for AGENT_CONFIG_NEGATIVE_TTL seconds (default 10)
+      so a misconfigured webhook can't hammer the admin DB.
+    - Concurrent misses for the same client_id share a single fetch (single-flight).
+    - Load errors are never cached.
+    - Callers get a copy; the cached dict is never handed out.
+    - invalidate() bumps a generation, so a load that was already in flight doesn't
+      store the stale row it read. broadcast_invalidate() also reaches the other
+      containers through the invalidation bus (within CACHE_SYNC_INTERVAL seconds).
+    """
+
+    SCOPE = "config"
+
+    def __init__(self, ttl: float = None, negative_ttl: float = None, maxsize: int = 1024, bus=None):
+        self.ttl = ttl if ttl is not None else float(os.environ.get("AGENT_CONFIG_CACHE_TTL", 60))
+        self.negative_ttl = negative_ttl if negative_ttl is not None else float(os.environ.get("AGENT_CONFIG_NEGATIVE_TTL", 10))
+        self._cache = TTLCache(maxsize=maxsize, ttl=self.ttl)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.bus = bus or invalidation_bus
+        self._versions: Dict[str, tuple] = {} # client_id -> last bus version seen
+        self._generations: Dict[str, int] = {}
+        self._global_generation = 0
+        self.negative_hits = 0
+        self.shared_fetches = 0
+
+    def _generation(self, client_id: str) -> tuple:
+        return self._global_generation, self._generations.get(client_id, 0)
+
+    async def _sync(self, client_id: str):
+        """Drops the local entry when another container invalidated this tenant."""
+        version = await self.bus.version(self.SCOPE, client_id)
+        previous = self._versions.get(client_id)
+        if previous is not None and previous != version:
+            self.invalidate(client_id)
+        self._versions[client_id] = version
+
+    async def get(self, client_id: str, loader: Callable[[str], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        await self._sync(client_id)
+        cached = self._cache.get(client_id, None)
+        if cached is _NOT_FOUND:
+            self.negative_hits += 1
+            return None
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        # Single-flight: piggyback on a fetch that is already running
+        inflight = self._inflight.get(client_id)
+        if inflight is not None:
+            self.shared_fetches += 1
+            return copy.deepcopy(await asyncio.shield(inflight))
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[client_id] = future
+        generation = self._generation(client_id)
+        try:
+            config = await loader(client_id)
+            # Invalidated while loading: serve this result once, but don't keep it
+            if self._generation(client_id) == generation:
+                if config:
+                    self._cache.set(client_id, config)
+                else:
+                    self._cache.set(client_id, _NOT_FOUND, ttl=self.negative_ttl)
+            future.set_result(config or None)
+            return copy.deepcopy(config) or None
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so waiters-less failures don't warn "exception never retrieved"
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(client_id, None)
+
+    def invalidate(self, client_id: Optional[str] = None) -> int:
+        """Drops one tenant (or everything when client_id is None) in this container. Returns entries removed."""
+        if client_id is None:
+            self._global_generation += 1
+            removed = len(self._cache)
+            self._cache.clear()
+            return removed
+        self._generations[client_id] = self._generations.get(client_id, 0) + 1
+        return 1 if self._cache.pop(client_id, None) is not None else 0
+
+    async def broadcast_invalidate(self, client_id: Optional[str] = None) -> int:
+        """invalidate() here, and in every other container on its next access to the tenant."""
+        removed = self.invalidate(client_id)
+        await self.bus.publish(self.SCOPE, client_id)
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._cache.stats(),
+            "ttl": self.ttl,
+            "negative_ttl": self.negative_ttl,
+            "negative_hits": self.negative_hits,
+            "shared_fetches": self.shared_fetches,
+            "inflight": len(self._inflight)
+        }
+
+
+# One cache per container; shared by every Orchestrator instance
+agent_config_cache = AgentConfigCache()
@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from typing import Any, Dict, Iterable, Optional
+
+from .cache import TTLCache
+
+
+class ModalDictBackend:
+    """
+    Stores (expires_at, blob) tuples in a modal.Dict (production), through the .aio
+    methods so request handlers never block the event loop on a Dict round trip.
+
+    Every write also puts an empty index entry "exp:<expires_at>:<key>" (concurrently with
+    the entry itself), so sweep() finds what is due by listing keys alone and only fetches
+    the entries it is about to delete.
+    """
+
+    INDEX_PREFIX = "exp:"
+    PREFIXES = ("ctx:", "res:", "claim:", "prompt:", INDEX_PREFIX)
+
+    def __init__(self, modal_dict):
+        self.dict = modal_dict
+
+    async def _index(self, key: str, expires_at: float):
+        await self.dict.put.aio(f"{self.INDEX_PREFIX}{int(expires_at) + 1}:{key}", None)
+
+    async def get(self, key: str) -> Optional[tuple]:
+        value = await self.dict.get.aio(key)
+        return value if isinstance(value, tuple) else None
+
+    async def get_legacy(self, key: str) -> Optional[dict]:
+        """Raw dicts written under unprefixed keys before contexts went through this store."""
+        value = await self.dict.get.aio(key)
+        return value if isinstance(value, dict) else None
+
+    async def put(self, key: str, blob: bytes, expires_at: float):
+        await asyncio.gather(self.dict.put.aio(key, (expires_at, blob)), self._index(key, expires_at))
+
+    async def put_if_absent(self, key: str, blob: bytes, expires_at: float) -> bool:
+        if not await self.dict.put.aio(key, (expires_at, blob), skip_if_exists=True):
+            current = await self.dict.get.aio(key)
+            if current is None or not isinstance(current, tuple) or current[0] >= time.time():
+                return False
+            # Expired claim: free it up and try once more
+            await self.delete(key)
+            if not await self.dict.put.aio(key, (expires_at, blob), skip_if_exists=True):
+                return False
+        await self._index(key, expires_at)
+        return True
+
+    async def delete(self, key: str):
+        try:
+            await self.dict.pop.aio(key)
+        except KeyError:
+            pass
+
+    async def sweep(self, now: float, legacy_ttl: float = 0) -> int:
+        keys = [key async for key in self.dict.keys.aio()]
+        indexed = set()
+        swept = 0
+        for index_key in keys:
+            if not index_key.startswith(self.INDEX_PREFIX):
+                continue
+            expires_at, key = index_key[len(self.INDEX_PREFIX):].split(":", 1)
+            indexed.add(key)
+            if float(expires_at) >= now:
+                continue
+            # A later write (e.g. a prompt whose expiry was extended) has its own index entry
+            entry = await self.dict.get.aio(key)
+            if entry is not None and (not isinstance(entry, tuple) or entry[0] < now):
+                await self.delete(key)
+                swept += 1
+            await self.delete(index_key)
+
+        # Entries written before the index existed get one now, `legacy_ttl` from the first sweep
+        for key in keys:
+            if not key.startswith(self.PREFIXES) and key not in indexed:
+                await self._index(key, now + legacy_ttl)
+        return swept
+
+
+class SQLiteBackend:
+    """Local file (or ':memory:') backend, for tests and running outside Modal. Calls run in the default executor."""
+
+    def __init__(self, path: str = ":memory:"):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS agent_contexts (key TEXT PRIMARY KEY, blob BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def _execute(self, sql: str, params: tuple):
+        with self.lock:
+            cur = self.conn.execute(sql, params)
+            self.conn.commit()
+            return cur
+
+    async def get(self, key: str) -> Optional[tuple]:
+        row = (await self._run(self._execute, "SELECT expires_at, blob FROM agent_contexts WHERE key = ?", (key,))).fetchone()
+        return (row[0], row[1]) if row else None
+
+    async def put(self, key: str, blob: bytes, expires_at: float):
+        await self._run(
+            self._execute,
+            "INSERT INTO agent_contexts (key, blob, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET blob = excluded.blob, expires_at = excluded.expires_at",
+            (key, blob, expires_at)
+        )
+
+    async def put_if_absent(self, key: str, blob: bytes, expires_at: float) -> bool:
+        cur = await self._run(
+            self._execute,
+            "INSERT INTO agent_contexts (key, blob, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET blob = excluded.blob, expires_at = excluded.expires_at "
+            "WHERE agent_contexts.expires_at < ?",
+            (key, blob, expires_at, time.time())
+        )
+        return cur.rowcount > 0
+
+    async def get_legacy(self, key: str) -> Optional[dict]:
+        return None # Nothing predates this backend
+
+    async def delete(self, key: str):
+        await self._run(self._execute, "DELETE FROM agent_contexts WHERE key = ?", (key,))
+
+    async def sweep(self, now: float, legacy_ttl: float = 0) -> int:
+        cur = await self._run(self._execute, "DELETE FROM agent_contexts WHERE expires_at < ?", (now,))
+        return cur.rowcount
+
+
+class ContextStore:
+    """
+    Suspended agent turns (waiting on external tools), stored compactly.
+
+    - Messages are plain JSON; SDK message objects are converted with model_dump.
+    - Large system messages are stored once under prompt:<sha256> and referenced by hash,
+      so contexts of the same tenant/prompt don't duplicate it. Prompts are also kept in
+      process, so a container saving or resuming the same prompt again skips that round trip.
+    - Every blob is zlib-compressed JSON with an expiry (AGENT_CONTEXT_TTL, default 6h);
+      expired entries read as missing and sweep() deletes them.
+    - Contexts suspended before this store existed (raw dicts under the bare context id)
+      are still readable until they expire, AGENT_CONTEXT_TTL after the first sweep sees them.
+    """
+
+    PROMPT_REF_MIN_CHARS = 512
+
+    def __init__(self, backend, ttl: float = None):
+        self.backend = backend
+        self.ttl = ttl or float(os.environ.get("AGENT_CONTEXT_TTL", 6 * 3600))
+        self._prompts = TTLCache(maxsize=256, ttl=self.ttl) # digest -> (content, stored expires_at)
+
+    @staticmethod
+    def _encode(payload: Any) -> bytes:
+        return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8"), 6)
+
+    @staticmethod
+    def _decode(blob: bytes) -> Any:
+        return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+    async def _get(self, key: str) -> Optional[Any]:
+        entry = await self.backend.get(key)
+        if entry is None:
+            return None
+        expires_at, blob = entry
+        if expires_at < time.time():
+            return None
+        return self._decode(blob)
+
+    @staticmethod
+    def _to_dict(message) -> dict:
+        if hasattr(message, "model_dump"):
+            return message.model_dump(exclude_none=True)
+        return dict(message)
+
+    async def _store_prompt(self, digest: str, content: str, expires_at: float):
+        """Writes the prompt once; only extends it when this context outlives it."""
+        known = self._prompts.get(digest)
+        if known is None:
+            current = await self.backend.get(f"prompt:{digest}")
+            known = (content, current[0]) if current else None
+        if known is None or known[1] < expires_at:
+            stored_until = expires_at + self.ttl
+            await self.backend.put(f"prompt:{digest}", self._encode(content), stored_until)
+            known = (content, stored_until)
+        self._prompts.set(digest, known)
+
+    async def _compact_messages(self, messages: list, expires_at: float) -> list:
+        compact = []
+        prompts = {}
+        for message in messages or []:
+            message = self._to_dict(message)
+            content = message.get("content")
+            if message.get("role") == "system" and isinstance(content, str) and len(content) >= self.PROMPT_REF_MIN_CHARS:
+                digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+                prompts[digest] = content
+                message = {**message, "content": None, "$prompt": digest}
+            compact.append(message)
+        await asyncio.gather(*(self._store_prompt(d, c, expires_at) for d, c in prompts.items()))
+        return compact
+
+    async def _load_prompt(self, digest: str) -> Optional[str]:
+        known = self._prompts.get(digest)
+        if known is not None and known[1] >= time.time():
+            return known[0]
+        return await self._get(f"prompt:{digest}")
+
+    async def _expand_messages(self, messages: list) -> Optional[list]:
+        expanded = []
+        for message in messages:
+            digest = message.pop("$prompt", None)
+            if digest:
+                content = await self._load_prompt(digest)
+                if content is None:
+                    return None
+                message["content"] = content
+            expanded.append(message)
+        return expanded
+
+    async def save(self, context_id: str, data: Dict[str, Any]) -> int:
+        """Stores a suspended context; returns the compressed size in bytes."""
+        expires_at = time.time() + self.ttl
+        payload = {**data, "messages": await self._compact_messages(data.get("messages"), expires_at)}
+        blob = self._encode(payload)
+        await self.backend.put(f"ctx:{context_id}", blob, expires_at)
+        return len(blob)
+
+    async def load(self, context_id: str) -> Optional[Dict[str, Any]]:
+        data = await self._get(f"ctx:{context_id}")
+        if data is None:
+            return await self.backend.get_legacy(context_id)
+        messages = await self._expand_messages(data.get("messages") or [])
+        if messages is None:
+            print(f"[ContextStore] Prompt for context {context_id} expired")
+            return None
+        data["messages"] = messages
+        return data
+
+    async def put_result(self, context_id: str, tool_call_id: str, result: Dict[str, Any]):
+        await self.backend.put(f"res:{context_id}:{tool_call_id}", self._encode(result), time.time() + self.ttl)
+
+    async def get_result(self, context_id: str, tool_call_id: str) -> Optional[Dict[str, Any]]:
+        result = await self._get(f"res:{context_id}:{tool_call_id}")
+        if result is None:
+            result = await self.backend.get_legacy(f"{context_id}:{tool_call_id}")
+        return result
+
+    async def get_results(self, context_id: str, tool_call_ids: Iterable[str]) -> list:
+        """get_result for every call, fetched concurrently, in the same order."""
+        return list(await asyncio.gather(*(self.get_result(context_id, call_id) for call_id in tool_call_ids)))
+
+    async def claim(self, context_id: str, lease: float = 300) -> bool:
+        """True for exactly one caller until release()/delete() or the lease runs out."""
+        return await self.backend.put_if_absent(f"claim:{context_id}", b"", time.time() + lease)
+
+    async def release(self, context_id: str):
+        await self.backend.delete(f"claim:{context_id}")
+
+    async def delete(self, context_id: str, tool_call_ids: Iterable[str] = ()):
+        keys = [f"ctx:{context_id}", f"claim:{context_id}", context_id, f"{context_id}:resume"] # + legacy keys
+        for tool_call_id in tool_call_ids:
+            keys += [f"res:{context_id}:{tool_call_id}", f"{context_id}:{tool_call_id}"]
+        await asyncio.gather(*(self.backend.delete(key) for key in keys))
+
+    async def sweep(self) -> int:
+        """Deletes expired contexts, results, claims and prompts."""
+        return await self.backend.sweep(time.time(), self.ttl)
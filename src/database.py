@@ -1,13 +1,37 @@
 import os
 import asyncio
-from typing import List, Dict, Optional, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Any, Tuple
 from supabase import create_client, Client, ClientOptions
-from datetime import datetime
+from datetime import datetime, timezone
+
+# supabase-py's query builders are synchronous. Every .execute() is pushed onto this
+# shared pool so the event loop keeps serving other conversations during the round trip.
+# The pool size is the cap on in-flight DB requests per container.
+DB_MAX_CONCURRENCY = int(os.environ.get("SUPABASE_MAX_CONCURRENCY", 32))
+_db_executor = ThreadPoolExecutor(max_workers=DB_MAX_CONCURRENCY, thread_name_prefix="supabase")
+
+def is_missing_function(e: Exception) -> bool:
+    """The RPC isn't deployed: PostgREST PGRST202, or undefined_function (42883) from Postgres."""
+    code = getattr(e, "code", None)
+    if code is None and e.args and isinstance(e.args[0], dict):
+        code = e.args[0].get("code")
+    return code in ("PGRST202", "42883")
+
 
 class SupabaseClient:
     def __init__(self, url: str, key: str):
         # Allow dynamic initialization
         self.client: Client = create_client(url, key)
+        # Flipped off the first time the get_conversation_snapshot RPC is missing on this DB
+        self._snapshot_rpc_available = True
+        # Same for the upsert_lead RPC
+        self._upsert_rpc_available = True
+
+    async def run(self, query):
+        """Executes a PostgREST query builder without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_db_executor, query.execute)
 
     async def get_client_uuid(self, text_client_id: str) -> Optional[str]:
         """
@@ -23,7 +47,7 @@ class SupabaseClient:
             # Yes, 'clients' and 'agent_configs' are central.
             # 'messages', 'leads', 'token_usage', 'knowledge_base' are per-tenant.
             
-            res = self.client.table("clients").select("id").eq("client_id", text_client_id).single().execute()
+            res = await self.run(self.client.table("clients").select("id").eq("client_id", text_client_id).single())
             if res.data:
                 return res.data['id']
             return None
@@ -40,24 +64,48 @@ class SupabaseClient:
     async def get_or_create_lead(self, client_id: str, phone: str, name: Optional[str] = None) -> Dict[str, Any]:
         """
         Retrieves a lead by phone and client_id, or creates if not exists.
+        One round trip through the upsert_lead RPC (INSERT ... ON CONFLICT (client_id, phone)),
+        so concurrent first messages from a new number can't create duplicates.
         """
         try:
             # Sanitize phone number to prevent duplicates
             clean_phone = self.sanitize_phone(phone)
-            
+
+            if self._upsert_rpc_available:
+                try:
+                    res = await self.run(self.client.rpc("upsert_lead", {
+                        "p_client_id": client_id,
+                        "p_phone": clean_phone,
+                        "p_name": name
+                    }))
+                    if res.data:
+                        return res.data[0] if isinstance(res.data, list) else res.data
+                except Exception as e:
+                    if is_missing_function(e):
+                        # Function not deployed on this tenant DB (see update_leads_upsert.sql)
+                        print(f"[WARN] upsert_lead RPC unavailable, using PostgREST upsert: {e}")
+                        self._upsert_rpc_available = False
+                    else:
+                        # Transient (timeout, 5xx): fall back for this call only
+                        print(f"[WARN] upsert_lead RPC failed, using PostgREST upsert: {e}")
+
             # Check if lead exists
-            res = self.client.table("leads").select("*").eq("client_id", client_id).eq("phone", clean_phone).execute()
+            query = self.client.table("leads").select("*").eq("client_id", client_id).eq("phone", clean_phone)
+            res = await self.run(query)
             if res.data:
                 return res.data[0]
-            
-            # Create new lead
+
+            # Create new lead; a concurrent insert wins the conflict and is read back
             new_lead = {
                 "client_id": client_id,
                 "phone": clean_phone,
                 "name": name,
                 "status": "active"
             }
-            res = self.client.table("leads").insert(new_lead).execute()
+            res = await self.run(self.client.table("leads").upsert(new_lead, on_conflict="client_id,phone", ignore_duplicates=True))
+            if res.data:
+                return res.data[0]
+            res = await self.run(query)
             if res.data:
                 return res.data[0]
             return None
@@ -65,6 +113,70 @@ class SupabaseClient:
             print(f"Error in get_or_create_lead: {e}")
             raise e
 
+    async def get_conversation_snapshot(self, client_id: str, phone: str, name: Optional[str] = None, limit: int = 10) -> Dict[str, Any]:
+        """
+        Lead + conversation_summary + last `limit` messages + message counter in one round trip.
+        Creates the lead if it doesn't exist.
+        Returns: {"lead": dict, "messages": list (oldest first), "message_count": int}
+        """
+        clean_phone = self.sanitize_phone(phone)
+
+        if self._snapshot_rpc_available:
+            try:
+                res = await self.run(self.client.rpc("get_conversation_snapshot", {
+                    "p_client_id": client_id,
+                    "p_phone": clean_phone,
+                    "p_name": name,
+                    "p_limit": limit
+                }))
+                if res.data and res.data.get("lead"):
+                    return {
+                        "lead": res.data["lead"],
+                        "messages": res.data.get("messages") or [],
+                        "message_count": res.data.get("message_count") or 0
+                    }
+            except Exception as e:
+                if is_missing_function(e):
+                    # Function not deployed on this tenant DB (see create_conversation_snapshot.sql)
+                    print(f"[WARN] get_conversation_snapshot RPC unavailable, using combined select: {e}")
+                    self._snapshot_rpc_available = False
+                else:
+                    # Transient (timeout, 5xx): fall back for this call only
+                    print(f"[WARN] get_conversation_snapshot RPC failed, using combined select: {e}")
+
+        try:
+            # Combined select: the lead row with its last `limit` messages embedded
+            res = await self.run(self.client.table("leads")\
+                .select("*, messages(id, role, content, created_at)")\
+                .eq("client_id", client_id)\
+                .eq("phone", clean_phone)\
+                .order("created_at", desc=True, foreign_table="messages")\
+                .limit(limit, foreign_table="messages"))
+
+            if res.data:
+                lead = res.data[0]
+                messages = (lead.pop("messages", None) or [])[::-1]
+            else:
+                lead = await self.get_or_create_lead(client_id, clean_phone, name)
+                messages = []
+
+            if not lead:
+                return {"lead": None, "messages": [], "message_count": 0}
+
+            # Prefer the counter maintained by the messages trigger (update_schema_phase4.py).
+            # Without it, a partial window is an exact count; otherwise one extra count is needed
+            if lead.get('message_count') is not None:
+                message_count = lead['message_count']
+            elif len(messages) < limit:
+                message_count = len(messages)
+            else:
+                message_count = await self.get_message_count(client_id, lead['id'])
+
+            return {"lead": lead, "messages": messages, "message_count": message_count}
+        except Exception as e:
+            print(f"Error in get_conversation_snapshot: {e}")
+            raise e
+
     async def save_message(self, client_id: str, lead_id: str, content: str, role: str, tokens: int = 0) -> Dict[str, Any]:
         """
         Saves a message to the history.
@@ -75,9 +187,12 @@ class SupabaseClient:
                 "lead_id": lead_id,
                 "content": content,
                 "role": role,
-                "tokens_used": tokens
+                "tokens_used": tokens,
+                # Container clock, like the write-behind buffer's assistant rows: mixing it with
+                # the DB's now() would let clock skew reorder a turn
+                "created_at": datetime.now(timezone.utc).isoformat()
             }
-            res = self.client.table("messages").insert(message_data).execute()
+            res = await self.run(self.client.table("messages").insert(message_data))
             if res.data:
                 return res.data[0]
             return None
@@ -85,18 +200,27 @@ class SupabaseClient:
             print(f"Error in save_message: {e}")
             raise e
 
+    async def insert_messages(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Bulk insert of message rows (used by the write-behind buffer). Raises on failure."""
+        res = await self.run(self.client.table("messages").insert(rows))
+        return res.data or []
+
+    async def insert_token_usage(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Bulk insert of token_usage rows (used by the write-behind buffer). Raises on failure."""
+        res = await self.run(self.client.table("token_usage").insert(rows))
+        return res.data or []
+
     async def get_conversation_history(self, client_id: str, lead_id: str, limit: int = 10) -> List[Dict[str, Any]]:
         """
         Retrieves recent conversation history for a lead.
         """
         try:
-            res = self.client.table("messages")\
+            res = await self.run(self.client.table("messages")\
                 .select("*")\
                 .eq("client_id", client_id)\
                 .eq("lead_id", lead_id)\
                 .order("created_at", desc=True)\
-                .limit(limit)\
-                .execute()
+                .limit(limit))
             
             return res.data[::-1] if res.data else []
         except Exception as e:
@@ -113,7 +237,7 @@ class SupabaseClient:
                 "tokens_out": tokens_out,
                 "cost": cost
             }
-            res = self.client.table("token_usage").insert(usage_data).execute()
+            res = await self.run(self.client.table("token_usage").insert(usage_data))
             if res.data:
                 return res.data[0]
             return None
@@ -122,13 +246,15 @@ class SupabaseClient:
             return None
 
     async def get_message_count(self, client_id: str, lead_id: str) -> int:
-        """Returns total number of messages for a lead."""
+        """
+        Returns total number of messages for a lead with a count="exact" scan.
+        Prefer leads.message_count (maintained by trigger) when available.
+        """
         try:
-            res = self.client.table("messages")\
+            res = await self.run(self.client.table("messages")\
                 .select("id", count="exact")\
                 .eq("client_id", client_id)\
-                .eq("lead_id", lead_id)\
-                .execute()
+                .eq("lead_id", lead_id))
             return res.count or 0
         except Exception as e:
             print(f"Error in get_message_count: {e}")
@@ -137,12 +263,11 @@ class SupabaseClient:
     async def get_lead_summary(self, client_id: str, lead_id: str) -> str:
         """Gets the accumulated conversation summary for a lead."""
         try:
-            res = self.client.table("leads")\
+            res = await self.run(self.client.table("leads")\
                 .select("conversation_summary")\
                 .eq("id", lead_id)\
                 .eq("client_id", client_id)\
-                .single()\
-                .execute()
+                .single())
             if res.data:
                 return res.data.get('conversation_summary') or ""
             return ""
@@ -150,27 +275,97 @@ class SupabaseClient:
             print(f"Error in get_lead_summary: {e}")
             return ""
 
-    async def update_lead_summary(self, lead_id: str, summary: str):
-        """Updates the conversation summary for a lead."""
-        try:
-            self.client.table("leads")\
-                .update({"conversation_summary": summary})\
-                .eq("id", lead_id)\
-                .execute()
-        except Exception as e:
-            print(f"Error in update_lead_summary: {e}")
+    async def get_summary_state(self, client_id: str, lead_id: str) -> Dict[str, Any]:
+        """conversation_summary + summary_watermark/summary_watermark_id (created_at and id of the last summarized message)."""
+        res = await self.run(self.client.table("leads")\
+            .select("conversation_summary, summary_watermark, summary_watermark_id")\
+            .eq("id", lead_id)\
+            .eq("client_id", client_id)\
+            .limit(1))
+        return res.data[0] if res.data else {}
 
-    async def get_old_messages(self, client_id: str, lead_id: str, offset: int = 10, limit: int = 20) -> list:
-        """Gets older messages (beyond the recent window) for summarization."""
-        try:
-            res = self.client.table("messages")\
-                .select("role, content, created_at")\
-                .eq("client_id", client_id)\
-                .eq("lead_id", lead_id)\
-                .order("created_at", desc=True)\
-                .range(offset, offset + limit - 1)\
-                .execute()
-            return res.data[::-1] if res.data else []
-        except Exception as e:
-            print(f"Error in get_old_messages: {e}")
-            return []
+    async def get_unsummarized_messages(self, client_id: str, lead_id: str, after: Optional[Tuple[str, str]] = None,
+                                        keep_recent: int = 10, limit: int = 40) -> list:
+        """
+        Oldest-first messages past the watermark `after` = (created_at, id), excluding the
+        `keep_recent` newest ones (those go to the prompt verbatim). Messages are ordered by
+        (created_at, id), so rows sharing a timestamp (one bulk insert) are neither skipped
+        nor summarized twice.
+        """
+        boundary = await self.run(self.client.table("messages")\
+            .select("id, created_at")\
+            .eq("client_id", client_id)\
+            .eq("lead_id", lead_id)\
+            .order("created_at", desc=True)\
+            .order("id", desc=True)\
+            .range(keep_recent - 1, keep_recent - 1))
+        if not boundary.data:
+            return [] # Still inside the recent window
+
+        edge = boundary.data[0]
+        query = self.client.table("messages")\
+            .select("id, role, content, created_at")\
+            .eq("client_id", client_id)\
+            .eq("lead_id", lead_id)\
+            .or_(f'created_at.lt."{edge["created_at"]}",and(created_at.eq."{edge["created_at"]}",id.lt.{edge["id"]})')
+        if after:
+            created_at, message_id = after
+            if message_id:
+                query = query.or_(f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt.{message_id})')
+            else:
+                query = query.gt("created_at", created_at) # Watermark from before summary_watermark_id
+        res = await self.run(query.order("created_at").order("id").limit(limit))
+        return res.data or []
+
+    async def advance_lead_summary(self, lead_id: str, summary: str, watermark: Tuple[str, str],
+                                   previous_watermark: Optional[Tuple[str, Optional[str]]] = None) -> bool:
+        """
+        Stores a new summary and moves the (created_at, id) watermark, only if nobody moved it
+        meanwhile (another container summarizing the same lead). Returns False when the guard fails.
+        """
+        query = self.client.table("leads")\
+            .update({
+                "conversation_summary": summary,
+                "summary_watermark": watermark[0],
+                "summary_watermark_id": watermark[1]
+            })\
+            .eq("id", lead_id)
+        if previous_watermark:
+            query = query.eq("summary_watermark", previous_watermark[0])
+            if previous_watermark[1]:
+                query = query.eq("summary_watermark_id", previous_watermark[1])
+            else:
+                query = query.is_("summary_watermark_id", "null")
+        else:
+            query = query.is_("summary_watermark", "null")
+        res = await self.run(query)
+        return bool(res.data)
+
+    async def schedule_follow_up(self, client_id: str, lead_id: str, rule_minutes: int, scheduled_at: str):
+        """Replaces the lead's pending follow-up job with one for `rule_minutes` (RPC, one transaction)."""
+        await self.run(self.client.rpc("schedule_follow_up", {
+            "p_client_id": client_id,
+            "p_lead_id": lead_id,
+            "p_rule_minutes": rule_minutes,
+            "p_scheduled_at": scheduled_at
+        }))
+
+    async def cancel_follow_ups(self, client_id: str, lead_id: str):
+        """The lead answered: its pending follow-up jobs no longer apply."""
+        await self.run(self.client.table("follow_ups")\
+            .update({"status": "cancelled"})\
+            .eq("client_id", client_id)\
+            .eq("lead_id", lead_id)\
+            .eq("status", "pending"))
+
+    async def claim_follow_ups(self, client_id: str, limit: int = 100, lease_seconds: int = 300) -> list:
+        """
+        Leases up to `limit` due jobs (FOR UPDATE SKIP LOCKED inside the RPC), so concurrent
+        workers never get the same row. Rows come back with the lead's phone and name.
+        """
+        res = await self.run(self.client.rpc("claim_follow_ups", {
+            "p_client_id": client_id,
+            "p_limit": limit,
+            "p_lease_seconds": lease_seconds
+        }))
+        return res.data or []
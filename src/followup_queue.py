@@ -0,0 +1,85 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict
+
+
+def rule_minutes(rule: dict) -> int:
+    """{"value": 2, "unit": "horas"} -> 120"""
+    value = int(rule.get('value', 0))
+    unit = rule.get('unit', 'minutes').lower()
+    if unit in ['horas', 'hours', 'hour']:
+        return value * 60
+    if unit in ['dias', 'days', 'day']:
+        return value * 1440
+    return value
+
+
+def queue_mode(config: dict) -> bool:
+    """agent_configs.followup_mode = 'queue' opts a tenant into event-driven follow-ups."""
+    return bool(config.get('followup_enabled')) and config.get('followup_mode') == 'queue'
+
+
+class FollowUpQueue:
+    """
+    Write side of the follow_ups job queue (followup_mode = 'queue').
+
+    An assistant reply schedules the first rule's job (replacing any pending one); a
+    user message cancels the lead's pending jobs. FollowUpScheduler leases due jobs
+    and chains the next rule after each send. Scheduling runs in the background so
+    the reply never waits on it.
+    """
+
+    def __init__(self):
+        self._tasks = set()
+        self.scheduled = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    async def cancel(self, db, config: dict, client_id: str, lead_id: str):
+        if not queue_mode(config):
+            return
+        try:
+            await db.cancel_follow_ups(client_id, lead_id)
+            self.cancelled += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"[FollowUp] Failed to cancel jobs for lead {lead_id}: {e}")
+
+    def schedule_after_reply(self, db, config: dict, client_id: str, lead_id: str):
+        """Non-blocking: queues the job for the smallest rule, counted from now."""
+        if not queue_mode(config):
+            return
+        rules = sorted(rule_minutes(r) for r in config.get('followup_rules') or [])
+        if not rules:
+            return
+        task = asyncio.create_task(self._schedule(db, client_id, lead_id, rules[0]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _schedule(self, db, client_id: str, lead_id: str, minutes: int):
+        scheduled_at = datetime.now(timezone.utc) + timedelta(minutes=minutes)
+        try:
+            await db.schedule_follow_up(client_id, lead_id, minutes, scheduled_at.isoformat())
+            self.scheduled += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"[FollowUp] Failed to schedule {minutes}min job for lead {lead_id}: {e}")
+
+    async def drain(self, timeout: float = 10.0):
+        if not self._tasks:
+            return
+        done, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        if pending:
+            print(f"[FollowUp] Drain timed out with {len(pending)} jobs still being scheduled")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._tasks),
+            "scheduled": self.scheduled,
+            "cancelled": self.cancelled,
+            "failed": self.failed
+        }
+
+
+# One queue per container
+follow_up_queue = FollowUpQueue()
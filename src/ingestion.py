@@ -0,0 +1,189 @@
+import io
+import asyncio
+import hashlib
+import random
+from typing import Any, Dict, List, Optional
+
+from openai import RateLimitError, APIConnectionError, APITimeoutError
+
+from .database import SupabaseClient
+from .rag_engine import RAGEngine
+from .rag_cache import rag_cache
+from .token_budget import get_encoding
+from .llm_pool import openai_pool
+
+
+def extract_text_from_pdf(file_bytes: bytes) -> str:
+    """Same extraction the prompt generator uses (PyPDF2), returning plain text."""
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
+    text = ""
+    for page in reader.pages:
+        page_text = page.extract_text()
+        if page_text:
+            text += page_text + "\n"
+    return text.strip()
+
+
+def chunk_text(text: str, max_tokens: int = 400, overlap: int = 60, model: str = RAGEngine.EMBEDDING_MODEL) -> List[str]:
+    """
+    Splits text into overlapping windows of at most `max_tokens` tokens.
+    Consecutive chunks share `overlap` tokens so answers spanning a boundary stay retrievable.
+    """
+    if overlap >= max_tokens:
+        raise ValueError("overlap must be smaller than max_tokens")
+
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text or "")
+    chunks = []
+    step = max_tokens - overlap
+    for start in range(0, len(tokens), step):
+        window = tokens[start:start + max_tokens]
+        chunk = encoding.decode(window).strip()
+        if chunk:
+            chunks.append(chunk)
+        if start + max_tokens >= len(tokens):
+            break
+    return chunks
+
+
+def content_hash(client_id: str, source: str, content: str) -> str:
+    """Scoped to the source document: the same text in two documents is two rows, each owned by its source."""
+    return hashlib.sha256(f"{client_id}\n{source}\n{content}".encode("utf-8")).hexdigest()
+
+
+class KnowledgeBaseIngestor:
+    """
+    Turns raw documents into embedded knowledge_base rows.
+
+    - Chunks with tiktoken (token-bounded, overlapping).
+    - Skips chunks whose content_hash is already stored, so re-ingesting an
+      unchanged document makes zero embedding calls.
+    - Embeds new chunks in batches, with bounded concurrency and backoff on rate limits.
+    - Upserts on (client_id, content_hash) and removes chunks that no longer
+      exist in the new version of the same source document. The hash includes the
+      source, so a chunk shared by two documents never makes one delete the other's.
+    """
+
+    def __init__(self, db: SupabaseClient, openai_api_key: str, batch_size: int = 96, max_concurrency: int = 4,
+                 max_tokens: int = 400, overlap: int = 60, max_retries: int = 6):
+        self.db = db
+        self.client = openai_pool.get(openai_api_key)
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.max_retries = max_retries
+
+    async def _existing_hashes(self, client_id: str, hashes: List[str]) -> set:
+        existing = set()
+        # Keep the IN (...) list well under URL length limits
+        for i in range(0, len(hashes), 200):
+            res = await self.db.run(self.db.client.table("knowledge_base")\
+                .select("content_hash")\
+                .eq("client_id", client_id)\
+                .in_("content_hash", hashes[i:i + 200]))
+            existing.update(row['content_hash'] for row in (res.data or []))
+        return existing
+
+    async def _embed_batch(self, texts: List[str]) -> List[list]:
+        async with self.semaphore:
+            for attempt in range(self.max_retries):
+                try:
+                    response = await self.client.embeddings.create(model=RAGEngine.EMBEDDING_MODEL, input=texts)
+                    return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+                except (RateLimitError, APIConnectionError, APITimeoutError) as e:
+                    if attempt == self.max_retries - 1:
+                        raise
+                    retry_after = None
+                    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+                    if headers.get("retry-after"):
+                        try:
+                            retry_after = float(headers["retry-after"])
+                        except ValueError:
+                            pass
+                    delay = retry_after or min(2 ** attempt, 30) + random.uniform(0, 1)
+                    print(f"[Ingest] Embedding batch throttled ({type(e).__name__}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+    async def ingest_document(self, client_id: str, title: str, text: str, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+        chunks = chunk_text(text, self.max_tokens, self.overlap)
+        # Identical chunks inside one document collapse to one row
+        by_hash = {}
+        for index, chunk in enumerate(chunks):
+            by_hash.setdefault(content_hash(client_id, title, chunk), (index, chunk))
+        hashes = list(by_hash.keys())
+
+        existing = await self._existing_hashes(client_id, hashes) if hashes else set()
+        new_hashes = [h for h in hashes if h not in existing]
+        print(f"[Ingest] {title}: {len(chunks)} chunks, {len(new_hashes)} new, {len(existing)} unchanged")
+
+        # Embed all new chunks, batches in parallel (bounded by the semaphore)
+        batches = [new_hashes[i:i + self.batch_size] for i in range(0, len(new_hashes), self.batch_size)]
+        embedded = await asyncio.gather(*[
+            self._embed_batch([by_hash[h][1] for h in batch]) for batch in batches
+        ])
+
+        rows = []
+        for batch, vectors in zip(batches, embedded):
+            for h, vector in zip(batch, vectors):
+                index, chunk = by_hash[h]
+                rows.append({
+                    "client_id": client_id,
+                    "title": title,
+                    "content": chunk,
+                    "content_hash": h,
+                    "embedding": vector,
+                    "metadata": {**(metadata or {}), "source": title, "chunk_index": index}
+                })
+
+        for i in range(0, len(rows), 100):
+            await self.db.run(self.db.client.table("knowledge_base")\
+                .upsert(rows[i:i + 100], on_conflict="client_id,content_hash"))
+
+        # Drop chunks from a previous version of this document
+        res = await self.db.run(self.db.client.table("knowledge_base")\
+            .select("id, content_hash")\
+            .eq("client_id", client_id)\
+            .eq("metadata->>source", title))
+        current = set(hashes)
+        stale_ids = [row['id'] for row in (res.data or []) if row.get('content_hash') not in current]
+        for i in range(0, len(stale_ids), 200):
+            await self.db.run(self.db.client.table("knowledge_base")\
+                .delete()\
+                .in_("id", stale_ids[i:i + 200]))
+        removed = len(stale_ids)
+
+        if rows or removed:
+            # Runs in the ingestion container: the webhook containers learn it through the bus
+            await rag_cache.broadcast_invalidate(client_id)
+
+        return {
+            "chunks": len(chunks),
+            "embedded": len(rows),
+            "unchanged": len(existing),
+            "removed": removed,
+            "embedding_calls": len(batches)
+        }
+
+    async def ingest_pdf(self, client_id: str, file_bytes: bytes, title: str, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+        text = extract_text_from_pdf(file_bytes)
+        return await self.ingest_document(client_id, title, text, metadata)
+
+
+async def build_ingestor(client_id: str, openai_api_key: str = None, **kwargs) -> KnowledgeBaseIngestor:
+    """Resolves the tenant DB and API key from agent_configs (admin DB) and returns an ingestor for it."""
+    from .client_pool import supabase_pool
+    from .orchestrator import Orchestrator
+
+    orchestrator = Orchestrator(supabase_pool.get_admin())
+    config = await orchestrator.load_agent_config(client_id)
+    if not config:
+        raise ValueError(f"Agent config not found for client_id: {client_id}")
+    orchestrator._setup_dynamic_client(config)
+
+    api_key = openai_api_key or config.get('openai_api_key')
+    if not api_key:
+        raise ValueError(f"OpenAI API Key not configured for client_id: {client_id}")
+    return KnowledgeBaseIngestor(orchestrator.db, api_key, **kwargs)
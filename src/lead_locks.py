@@ -0,0 +1,63 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Tuple
+
+
+def lead_key(client_id: str, phone: str) -> Tuple[str, str]:
+    """(client_id, phone digits): the same lead however the number is formatted (see SupabaseClient.sanitize_phone)."""
+    return client_id, "".join(filter(str.isdigit, phone or ""))
+
+
+class LeadLocks:
+    """
+    One turn at a time per lead (client_id, phone digits) inside this container.
+
+    Without it, two messages from the same lead run concurrent turns that read the same
+    history and save interleaved replies. Locks exist only while someone holds or waits
+    on them. A turn that waits longer than LEAD_LOCK_TIMEOUT_SECONDS runs anyway (logged):
+    answering late beats dropping the message.
+    """
+
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout or float(os.environ.get("LEAD_LOCK_TIMEOUT_SECONDS", 60))
+        self._locks: Dict[Tuple[str, str], List] = {} # key -> [asyncio.Lock, holders + waiters]
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+
+    @asynccontextmanager
+    async def hold(self, client_id: str, phone: str):
+        key = lead_key(client_id, phone)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        if entry[1] > 1:
+            self.contended += 1 # Another turn of this lead holds or waits for the lock
+        locked = False
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), timeout=self.timeout)
+                locked = True
+                self.acquired += 1
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                print(f"[LeadLock] {key} still busy after {self.timeout}s, running unlocked")
+            yield
+        finally:
+            if locked:
+                entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_leads": len(self._locks),
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "timeouts": self.timeouts
+        }
+
+
+# One registry per container
+lead_locks = LeadLocks()
@@ -1,38 +1,148 @@
-
 import os
 import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlparse
 import psycopg2
+from psycopg2 import errors
+from psycopg2.extensions import connection as _BaseConnection
+from psycopg2.pool import ThreadedConnectionPool
 from psycopg2.extras import RealDictCursor
 
+# psycopg2 is blocking: queries run on this executor, one worker per pooled connection,
+# so a slow Postgres never stalls the event loop and never waits on the pool itself.
+LEARNINGS_POOL_MAX = int(os.environ.get("LEARNINGS_POOL_MAX", 8))
+_executor = ThreadPoolExecutor(max_workers=LEARNINGS_POOL_MAX, thread_name_prefix="learnings")
+
+_pools = {} # db_url -> ThreadedConnectionPool
+_pools_lock = threading.Lock()
+_prepare_supported = True # Flipped off when a prepared statement goes missing between calls
+
+
+class _Connection(_BaseConnection):
+    """Remembers which STATEMENTS were PREPAREd on this server session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _uses_transaction_pooler(db_url: str) -> bool:
+    """
+    PgBouncer/Supavisor in transaction mode (Supabase :6543) hand each transaction to any
+    backend: a PREPARE succeeds on one and the EXECUTE lands on another. Don't prepare there.
+    """
+    try:
+        parsed = urlparse(db_url)
+        return parsed.port == 6543 or "pgbouncer=true" in (parsed.query or "")
+    except ValueError:
+        return False
+
+STATEMENTS = {
+    "learnings_get": (
+        "(text, text, int)",
+        """
+        SELECT original_input, corrected_output, interaction_type, context
+        FROM agent_learnings
+        WHERE client_id = %s
+        AND (lead_phone = %s OR lead_phone IS NULL)
+        ORDER BY last_seen DESC
+        LIMIT %s
+        """
+    ),
+    "learnings_save": (
+        "(text, text, text, text, text, jsonb)",
+        """
+        INSERT INTO agent_learnings
+        (client_id, lead_phone, interaction_type, original_input, corrected_output, context, frequency, last_seen)
+        VALUES (%s, %s, %s, %s, %s, %s, 1, NOW())
+        ON CONFLICT DO NOTHING
+        """
+    )
+}
+
+
+def _numbered(sql: str) -> str:
+    """%s placeholders -> $1..$n, the form PREPARE expects."""
+    parts = sql.split("%s")
+    return "".join(part + (f"${i + 1}" if i < len(parts) - 1 else "") for i, part in enumerate(parts))
+
+
+def _get_pool(db_url: str) -> ThreadedConnectionPool:
+    pool = _pools.get(db_url)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_url)
+            if pool is None:
+                pool = ThreadedConnectionPool(1, LEARNINGS_POOL_MAX, db_url, cursor_factory=RealDictCursor, connection_factory=_Connection)
+                _pools[db_url] = pool
+    return pool
+
+
 class LearningEngine:
+    """
+    agent_learnings over a direct Postgres connection (POSTGRES_DIRECT_URL).
+
+    Connections come from a container-wide ThreadedConnectionPool (LEARNINGS_POOL_MAX)
+    and stay open between turns; both queries are PREPAREd once per connection, except
+    behind a transaction-mode pooler, where plain queries are used.
+    """
+
     def __init__(self):
         self.db_url = os.environ.get("POSTGRES_DIRECT_URL")
         if not self.db_url:
             # Fallback or error
             print("[WARN] POSTGRES_DIRECT_URL not set for LearningEngine")
 
-    def _get_connection(self):
-        return psycopg2.connect(self.db_url, cursor_factory=RealDictCursor)
+    def _execute(self, name: str, params: tuple, fetch: bool):
+        """Runs on the executor thread: borrow a connection, EXECUTE the prepared statement, give it back."""
+        global _prepare_supported
+        pool = _get_pool(self.db_url)
+        conn = pool.getconn()
+        broken = False
+        try:
+            conn.autocommit = True
+            types, sql = STATEMENTS[name]
+            with conn.cursor() as cur:
+                prepare = _prepare_supported and not _uses_transaction_pooler(self.db_url)
+                if prepare and name not in conn.prepared:
+                    try:
+                        cur.execute(f"PREPARE {name} {types} AS {_numbered(sql)}")
+                        conn.prepared.add(name)
+                    except psycopg2.ProgrammingError as e:
+                        print(f"[WARN] Prepared statements unavailable, using plain queries: {e}")
+                        _prepare_supported = prepare = False
+                if prepare:
+                    try:
+                        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+                    except errors.InvalidSqlStatementName as e:
+                        # Session moved to another backend (transaction-mode pooler)
+                        print(f"[WARN] Prepared statement lost between calls, using plain queries: {e}")
+                        _prepare_supported = False
+                        conn.prepared.clear()
+                        cur.execute(sql, params)
+                else:
+                    cur.execute(sql, params)
+                return cur.fetchall() if fetch else None
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+    async def _run(self, name: str, params: tuple, fetch: bool = False):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, self._execute, name, params, fetch)
 
     async def get_learnings(self, client_id: str, lead_phone: str = None, limit: int = 5):
         """
         Retrieves relevant learnings for the context.
         """
         try:
-            with self._get_connection() as conn:
-                with conn.cursor() as cur:
-                    # Query for client-wide patterns OR specific lead corrections
-                    query = """
-                        SELECT original_input, corrected_output, interaction_type, context
-                        FROM agent_learnings
-                        WHERE client_id = %s
-                        AND (lead_phone = %s OR lead_phone IS NULL)
-                        ORDER BY last_seen DESC
-                        LIMIT %s
-                    """
-                    cur.execute(query, (client_id, lead_phone, limit))
-                    return cur.fetchall()
+            # Query for client-wide patterns OR specific lead corrections
+            return await self._run("learnings_get", (client_id, lead_phone, limit), fetch=True)
         except Exception as e:
             print(f"[ERROR] Failed to get learnings: {e}")
             return []
@@ -42,22 +152,12 @@ class LearningEngine:
         Saves a learning interaction.
         """
         try:
-            with self._get_connection() as conn:
-                with conn.cursor() as cur:
-                    query = """
-                        INSERT INTO agent_learnings 
-                        (client_id, lead_phone, interaction_type, original_input, corrected_output, context, frequency, last_seen)
-                        VALUES (%s, %s, %s, %s, %s, %s, 1, NOW())
-                        ON CONFLICT DO NOTHING
-                    """
-                    # Note: We might want a conflict update to increment frequency, 
-                    # but for now simplicity. Table schema might not have unique constraint on these fields yet.
-                    # Assuming we just insert for log history for now.
-                    cur.execute(query, (
-                        client_id, lead_phone, interaction_type, 
-                        original_input, corrected_output, json.dumps(context or {})
-                    ))
-                    conn.commit()
+            # Note: We might want a conflict update to increment frequency,
+            # but for now simplicity. Table schema might not have unique constraint on these fields yet.
+            # Assuming we just insert for log history for now.
+            await self._run("learnings_save", (
+                client_id, lead_phone, interaction_type,
+                original_input, corrected_output, json.dumps(context or {})
+            ))
         except Exception as e:
             print(f"[ERROR] Failed to save learning: {e}")
-
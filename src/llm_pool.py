@@ -0,0 +1,92 @@
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI
+
+
+class OpenAIClientPool:
+    """
+    Container-level cache of OpenAI clients, keyed by sha256(api_key).
+
+    Every client keeps a keep-alive httpx connection pool, so turns stop paying
+    a fresh TCP+TLS handshake to the API. Tenants bringing their own key are
+    evicted LRU-first once OPENAI_POOL_MAX_CLIENTS is exceeded.
+
+    limit() hands out a semaphore per (key, tenant) to cap in-flight requests
+    (OPENAI_MAX_CONCURRENCY_PER_KEY, or agent_configs.llm_max_concurrency). Tenants sharing
+    a key each keep their own cap. A caller passing a different limit for the same tenant
+    (its config changed) replaces the semaphore; callers without one (summaries) use
+    whatever the tenant already has.
+
+    Evicted clients are dropped, not closed: coroutines may still be using them.
+    """
+
+    def __init__(self, max_clients: int = None, max_concurrency: int = None):
+        self.max_clients = max_clients or int(os.environ.get("OPENAI_POOL_MAX_CLIENTS", 32))
+        self.max_concurrency = max_concurrency or int(os.environ.get("OPENAI_MAX_CONCURRENCY_PER_KEY", 16))
+        self.timeout = float(os.environ.get("OPENAI_TIMEOUT", 60))
+        self._async: "OrderedDict[str, AsyncOpenAI]" = OrderedDict()
+        self._limits: Dict[Tuple[str, str], Tuple[int, asyncio.Semaphore]] = {} # (key, tenant) -> (limit, semaphore)
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _key(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def _limits_config(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_concurrency * 2,
+            max_keepalive_connections=self.max_concurrency,
+            keepalive_expiry=120
+        )
+
+    def get(self, api_key: str) -> AsyncOpenAI:
+        key = self._key(api_key)
+        client = self._async.get(key)
+        if client is not None:
+            self._async.move_to_end(key)
+            self.reused += 1
+            return client
+
+        client = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(limits=self._limits_config(), timeout=self.timeout)
+        )
+        self._async[key] = client
+        self.created += 1
+
+        while len(self._async) > self.max_clients:
+            old_key, _ = self._async.popitem(last=False)
+            for limit_key in [k for k in self._limits if k[0] == old_key]:
+                del self._limits[limit_key]
+            self.evicted += 1
+        return client
+
+    def limit(self, api_key: str, tenant: Optional[str] = None, max_concurrency: Optional[int] = None) -> asyncio.Semaphore:
+        key = (self._key(api_key), tenant)
+        entry = self._limits.get(key)
+        if entry is None or (max_concurrency and entry[0] != max_concurrency):
+            # New tenant or changed tenant config; holders of a replaced semaphore release into it harmlessly
+            limit = max_concurrency or self.max_concurrency
+            entry = (limit, asyncio.Semaphore(limit))
+            self._limits[key] = entry
+        return entry[1]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "async_clients": len(self._async),
+            "max_clients": self.max_clients,
+            "created": self.created,
+            "reused": self.reused,
+            "evicted": self.evicted
+        }
+
+
+# One pool per container
+openai_pool = OpenAIClientPool()
@@ -3,77 +3,59 @@ from .agent_engine import AgentEngine
 from .tools_registry import ToolsRegistry
 from .rag_engine import RAGEngine
 from .learning_engine import LearningEngine
+from .config_cache import agent_config_cache
+from .client_pool import supabase_pool
+from .write_buffer import write_buffer
+from .prompt_builder import stable_system_prompt, temporal_context, format_dynamic_context
+from .token_budget import ContextBudgeter
+from .summarizer import summary_queue, RECENT_WINDOW
+from .followup_queue import follow_up_queue
+from .coalescer import turn_coalescer
+from .lead_locks import lead_locks, lead_key
 import os
 import json
 import requests
 import traceback
 import asyncio
-from openai import AsyncOpenAI
+import time
+from datetime import datetime
 
 class Orchestrator:
+    # Per-source timeouts (seconds) for the context-building phase.
+    # Memory is in-process (snapshot + write buffer); summarization runs in the background.
+    CONTEXT_TIMEOUTS = {"memory": 2.0, "rag": 3.0, "learnings": 2.0}
+
     def __init__(self, db_client: SupabaseClient):
         self.admin_db = db_client # Persist admin DB connection
         self.db = db_client       # Current DB connection (defaults to admin)
 
+    async def _fetch_agent_config(self, client_id: str):
+        # Always load config from ADMIN DB first
+        # agent_configs table now uses the text ID (slug) directly
+        res = await self.admin_db.run(self.admin_db.client.table("agent_configs").select("*").eq("client_id", client_id))
+
+        if res.data:
+            config = res.data[0]
+            # DEBUG LOG
+            s_url = config.get('supabase_url')
+            print(f"[DEBUG] Loaded Config for {client_id}")
+            print(f"[DEBUG] Supabase URL in DB: '{s_url}'")
+            return config
+
+        print(f"Agent config not found for client_id: {client_id}")
+        return None
+
     async def load_agent_config(self, client_id: str):
         try:
-            # Always load config from ADMIN DB first
-            # Always load config from ADMIN DB first
-            # agent_configs table now uses the text ID (slug) directly
-            res = self.admin_db.client.table("agent_configs").select("*").eq("client_id", client_id).execute()
-            
-            if res.data:
-                config = res.data[0]
-                # DEBUG LOG
-                s_url = config.get('supabase_url')
-                print(f"[DEBUG] Loaded Config for {client_id}")
-                print(f"[DEBUG] Supabase URL in DB: '{s_url}'")
-                return config
-            
-            print(f"Agent config not found for client_id: {client_id}")
-            return None
+            # Served from the process-wide cache; only misses hit the admin DB
+            return await agent_config_cache.get(client_id, self._fetch_agent_config)
         except Exception as e:
             print(f"Error loading config: {e}")
             return None
 
     def _get_temporal_context(self) -> str:
-        from datetime import datetime
-        from zoneinfo import ZoneInfo
-        
-        # Use São Paulo timezone (GMT-3) instead of server UTC
-        tz_sp = ZoneInfo("America/Sao_Paulo")
-        current_date = datetime.now(tz_sp)
-        
-        # Determine greeting based on hour
-        hour = current_date.hour
-        if 6 <= hour < 12:
-            saudacao = "Bom dia"
-        elif 12 <= hour < 18:
-            saudacao = "Boa tarde"
-        else:
-            saudacao = "Boa noite"
-
-        dias_semana = {
-            'Monday': 'Segunda-feira', 'Tuesday': 'Terça-feira',
-            'Wednesday': 'Quarta-feira', 'Thursday': 'Quinta-feira',
-            'Friday': 'Sexta-feira', 'Saturday': 'Sábado', 'Sunday': 'Domingo'
-        }
-        dia_semana = dias_semana.get(current_date.strftime('%A'), current_date.strftime('%A'))
-
-        return f"""
-CONTEXTO TEMPORAL (Horário de Brasília):
-- Data atual: {current_date.strftime('%d/%m/%Y')}
-- Dia da semana: {dia_semana}
-- Ano atual: {current_date.year}
-- Hora atual: {current_date.strftime('%H:%M')}
-- Saudação adequada: {saudacao}
-
-IMPORTANTE: 
-- Use SEMPRE a saudação adequada ao horário ({saudacao}).
-- Quando o cliente mencionar apenas dia/mês (ex: "20/02"), assuma o ANO ATUAL ({current_date.year}).
-- Se a data mencionada já passou neste ano, assuma o PRÓXIMO ANO ({current_date.year + 1}).
-- SEMPRE use o formato DD/MM/YYYY nas chamadas de ferramentas.
-"""
+        """Date/time values only; the rules that use them are part of the stable system prompt."""
+        return temporal_context()
 
     def _preprocess_message(self, msg: str) -> str:
         corrections = {
@@ -103,7 +85,7 @@ IMPORTANTE:
         if supabase_url and supabase_key:
             try:
                 print(f"[DEBUG] Switching to isolated Supabase: {supabase_url}")
-                self.db = SupabaseClient(supabase_url, supabase_key)
+                self.db = supabase_pool.get(supabase_url, supabase_key)
             except Exception as e:
                 print(f"[ERROR] Failed to initialize isolated Supabase: {e}")
                 raise Exception(f"Failed to initialize isolated Supabase: {e}")
@@ -111,56 +93,28 @@ IMPORTANTE:
             print(f"[DEBUG] No isolated Supabase configured (URL='{supabase_url}'). Using Admin DB.")
             self.db = self.admin_db
 
-    async def _summarize_old_messages(self, messages: list, existing_summary: str, openai_api_key: str) -> str:
-        """
-        Uses a cheap LLM call to summarize older messages into a compact context.
-        Merges with any existing summary.
-        """
-        if not messages:
-            return existing_summary
-        
-        msgs_text = "\n".join([f"{m['role']}: {m['content']}" for m in messages])
-        
-        prompt = f"""Resuma a conversa abaixo em NO MÁXIMO 3 frases curtas em português.
-Mantenha APENAS informações essenciais: nome do cliente, o que ele quer, decisões tomadas, dados importantes (datas, valores, preferências).
-Não inclua saudações ou conversa trivial.
-
-{f'RESUMO ANTERIOR: {existing_summary}' if existing_summary else ''}
-
-NOVAS MENSAGENS:
-{msgs_text}
-
-RESUMO ATUALIZADO:"""
-
-        try:
-            client = AsyncOpenAI(api_key=openai_api_key)
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                max_tokens=200
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"[ERROR] Summarization failed: {e}")
-            return existing_summary
-
-    async def _build_smart_memory(self, client_id: str, lead: dict, openai_api_key: str) -> dict:
+    async def _build_smart_memory(self, client_id: str, snapshot: dict, openai_api_key: str) -> dict:
         """
         Builds a 3-layer memory context:
         Layer 1: Accumulated summary of old messages (compact)
-        Layer 2: Last 10 raw messages (detailed)
+        Layer 2: Last RECENT_WINDOW raw messages (detailed)
         Layer 3: Learnings + RAG (injected separately)
+        Everything comes from the conversation snapshot read at the start of the turn.
+        The summary is only read here; summary_queue refreshes it in the background.
         Returns: {"summary": str, "recent_messages": list[{role, content}]}
         """
+        lead = snapshot["lead"]
         lead_id = lead['id']
         
-        # Get total message count
-        total_count = await self.db.get_message_count(client_id, lead_id)
-        print(f"[MEMORY] Total messages for lead: {total_count}")
+        # Replies still sitting in the write-behind buffer aren't in the snapshot yet
+        # (they are always newer than anything already persisted)
+        pending = snapshot.get("pending_messages") or []
         
-        # Get last 10 messages (raw, for detailed context)
-        recent = await self.db.get_conversation_history(client_id, lead_id, limit=10)
+        # The snapshot was taken before the current user message was saved
+        total_count = snapshot["message_count"] + len(pending) + 1
+        recent = (snapshot["messages"] + pending)[-RECENT_WINDOW:]
+        summary = lead.get('conversation_summary') or ""
+        print(f"[MEMORY] Total messages for lead: {total_count}")
         
         # Format recent as proper chat messages
         recent_messages = []
@@ -169,38 +123,121 @@ RESUMO ATUALIZADO:"""
             if role in ('user', 'assistant'):
                 recent_messages.append({"role": role, "content": msg['content']})
         
-        summary = ""
+        # Older messages get folded into the summary after the reply (debounced per lead)
+        if total_count > RECENT_WINDOW:
+            summary_queue.schedule(self.db, client_id, lead_id, openai_api_key)
         
-        # If there are more than 10 messages, we need summarization
-        if total_count > 10:
-            # Get existing summary
-            existing_summary = await self.db.get_lead_summary(client_id, lead_id)
-            
-            if not existing_summary:
-                # First time: summarize all old messages (beyond the last 10)
-                old_msgs = await self.db.get_old_messages(client_id, lead_id, offset=10, limit=40)
-                if old_msgs:
-                    print(f"[MEMORY] Summarizing {len(old_msgs)} old messages...")
-                    summary = await self._summarize_old_messages(old_msgs, "", openai_api_key)
-                    await self.db.update_lead_summary(lead_id, summary)
-            else:
-                summary = existing_summary
-                
-                # Check if there are NEW unsummarized messages beyond the window
-                # We re-summarize every 20 new messages to keep summary fresh
-                if total_count % 20 == 0:
-                    old_msgs = await self.db.get_old_messages(client_id, lead_id, offset=10, limit=20)
-                    if old_msgs:
-                        print(f"[MEMORY] Refreshing summary with {len(old_msgs)} messages...")
-                        summary = await self._summarize_old_messages(old_msgs, existing_summary, openai_api_key)
-                        await self.db.update_lead_summary(lead_id, summary)
-        
-        print(f"[MEMORY] Summary: {summary[:100]}..." if summary else "[MEMORY] No summary needed yet")
+        print(f"[MEMORY] Summary: {summary[:100]}..." if summary else "[MEMORY] No summary yet")
         return {
             "summary": summary,
             "recent_messages": recent_messages
         }
 
+    def _build_tools_registry(self, config: dict, openai_api_key: str) -> ToolsRegistry:
+        """One registry (and one configured RAGEngine) per turn, shared by the prompt builder and the tools."""
+        rag = RAGEngine(
+            self.db,
+            openai_api_key=openai_api_key,
+            mode=config.get('rag_mode') or "keyword",
+            match_threshold=0.5 if config.get('rag_match_threshold') is None else config['rag_match_threshold']
+        )
+        return ToolsRegistry(self.db, rag=rag, rag_top_k=config.get('rag_top_k', 3))
+
+    async def _build_rag_context(self, config: dict, client_id: str, message: str, engine: AgentEngine) -> list:
+        """
+        The turn's single retrieval stage, only for tenants with rag_enabled. The result is
+        memoized in the ToolsRegistry so a search_knowledge_base tool call for the same query is free.
+        Returns the formatted chunks, best first (the budgeter drops from the end).
+        """
+        if not config.get('rag_enabled', False):
+            return []
+        print(f"[DEBUG] RAG for {client_id} (mode: {config.get('rag_mode') or 'keyword'})")
+        return await engine.tools_registry.retrieve(message, client_id) or []
+
+    async def _build_learning_context(self, client_id: str, lead_phone: str) -> list:
+        learning = LearningEngine()
+        learnings = await learning.get_learnings(client_id, lead_phone, limit=3)
+        return [
+            f"- O usuário disse '{l['original_input']}' e o correto é '{l.get('corrected_output')}' (Tipo: {l.get('interaction_type')})"
+            for l in learnings or []
+        ]
+
+    async def _run_stage(self, name: str, coro, timeout: float, default, timings: dict, required: bool = False):
+        """
+        Runs one context source with its own timeout.
+        A slow or failing optional source degrades to `default` instead of failing the turn;
+        a required one (conversation memory) raises, so the turn goes to retry/fallback
+        rather than answering without history.
+        """
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(coro, timeout=timeout)
+        except asyncio.TimeoutError:
+            if required:
+                print(f"[CONTEXT] '{name}' timed out after {timeout}s, failing the turn")
+                raise
+            print(f"[CONTEXT] '{name}' timed out after {timeout}s, continuing without it")
+            return default
+        except Exception as e:
+            print(f"[ERROR] Context stage '{name}' failed: {e}")
+            if required:
+                raise
+            return default
+        finally:
+            timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    async def _build_context(self, config: dict, client_id: str, snapshot: dict, lead_phone: str, message: str, openai_api_key: str, engine: AgentEngine) -> dict:
+        """
+        Context-building phase. Memory, RAG and learnings don't depend on each other,
+        so they run concurrently and the phase costs as much as its slowest source.
+        RAG and learnings may degrade to nothing; memory (history) may not.
+        Per-source timeouts can be overridden with agent_configs.context_timeouts.
+        """
+        timeouts = {**self.CONTEXT_TIMEOUTS, **(config.get('context_timeouts') or {})}
+        timings = {}
+        start = time.perf_counter()
+
+        memory, rag_context, learning_context = await asyncio.gather(
+            self._run_stage("memory", self._build_smart_memory(client_id, snapshot, openai_api_key),
+                            timeouts["memory"], None, timings, required=True),
+            self._run_stage("rag", self._build_rag_context(config, client_id, message, engine),
+                            timeouts["rag"], [], timings),
+            self._run_stage("learnings", self._build_learning_context(client_id, lead_phone),
+                            timeouts["learnings"], [], timings)
+        )
+
+        stage_start = time.perf_counter()
+        temporal_context = self._get_temporal_context()
+        timings["temporal"] = round((time.perf_counter() - stage_start) * 1000, 1)
+        timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+        print(f"[TIMING] Context stages (ms): {timings}")
+
+        return {
+            "memory": memory,
+            "rag_context": rag_context,
+            "learning_context": learning_context,
+            "temporal_context": temporal_context,
+            "timings": timings
+        }
+
+    def _queue_bookkeeping(self, client_id: str, lead_id: str, result: dict, model: str):
+        """
+        Hands the assistant message and its token usage to the write-behind buffer,
+        so the reply goes back to n8n without waiting on bookkeeping inserts.
+        """
+        p_tokens = result.get('prompt_tokens', 0)
+        c_tokens = result.get('completion_tokens', 0)
+        cached_tokens = result.get('cached_tokens', 0)
+        
+        if p_tokens == 0 and c_tokens == 0 and result.get('tokens_used', 0) > 0:
+            c_tokens = result.get('tokens_used', 0)
+            
+        # Prompt-cache hits are billed at the cached input rate
+        cost = ((p_tokens - cached_tokens) / 1_000_000 * 0.15) + (cached_tokens / 1_000_000 * 0.075) + (c_tokens / 1_000_000 * 0.60)
+        
+        write_buffer.add_message(self.db, client_id, lead_id, result.get('response'), "assistant", tokens=result.get('tokens_used', 0))
+        write_buffer.add_token_usage(self.db, client_id, lead_id, model, p_tokens, c_tokens, cost, tokens_cached=cached_tokens)
+
     async def _fallback_handler(self, client_id: str, lead_phone: str, error_msg: str, webhook_url: str = None):
         """
         Handles critical failures by:
@@ -238,40 +275,184 @@ RESUMO ATUALIZADO:"""
             "fallback_triggered": True
         }
 
-    async def execute_agent(self, client_id: str, lead_phone: str, message: str, lead_name: str = None, openai_api_key: str = None):
-        print(f"[DEBUG] Executing Agent for Client: {client_id}")
-        
+    async def _prepare_turn(self, client_id: str, lead_phone: str, message: str, lead_name: str = None, openai_api_key: str = None):
+        """
+        Shared setup of execute_agent and stream_agent: config, tenant DB, lead snapshot,
+        user message and engine. Returns (turn, None) or (None, error_result).
+        """
         # 1. Validate Client & Load Config (FROM ADMIN DB)
         config = await self.load_agent_config(client_id)
         if not config:
-            return {"success": False, "error": "Client configuration not found", "error_type": "active_config_not_found"}
+            return None, {"success": False, "error": "Client configuration not found", "error_type": "active_config_not_found"}
 
         if not config.get('active'):
-            return {"success": False, "error": "Agent is inactive", "error_type": "agent_inactive"}
+            return None, {"success": False, "error": "Agent is inactive", "error_type": "agent_inactive"}
         
         # 2. Setup Dynamic Client (Multi-Supabase)
         try:
             self._setup_dynamic_client(config)
         except Exception as e:
-             return {"success": False, "error": str(e), "error_type": "database_connection_error"}
+             return None, {"success": False, "error": str(e), "error_type": "database_connection_error"}
 
         openai_api_key = openai_api_key or config.get('openai_api_key')
         if not openai_api_key:
-             return {"success": False, "error": "OpenAI API Key not configured for this client", "error_type": "config_error"}
+             return None, {"success": False, "error": "OpenAI API Key not configured for this client", "error_type": "config_error"}
 
-        # 3. Get/Create Lead (IN TARGET DB)
+        # 3. Get/Create Lead + summary + recent history in one round trip (IN TARGET DB).
+        # Buffered replies are read first: one flushed while the snapshot runs is then in one or both
+        buffered = write_buffer.pending_messages(self.db)
         try:
-            lead = await self.db.get_or_create_lead(client_id, lead_phone, lead_name)
+            snapshot = await self.db.get_conversation_snapshot(client_id, lead_phone, lead_name, limit=RECENT_WINDOW)
+            lead = snapshot["lead"]
             if not lead:
-                 return {"success": False, "error": "Failed to initialize lead (check DB permissions/schema)", "error_type": "internal_error"}
+                 return None, {"success": False, "error": "Failed to initialize lead (check DB permissions/schema)", "error_type": "internal_error"}
         except Exception as e:
-             return {"success": False, "error": f"DB Error (Lead): {str(e)}", "error_type": "database_error"}
+             return None, {"success": False, "error": f"DB Error (Lead): {str(e)}", "error_type": "database_error"}
+        stored = {m.get('id') for m in snapshot["messages"]}
+        snapshot["pending_messages"] = [
+            row for row in buffered if row["lead_id"] == lead['id'] and row["id"] not in stored
+        ]
+
+        # 4. Save User Message (IN TARGET DB); the lead answered, so its pending follow-up jobs go
+        results = await asyncio.gather(
+            self.db.save_message(client_id, lead['id'], message, "user"),
+            follow_up_queue.cancel(self.db, config, client_id, lead['id']),
+            return_exceptions=True
+        )
+        if isinstance(results[0], Exception):
+             print(f"Error saving message: {results[0]}")
+
+        # Initialize Engine (With TARGET DB). The registry memoizes retrieval for this turn.
+        tools_registry = self._build_tools_registry(config, openai_api_key)
+        engine = AgentEngine(tools_registry, client_id, max_concurrency=config.get('llm_max_concurrency'))
+
+        return {
+            "config": config,
+            "openai_api_key": openai_api_key,
+            "snapshot": snapshot,
+            "lead": lead,
+            "engine": engine
+        }, None
+
+    async def _compose_request(self, turn: dict, client_id: str, lead_phone: str, message: str, turn_start: float) -> tuple:
+        """
+        Builds the context (memory, RAG, learnings), fits it to agent_configs.context_token_budget
+        and returns (engine kwargs, timings, per-section token report).
+        """
+        config = turn["config"]
+        engine = turn["engine"]
+        model = config.get('model', 'gpt-4o-mini')
+        # 5. Context Building (FROM TARGET DB) — memory, RAG and learnings run concurrently
+        built = await self._build_context(config, client_id, turn["snapshot"], lead_phone, message, turn["openai_api_key"], engine)
+        memory = built["memory"]
+
+        # Most to least stable, see prompt_builder: only the tail changes every turn
+        system_prompt = stable_system_prompt(config['system_prompt'])
+        user_message = self._preprocess_message(message)
+        tool_names = config.get('enabled_tools', [])
+
+        fitted = ContextBudgeter(model, config.get('context_token_budget')).fit(
+            system=system_prompt,
+            user_message=user_message,
+            tools=engine._prepare_tools(tool_names),
+            summary=memory["summary"],
+            learnings=built["learning_context"],
+            rag=built["rag_context"],
+            recent_messages=memory["recent_messages"],
+            volatile=built["temporal_context"]
+        )
+        context_tokens = fitted["report"]
+        if context_tokens["over_budget"] or any(context_tokens["dropped"].values()):
+            print(f"[BUDGET] {client_id}: {context_tokens['total']}/{context_tokens['budget']} tokens, dropped {context_tokens['dropped']}")
+
+        timings = built["timings"]
+        timings["time_to_llm"] = round((time.perf_counter() - turn_start) * 1000, 1)
+
+        return {
+            "system_prompt": system_prompt,
+            "user_message": user_message,
+            "tool_names": tool_names,
+            "context": {
+                "client_id": client_id,
+                "lead_phone": lead_phone,
+                "memory_summary": fitted["summary"],
+                "dynamic_context": format_dynamic_context(fitted["learnings"], fitted["rag"]),
+                "recent_messages": fitted["recent_messages"],
+                "volatile_context": built['temporal_context']
+            },
+            "openai_api_key": turn["openai_api_key"],
+            "model": model,
+            "temperature": config.get('temperature', 0.7),
+            "max_tokens": config.get('max_tokens', 1000),
+            "max_steps": config.get('max_tool_steps'),
+            "token_budget": config.get('tool_token_budget')
+        }, timings, context_tokens
+
+    def _finish_turn(self, turn: dict, client_id: str, lead_phone: str, result: dict, timings: dict, context_tokens: dict = None) -> dict:
+        config = turn["config"]
+        lead = turn["lead"]
+        if result.get('type') == 'tool_call':
+            result['lead_id'] = lead['id'] # Lets resume_agent skip the lead lookup
+            # Usage so far travels in the suspended context and is logged when the turn resumes
+            return result # Return immediately for tool processing
+
+        # 8-9. Save Assistant Message + Log Usage (IN TARGET DB, write-behind)
+        self._queue_bookkeeping(client_id, lead['id'], result, config.get('model', 'gpt-4o-mini'))
+        follow_up_queue.schedule_after_reply(self.db, config, client_id, lead['id'])
+        
+        return {
+            "success": True,
+            "type": "message",
+            "response": result.get('response'),
+            "tokens_used": result.get('tokens_used', 0),
+            "client_id": client_id,
+            "lead_phone": lead_phone,
+            "db_mode": "isolated" if config.get('supabase_url') else "admin",
+            "context_timings": timings,
+            "context_tokens": context_tokens,
+            "prompt_cache": {
+                "prompt_tokens": result.get('prompt_tokens', 0),
+                "cached_tokens": result.get('cached_tokens', 0)
+            }
+        }
+
+    async def execute_coalesced(self, client_id: str, lead_phone: str, message: str, lead_name: str = None, openai_api_key: str = None):
+        """
+        execute_agent behind turn_coalescer: a burst of messages from one lead becomes one turn,
+        answered to the request that brought the last message (the others get type "coalesced").
+        Quiet window: agent_configs.coalesce_window_ms, else COALESCE_WINDOW_SECONDS.
+        """
+        config = await self.load_agent_config(client_id) or {}
+        window_ms = config.get('coalesce_window_ms')
+        window = window_ms / 1000 if window_ms is not None else None
+
+        async def run(merged_message: str):
+            return await self.execute_agent(client_id, lead_phone, merged_message, lead_name, openai_api_key)
+
+        result = await turn_coalescer.submit(lead_key(client_id, lead_phone), message, run, window=window)
+        if result.get('type') == 'coalesced':
+            result.update({"client_id": client_id, "lead_phone": lead_phone})
+        return result
+
+    async def execute_agent(self, client_id: str, lead_phone: str, message: str, lead_name: str = None, openai_api_key: str = None):
+        # One turn at a time per lead: concurrent turns would read the same history and interleave replies
+        async with lead_locks.hold(client_id, lead_phone):
+            return await self._execute_turn(client_id, lead_phone, message, lead_name, openai_api_key)
 
-        # 4. Save User Message (IN TARGET DB)
+    async def _execute_turn(self, client_id: str, lead_phone: str, message: str, lead_name: str = None, openai_api_key: str = None):
+        print(f"[DEBUG] Executing Agent for Client: {client_id}")
+        turn_start = time.perf_counter()
+
+        turn, error = await self._prepare_turn(client_id, lead_phone, message, lead_name, openai_api_key)
+        if error:
+            return error
+        config = turn["config"]
+
+        # Context (memory, RAG, learnings) is built once per turn; only the model call is retried
         try:
-            await self.db.save_message(client_id, lead['id'], message, "user")
+            request, timings, context_tokens = await self._compose_request(turn, client_id, lead_phone, message, turn_start)
         except Exception as e:
-             print(f"Error saving message: {e}")
+            return await self._fallback_handler(client_id, lead_phone, f"{type(e).__name__}: {str(e)}", config.get('error_webhook'))
 
         # --- RETRY LOOP STARTS ---
         max_retries = 3
@@ -279,102 +460,11 @@ RESUMO ATUALIZADO:"""
         
         for attempt in range(max_retries):
             try:
-                # 5. Context Building (FROM TARGET DB) — SMART MEMORY
-                memory = await self._build_smart_memory(client_id, lead, openai_api_key)
-                
-                context = {
-                    "client_id": client_id,
-                    "lead_phone": lead_phone,
-                    "memory_summary": memory["summary"],
-                    "recent_messages": memory["recent_messages"]
-                }
-
-                # --- INTELLIGENCE ENHANCEMENTS ---
-                temporal_context = self._get_temporal_context()
-                
-                # 5.1 RAG Injection
-                rag_context = ""
-                if config.get('rag_enabled', False):
-                    try:
-                        print(f"[DEBUG] RAG Enabled for {client_id}")
-                        rag = RAGEngine(self.db)
-                        rag_results = await rag.search(message, client_id, top_k=config.get('rag_top_k', 3))
-                        if rag_results:
-                            rag_context = "\n\nBASE DE CONHECIMENTO (Use estas informações para responder):\n" + "\n---\n".join(rag_results)
-                    except Exception as e:
-                        print(f"[ERROR] RAG Injection failed: {e}")
-
-                # 5.2 Learning Injection
-                learning_context = ""
-                try:
-                    learning = LearningEngine()
-                    learnings = await learning.get_learnings(client_id, lead_phone, limit=3)
-                    if learnings:
-                        l_texts = []
-                        for l in learnings:
-                            l_texts.append(f"- O usuário disse '{l['original_input']}' e o correto é '{l.get('corrected_output')}' (Tipo: {l.get('interaction_type')})")
-                        learning_context = "\n\nAPRENDIZADOS PASSADOS (Evite cometer estes erros novamente):\n" + "\n".join(l_texts)
-                except Exception as e:
-                    print(f"[ERROR] Learning Injection failed: {e}")
-
-                system_prompt = f"{config['system_prompt']}\n{rag_context}\n{learning_context}\n\n{temporal_context}"
-                processed_message = self._preprocess_message(message)
-                # --- END INTELLIGENCE ENHANCEMENTS ---
-        
-                # 6. Initialize Engine (With TARGET DB)
-                tools_registry = ToolsRegistry(self.db)
-                engine = AgentEngine(tools_registry)
-        
                 # 7. Execute Agent
-                result = await engine.execute(
-                    system_prompt=system_prompt,
-                    user_message=processed_message,
-                    tool_names=config.get('enabled_tools', []),
-                    context=context,
-                    openai_api_key=openai_api_key,
-                    model=config.get('model', 'gpt-4o-mini'),
-                    temperature=config.get('temperature', 0.7),
-                    max_tokens=config.get('max_tokens', 1000)
-                )
+                result = await turn["engine"].execute(**request)
         
                 if result['success']:
-                    if result.get('type') == 'message':
-                        response_content = result.get('response')
-                        # 8. Save Assistant Message (IN TARGET DB)
-                        try:
-                            await self.db.save_message(client_id, lead['id'], response_content, "assistant", tokens=result.get('tokens_used', 0))
-                            
-                            # 9. Log Usage (IN TARGET DB)
-                            p_tokens = result.get('prompt_tokens', 0)
-                            c_tokens = result.get('completion_tokens', 0)
-                            
-                            if p_tokens == 0 and c_tokens == 0 and result.get('tokens_used', 0) > 0:
-                                c_tokens = result.get('tokens_used', 0)
-                                
-                            cost = (p_tokens / 1_000_000 * 0.15) + (c_tokens / 1_000_000 * 0.60)
-                            
-                            await self.db.log_token_usage(
-                                client_id=client_id, 
-                                lead_id=lead['id'], 
-                                model=config.get('model', 'gpt-4o-mini'), 
-                                tokens_in=p_tokens, 
-                                tokens_out=c_tokens,
-                                cost=cost
-                            )
-                        except Exception as e:
-                            print(f"Error saving response/usage: {e}")
-                        
-                        return {
-                            "success": True,
-                            "type": "message",
-                            "response": response_content,
-                            "tokens_used": result.get('tokens_used', 0),
-                            "client_id": client_id,
-                            "lead_phone": lead_phone,
-                            "db_mode": "isolated" if config.get('supabase_url') else "admin"
-                        }
-                    elif result.get('type') == 'tool_call':
-                        return result # Return immediately for tool processing
+                    return self._finish_turn(turn, client_id, lead_phone, result, timings, context_tokens)
                 else:
                     # Logic error from engine, not exception
                     raise Exception(f"Engine Error: {result.get('error')}")
@@ -395,8 +485,63 @@ RESUMO ATUALIZADO:"""
             config.get('error_webhook')
         )
 
-    async def resume_agent(self, client_id: str, lead_phone: str, messages: list, tool_call_id: str, tool_name: str, tool_result: dict):
-        print(f"[DEBUG] Resuming Agent for Client: {client_id}")
+    async def stream_agent(self, client_id: str, lead_phone: str, message: str, lead_name: str = None, openai_api_key: str = None):
+        """
+        Streaming counterpart of execute_agent. Relays the engine's "delta" / "tool_call_delta"
+        events and ends with {"type": "done", "result": ...} carrying the execute_agent payload.
+        The final text is persisted (write-behind) only once the stream completes.
+        There is no retry: tokens already sent can't be taken back, so failures go to the fallback.
+        """
+        async with lead_locks.hold(client_id, lead_phone):
+            async for event in self._stream_turn(client_id, lead_phone, message, lead_name, openai_api_key):
+                yield event
+
+    async def _stream_turn(self, client_id: str, lead_phone: str, message: str, lead_name: str = None, openai_api_key: str = None):
+        print(f"[DEBUG] Streaming Agent for Client: {client_id}")
+        turn_start = time.perf_counter()
+
+        turn, error = await self._prepare_turn(client_id, lead_phone, message, lead_name, openai_api_key)
+        if error:
+            yield {"type": "done", "result": error}
+            return
+
+        try:
+            request, timings, context_tokens = await self._compose_request(turn, client_id, lead_phone, message, turn_start)
+            result = None
+            async for event in turn["engine"].stream(**request):
+                if event["type"] == "done":
+                    result = event["result"]
+                    break
+                if event["type"] == "delta" and "time_to_first_token" not in timings:
+                    timings["time_to_first_token"] = round((time.perf_counter() - turn_start) * 1000, 1)
+                yield event
+            if not result or not result.get('success'):
+                raise Exception(f"Engine Error: {(result or {}).get('error')}")
+        except Exception as e:
+            fallback = await self._fallback_handler(
+                client_id,
+                lead_phone,
+                f"{type(e).__name__}: {str(e)}",
+                turn["config"].get('error_webhook')
+            )
+            yield {"type": "done", "result": fallback}
+            return
+
+        timings["total_turn"] = round((time.perf_counter() - turn_start) * 1000, 1)
+        yield {"type": "done", "result": self._finish_turn(turn, client_id, lead_phone, result, timings, context_tokens)}
+
+    async def resume_agent(self, client_id: str, lead_phone: str, messages: list, tool_results: list, lead_id: str = None,
+                           usage: dict = None):
+        """
+        tool_results: [{"tool_call_id", "tool_name", "tool_result"}] for every call of the suspension.
+        usage: token counts of the model steps before the suspension (tokens_used, prompt_tokens, ...).
+        """
+        async with lead_locks.hold(client_id, lead_phone):
+            return await self._resume_turn(client_id, lead_phone, messages, tool_results, lead_id, usage)
+
+    async def _resume_turn(self, client_id: str, lead_phone: str, messages: list, tool_results: list, lead_id: str = None,
+                           usage: dict = None):
+        print(f"[DEBUG] Resuming Agent for Client: {client_id} with {len(tool_results)} tool result(s)")
         # 1. Load Config (FROM ADMIN DB)
         config = await self.load_agent_config(client_id)
         if not config:
@@ -411,15 +556,13 @@ RESUMO ATUALIZADO:"""
         openai_api_key = config.get('openai_api_key')
         
         # 3. Initialize Engine (With TARGET DB)
-        tools_registry = ToolsRegistry(self.db)
-        engine = AgentEngine(tools_registry)
+        tools_registry = self._build_tools_registry(config, openai_api_key)
+        engine = AgentEngine(tools_registry, client_id, max_concurrency=config.get('llm_max_concurrency'))
         
         # 4. Resume execution
         result = await engine.resume(
             messages=messages,
-            tool_call_id=tool_call_id,
-            tool_name=tool_name,
-            tool_result=tool_result,
+            tool_results=tool_results,
             openai_api_key=openai_api_key,
             model=config.get('model', 'gpt-4o-mini'),
             temperature=config.get('temperature', 0.7),
@@ -427,25 +570,17 @@ RESUMO ATUALIZADO:"""
         )
         
         if result['success'] and result.get('type') == 'message':
+            # The turn's usage = steps before the suspension + the resumed call
+            for key, tokens in (usage or {}).items():
+                result[key] = result.get(key, 0) + (tokens or 0)
              # Save and Log (IN TARGET DB)
             try:
-                lead = await self.db.get_or_create_lead(client_id, lead_phone) 
-                if lead:
-                    await self.db.save_message(client_id, lead['id'], result.get('response'), "assistant", tokens=result.get('tokens_used', 0))
-                    
-                    # Calculate Cost
-                    p_tokens = result.get('prompt_tokens', 0)
-                    c_tokens = result.get('completion_tokens', 0)
-                    cost = (p_tokens / 1_000_000 * 0.15) + (c_tokens / 1_000_000 * 0.60)
-
-                    await self.db.log_token_usage(
-                        client_id=client_id, 
-                        lead_id=lead['id'], 
-                        model=config.get('model', 'gpt-4o-mini'), 
-                        tokens_in=p_tokens, 
-                        tokens_out=c_tokens,
-                        cost=cost
-                    )
+                if not lead_id:
+                    lead = await self.db.get_or_create_lead(client_id, lead_phone)
+                    lead_id = lead['id'] if lead else None
+                if lead_id:
+                    self._queue_bookkeeping(client_id, lead_id, result, config.get('model', 'gpt-4o-mini'))
+                    follow_up_queue.schedule_after_reply(self.db, config, client_id, lead_id)
             except Exception as e:
                 print(f"Error saving resumed response: {e}")
             
@@ -0,0 +1,101 @@
+"""
+Prompt assembly, laid out for provider prompt caching.
+
+OpenAI reuses the longest previously seen prefix of a request (tools + messages,
+from 1024 tokens up) at a discount and lower latency. Anything that changes early in
+the prompt invalidates everything after it, so sections go from most to least stable:
+
+1. tenant system prompt + fixed rules   (changes only when the tenant edits its config)
+   tool definitions travel in `tools`, which is part of the same cached prefix
+2. conversation summary                  (changes every few turns)
+3. dynamic context: learnings, then RAG  (changes per turn)
+4. recent messages
+5. volatile tail: current date/time, then the user message
+"""
+
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from typing import List, Optional
+
+TIMEZONE = ZoneInfo("America/Sao_Paulo") # Horário de Brasília (GMT-3), not server UTC
+
+# Rules only; the values they refer to live in the volatile tail (temporal_context)
+TEMPORAL_RULES = """
+REGRAS DE DATA E HORA:
+- Use SEMPRE a "Saudação adequada" informada no CONTEXTO TEMPORAL (no fim das instruções).
+- Quando o cliente mencionar apenas dia/mês (ex: "20/02"), assuma o ANO ATUAL do CONTEXTO TEMPORAL.
+- Se a data mencionada já passou neste ano, assuma o PRÓXIMO ANO.
+- SEMPRE use o formato DD/MM/YYYY nas chamadas de ferramentas.
+"""
+
+DIAS_SEMANA = {
+    'Monday': 'Segunda-feira', 'Tuesday': 'Terça-feira',
+    'Wednesday': 'Quarta-feira', 'Thursday': 'Quinta-feira',
+    'Friday': 'Sexta-feira', 'Saturday': 'Sábado', 'Sunday': 'Domingo'
+}
+
+
+def stable_system_prompt(tenant_prompt: str) -> str:
+    """Section 1: identical for every turn of a tenant until its config changes."""
+    return f"{(tenant_prompt or '').rstrip()}\n{TEMPORAL_RULES}"
+
+
+def temporal_context(now: Optional[datetime] = None) -> str:
+    """Section 5: the per-request date/time values."""
+    current_date = now or datetime.now(TIMEZONE)
+
+    # Determine greeting based on hour
+    hour = current_date.hour
+    if 6 <= hour < 12:
+        saudacao = "Bom dia"
+    elif 12 <= hour < 18:
+        saudacao = "Boa tarde"
+    else:
+        saudacao = "Boa noite"
+
+    dia_semana = DIAS_SEMANA.get(current_date.strftime('%A'), current_date.strftime('%A'))
+
+    return f"""CONTEXTO TEMPORAL (Horário de Brasília):
+- Data atual: {current_date.strftime('%d/%m/%Y')}
+- Dia da semana: {dia_semana}
+- Ano atual: {current_date.year}
+- Hora atual: {current_date.strftime('%H:%M')}
+- Saudação adequada: {saudacao}"""
+
+
+def format_dynamic_context(learnings: List[str], rag_chunks: List[str]) -> str:
+    """Section 3: learnings (per lead) before RAG (per message)."""
+    parts = []
+    if learnings:
+        parts.append("APRENDIZADOS PASSADOS (Evite cometer estes erros novamente):\n" + "\n".join(learnings))
+    if rag_chunks:
+        parts.append("BASE DE CONHECIMENTO (Use estas informações para responder):\n" + "\n---\n".join(rag_chunks))
+    return "\n\n".join(parts)
+
+
+def build_messages(system_prompt: str, user_message: str, summary: str = "", dynamic_context: str = "",
+                   recent_messages: Optional[List[dict]] = None, volatile_context: str = "", history_str: str = "") -> List[dict]:
+    """Chat messages in cache-friendly order (see module docstring)."""
+    messages = [{"role": "system", "content": system_prompt}]
+
+    # Layer 1: compressed old context
+    if summary:
+        messages.append({"role": "system", "content": f"RESUMO DA CONVERSA ANTERIOR:\n{summary}"})
+
+    # Learnings + RAG for this turn
+    if dynamic_context and dynamic_context.strip():
+        messages.append({"role": "system", "content": dynamic_context.strip()})
+
+    # Layer 2: recent messages as real chat messages
+    if recent_messages:
+        for msg in recent_messages:
+            messages.append({"role": msg["role"], "content": msg["content"]})
+    elif history_str:
+        # Fallback for backward compatibility (resume_agent)
+        messages.append({"role": "system", "content": f"Contexto da conversa:\n{history_str}"})
+
+    if volatile_context:
+        messages.append({"role": "system", "content": volatile_context})
+
+    messages.append({"role": "user", "content": user_message})
+    return messages
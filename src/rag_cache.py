@@ -0,0 +1,99 @@
+import os
+import re
+import hashlib
+import unicodedata
+from typing import Any, Dict, Optional
+from .cache import TTLCache
+from .cache_sync import invalidation_bus
+
+
+def normalize_query(text: str) -> str:
+    """'Qual o horário do Café?' and 'qual o horario do cafe' share cache entries."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+class RAGCache:
+    """
+    Two-level retrieval cache shared by every RAGEngine in the container.
+
+    1. embeddings: sha256(model + normalized query) -> query embedding
+       (tenant independent: the same text always embeds to the same vector)
+    2. results: (client_id, normalized query, top_k, mode, match_threshold) -> retrieved chunks
+
+    Both levels are LRU-bounded with a TTL. Results for a tenant are dropped
+    whenever its knowledge_base changes: invalidate_client() here, broadcast_invalidate()
+    in every container (the ingestion job runs in its own container), picked up by
+    sync_client() within CACHE_SYNC_INTERVAL seconds. A retrieval that was running while
+    the tenant was invalidated is not stored (generation check).
+    """
+
+    SCOPE = "rag"
+
+    def __init__(self, max_embeddings: int = None, max_results: int = None, ttl: float = None, bus=None):
+        ttl = ttl or float(os.environ.get("RAG_CACHE_TTL", 600))
+        self.embeddings = TTLCache(maxsize=max_embeddings or int(os.environ.get("RAG_CACHE_MAX_EMBEDDINGS", 2048)), ttl=ttl)
+        self.results = TTLCache(maxsize=max_results or int(os.environ.get("RAG_CACHE_MAX_RESULTS", 2048)), ttl=ttl)
+        self.bus = bus or invalidation_bus
+        self._versions: Dict[str, tuple] = {} # client_id -> last bus version seen
+        self._generations: Dict[str, int] = {}
+        self._global_generation = 0
+
+    @staticmethod
+    def embedding_key(model: str, query: str) -> str:
+        return hashlib.sha256(f"{model}\n{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def results_key(client_id: str, query: str, top_k: int, mode: str, match_threshold: float) -> tuple:
+        return (client_id, normalize_query(query), top_k, mode, match_threshold)
+
+    def get_embedding(self, model: str, query: str) -> Optional[list]:
+        return self.embeddings.get(self.embedding_key(model, query))
+
+    def set_embedding(self, model: str, query: str, embedding: list):
+        self.embeddings.set(self.embedding_key(model, query), embedding)
+
+    def generation(self, client_id: str) -> tuple:
+        return self._global_generation, self._generations.get(client_id, 0)
+
+    def get_results(self, client_id: str, query: str, top_k: int, mode: str, match_threshold: float) -> Optional[list]:
+        return self.results.get(self.results_key(client_id, query, top_k, mode, match_threshold))
+
+    def set_results(self, client_id: str, query: str, top_k: int, mode: str, match_threshold: float, chunks: list,
+                    generation: Optional[tuple] = None):
+        """`generation`: taken before retrieving; if the tenant was invalidated since, nothing is stored."""
+        if generation is not None and generation != self.generation(client_id):
+            return
+        self.results.set(self.results_key(client_id, query, top_k, mode, match_threshold), chunks)
+
+    async def sync_client(self, client_id: str):
+        """Drops the tenant's results when another container invalidated it."""
+        version = await self.bus.version(self.SCOPE, client_id)
+        previous = self._versions.get(client_id)
+        if previous is not None and previous != version:
+            self.invalidate_client(client_id)
+        self._versions[client_id] = version
+
+    def invalidate_client(self, client_id: Optional[str] = None) -> int:
+        """Drops cached retrievals for one tenant (or all) in this container. Embeddings stay valid."""
+        if client_id is None:
+            self._global_generation += 1
+            removed = len(self.results)
+            self.results.clear()
+            return removed
+        self._generations[client_id] = self._generations.get(client_id, 0) + 1
+        return self.results.invalidate_where(lambda key: key[0] == client_id)
+
+    async def broadcast_invalidate(self, client_id: Optional[str] = None) -> int:
+        removed = self.invalidate_client(client_id)
+        await self.bus.publish(self.SCOPE, client_id)
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
+
+
+# One cache per container
+rag_cache = RAGCache()
@@ -1,41 +1,111 @@
 from .database import SupabaseClient
+from .rag_cache import rag_cache
+from .llm_pool import openai_pool
 import os
 
 class RAGEngine:
-    def __init__(self, db_client: SupabaseClient):
+    """
+    Retrieval over knowledge_base.
+
+    Modes (agent_configs.rag_mode):
+    - 'keyword' (default): ILIKE on title/content.
+    - 'vector': embeds the query and calls the search_knowledge_base RPC
+      (update_knowledge_base_vector.sql), filtered by client_id. Falls back to
+      keyword search when there is no API key, no embedded chunks or the RPC fails.
+    """
+    EMBEDDING_MODEL = "text-embedding-3-small" # 1536 dims, matches knowledge_base.embedding
+
+    def __init__(self, db_client: SupabaseClient, openai_api_key: str = None, mode: str = "keyword", match_threshold: float = 0.5):
         self.db = db_client
+        self.openai_api_key = openai_api_key
+        self.mode = (mode or "keyword").lower()
+        self.match_threshold = match_threshold
+
+    async def embed(self, text: str, client_id: str = None) -> list:
+        cached = rag_cache.get_embedding(self.EMBEDDING_MODEL, text)
+        if cached is not None:
+            return cached
+        client = openai_pool.get(self.openai_api_key)
+        async with openai_pool.limit(self.openai_api_key, client_id):
+            response = await client.embeddings.create(model=self.EMBEDDING_MODEL, input=text)
+        embedding = response.data[0].embedding
+        rag_cache.set_embedding(self.EMBEDDING_MODEL, text, embedding)
+        return embedding
+
+    async def search_chunks(self, query: str, client_id: str, top_k: int = 3) -> list:
+        """
+        Returns scored chunks: [{"title", "content", "similarity"}].
+        similarity is None for keyword matches.
+        Served from rag_cache when the same normalized question was asked recently.
+        """
+        await rag_cache.sync_client(client_id)
+        cached = rag_cache.get_results(client_id, query, top_k, self.mode, self.match_threshold)
+        if cached is not None:
+            return cached
+
+        generation = rag_cache.generation(client_id)
+        chunks = []
+        degraded = False
+        if self.mode == "vector" and self.openai_api_key:
+            chunks = await self._vector_search(query, client_id, top_k)
+            if chunks is None:
+                degraded = True # Vector search failed: serve keyword matches, but don't cache them
+                chunks = []
+            elif not chunks:
+                print(f"[RAG] No vector matches for {client_id}, falling back to keyword search")
+        if not chunks:
+            chunks = await self._keyword_search(query, client_id, top_k)
+            if chunks is None:
+                return [] # DB error: don't cache it
+
+        if not degraded:
+            rag_cache.set_results(client_id, query, top_k, self.mode, self.match_threshold, chunks, generation)
+        return chunks
 
     async def search(self, query: str, client_id: str, top_k: int = 3):
         """
         Busca em knowledge_base filtrando por client_id.
-        Usa ILIKE para buscar em title e content (Busca Simples por enquanto).
+        Retorna os chunks já formatados para o prompt.
+        """
+        chunks = await self.search_chunks(query, client_id, top_k)
+        return [f"Título: {c['title']}\nConteúdo: {c['content']}" for c in chunks]
+
+    async def _vector_search(self, query: str, client_id: str, top_k: int) -> list:
+        """Returns None on errors (embedding or RPC), [] when nothing matched."""
+        try:
+            embedding = await self.embed(query, client_id)
+            res = await self.db.run(self.db.client.rpc("search_knowledge_base", {
+                "query_embedding": embedding,
+                "filter_client_id": client_id,
+                "match_threshold": self.match_threshold,
+                "match_count": top_k
+            }))
+            return [
+                {"title": item.get('title'), "content": item['content'], "similarity": item.get('similarity')}
+                for item in (res.data or [])
+            ]
+        except Exception as e:
+            print(f"RAG Vector Search Error: {e}")
+            return None
+
+    async def _keyword_search(self, query: str, client_id: str, top_k: int) -> list:
+        """
+        Usa ILIKE para buscar em title e content (Busca Simples).
+        Returns None on DB errors so the caller doesn't cache the failure.
         """
         try:
-            # Supabase-py 'like' allows simple pattern matching
-            # logic: title ilike %query% OR content ilike %query%
-            # The client library might limit OR queries, let's try a simple approach or rpc if needed.
-            # Using 'or' filter string format: "title.ilike.%query%,content.ilike.%query%"
-            
             # PostgREST syntax for OR is (col.op.val,col.op.val)
-            # filter = f"title.ilike.%{query}%,content.ilike.%{query}%" -- this implies OR? 
-            # Actually standard 'or' usage: .or_("title.ilike.%q%,content.ilike.%q%")
-            
-            # Note: embeddings are better, but for now we follow instructions for simple text search.
-            
             pattern = f"%{query}%"
-            res = self.db.client.table("knowledge_base")\
-                .select("*")\
+            res = await self.db.run(self.db.client.table("knowledge_base")\
+                .select("title, content")\
                 .eq("client_id", client_id)\
                 .or_(f"title.ilike.{pattern},content.ilike.{pattern}")\
-                .limit(top_k)\
-                .execute()
-                
-            if res.data:
-                results = []
-                for item in res.data:
-                    results.append(f"Título: {item['title']}\nConteúdo: {item['content']}")
-                return results
-            return []
+                .limit(top_k))
+
+            return [
+                {"title": item.get('title'), "content": item['content'], "similarity": None}
+                for item in (res.data or [])
+            ]
         except Exception as e:
             print(f"RAG Search Error: {e}")
-            return []
+            return None
@@ -1,42 +1,64 @@
 from modal import App, Cron
 import os
-import requests
-from datetime import datetime
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
 from src.database import SupabaseClient
+from src.client_pool import supabase_pool
+from src.webhook_dispatcher import WebhookDispatcher
+from src.followup_queue import rule_minutes, queue_mode
 
 # Re-use the app definition or create a new one if separating services
 # Here we assume it's part of the main app, but we define the logic in a class or function
 # to be imported by modal_app.py
 
 class FollowUpScheduler:
-    def __init__(self, admin_db: SupabaseClient):
+    BATCH_SIZE = int(os.environ.get("FOLLOWUP_BATCH_SIZE", 200))
+    # Leads silent for longer than the largest rule plus this window are no longer scanned
+    LOOKBACK_MINUTES = int(os.environ.get("FOLLOWUP_LOOKBACK_MINUTES", 1440))
+    # Tenants scanned at the same time; webhook limits live in WebhookDispatcher
+    AGENT_CONCURRENCY = int(os.environ.get("FOLLOWUP_AGENT_CONCURRENCY", 10))
+    # followup_mode = 'queue': a claimed job is invisible to other workers this long,
+    # and is given up after MAX_ATTEMPTS failed sends
+    LEASE_SECONDS = int(os.environ.get("FOLLOWUP_LEASE_SECONDS", 300))
+    MAX_ATTEMPTS = int(os.environ.get("FOLLOWUP_MAX_ATTEMPTS", 5))
+
+    def __init__(self, admin_db: SupabaseClient, dispatcher: WebhookDispatcher = None):
         self.admin_db = admin_db
+        self.dispatcher = dispatcher
 
     def normalize_to_minutes(self, rule: dict) -> int:
-        value = int(rule.get('value', 0))
-        unit = rule.get('unit', 'minutes').lower()
-        if unit in ['horas', 'hours', 'hour']:
-            return value * 60
-        if unit in ['dias', 'days', 'day']:
-            return value * 1440
-        return value
+        return rule_minutes(rule)
 
     async def run_check(self):
         print(f"[FollowUp] Starting check at {datetime.now()}")
         
         # 1. Get all agents with followup enabled
         try:
-            res = self.admin_db.client.table("agent_configs")\
+            res = await self.admin_db.run(self.admin_db.client.table("agent_configs")\
                 .select("*")\
-                .eq("followup_enabled", True)\
-                .execute()
+                .eq("followup_enabled", True))
             agents = res.data
         except Exception as e:
             print(f"[FollowUp] Error fetching agents: {e}")
             return
 
-        for agent in agents:
-            await self._process_agent(agent)
+        owns_dispatcher = self.dispatcher is None
+        if owns_dispatcher:
+            self.dispatcher = WebhookDispatcher()
+        limit = asyncio.Semaphore(self.AGENT_CONCURRENCY)
+
+        async def bounded(agent):
+            async with limit:
+                await self._process_agent(agent)
+
+        try:
+            await asyncio.gather(*(bounded(agent) for agent in agents))
+        finally:
+            print(f"[FollowUp] Check finished: {self.dispatcher.stats()}")
+            if owns_dispatcher:
+                await self.dispatcher.aclose()
+                self.dispatcher = None
 
     async def _process_agent(self, agent: dict):
         client_id = agent.get('client_id')
@@ -53,110 +75,251 @@ class FollowUpScheduler:
         
         try:
             if s_url and s_key:
-                client_db = SupabaseClient(s_url, s_key)
+                client_db = supabase_pool.get(s_url, s_key)
             else:
                 client_db = self.admin_db # Fallback (should typically be isolated)
             
             # Normalize rules
             # rules example: [{"value": 15, "unit": "minutes"}]
-            # We want to check them in order.
-            # But the SQL query handles the logic of "finding candidates"
-            
-            # For efficiency, we fetch LEADS that are 'active'
-            # We can't do complex time math in Supabase easily without a stored proc, 
-            # so we fetch leads with recent-ish activity or all active leads (careful with scale)
-            # Better approach: Fetch active leads, check last message time in code (if < 1000 leads)
-            # OR simple SQL filter if possible.
-            
-            # Fetch active leads
-            leads_res = client_db.client.table("leads").select("*").eq("status", "active").execute()
-            leads = leads_res.data
-            
-            for lead in leads:
-                await self._check_lead(client_id, client_db, lead, rules_json, webhook)
+            # Sort rules by minutes ascending
+            sorted_rules = sorted(
+                [{**r, 'min': self.normalize_to_minutes(r)} for r in rules_json],
+                key=lambda x: x['min']
+            )
+            if not sorted_rules:
+                return
+
+            if queue_mode(agent):
+                triggered = await self._process_queue(client_id, client_db, sorted_rules, webhook)
+            else:
+                triggered = await self._process_scan(client_id, client_db, sorted_rules, webhook)
+
+            if triggered:
+                print(f"[FollowUp] {client_id}: {triggered} follow-ups triggered")
                 
         except Exception as e:
             print(f"[FollowUp] Error processing agent {client_id}: {e}")
 
-    async def _check_lead(self, client_id, db, lead, rules, webhook):
-        # Get last message
+    async def _process_scan(self, client_id: str, db, sorted_rules: list, webhook: str) -> int:
+        """
+        followup_mode = 'scan': only leads whose silence already crosses the first rule come
+        back from the DB, a page at a time; each page is claimed with one bulk update per rule.
+        """
+        triggered = 0
+        cursor = None
+        while True:
+            leads = await self._fetch_candidates(db, sorted_rules, cursor)
+            if not leads:
+                break
+            triggered += await self._process_batch(client_id, db, leads, sorted_rules, webhook)
+            if len(leads) < self.BATCH_SIZE:
+                break
+            cursor = leads[-1]['id']
+        return triggered
+
+    async def _fetch_candidates(self, db, sorted_rules: list, after_id: str = None) -> list:
+        """
+        Set-based candidate query, served by idx_leads_followup_candidates
+        (status, last_message_role, last_message_at): active leads whose last message is
+        from the assistant, silent for at least the smallest rule, not past the largest rule
+        (+ FOLLOWUP_LOOKBACK_MINUTES) and with a rule still pending. Keyset-paginated by id.
+        """
+        now = datetime.now(timezone.utc)
+        min_rule = sorted_rules[0]['min']
+        max_rule = sorted_rules[-1]['min']
+        query = db.client.table("leads")\
+            .select("id, phone, name, last_message_at, last_followup_minutes")\
+            .eq("status", "active")\
+            .eq("last_message_role", "assistant")\
+            .lte("last_message_at", (now - timedelta(minutes=min_rule)).isoformat())\
+            .gte("last_message_at", (now - timedelta(minutes=max_rule + self.LOOKBACK_MINUTES)).isoformat())\
+            .or_(f"last_followup_minutes.is.null,last_followup_minutes.lt.{max_rule}")
+        if after_id:
+            query = query.gt("id", after_id)
+        res = await db.run(query.order("id").limit(self.BATCH_SIZE))
+        return res.data or []
+
+    def _due_rule(self, lead: dict, sorted_rules: list, now: datetime):
+        # Calculate silence duration
+        last_time = datetime.fromisoformat(lead['last_message_at'].replace('Z', '+00:00'))
+        delta_minutes = int((now - last_time).total_seconds() / 60)
+        last_triggered = lead.get('last_followup_minutes', 0) or 0
+
+        # Take the first rule that qualifies (smallest > last_triggered) so that
+        # sequential messages (15min, then 2h, then 24h) aren't skipped
+        for rule in sorted_rules:
+            r_min = rule['min']
+            if delta_minutes >= r_min and last_triggered < r_min:
+                return rule
+        return None
+
+    def idempotency_key(self, client_id: str, lead: dict, rule_min: int) -> str:
+        """Same lead, same silence, same rule -> same key, however many ticks or retries send it."""
+        raw = f"{client_id}:{lead['id']}:{lead['last_message_at']}:{rule_min}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def _claim(self, db, lead_ids: list, rule_min: int, now: datetime) -> list:
+        """
+        Conditional bulk update, run BEFORE sending: only rows still below this rule and still
+        silent (no user reply since the scan) are moved to it. Rows another tick or container
+        already claimed don't come back, so they are not sent twice.
+        """
+        res = await db.run(db.client.table("leads").update({
+            "last_followup_minutes": rule_min
+        }).in_("id", lead_ids)\
+            .eq("last_message_role", "assistant")\
+            .lte("last_message_at", (now - timedelta(minutes=rule_min)).isoformat())\
+            .or_(f"last_followup_minutes.is.null,last_followup_minutes.lt.{rule_min}"))
+        return [row['id'] for row in (res.data or [])]
+
+    async def _release(self, db, lead: dict, rule_min: int):
+        """Gives a claim back after the webhook failed for good, so the next tick retries it."""
         try:
-            # We need the VERY last message to see if it's from assistant and how long ago
-            history = await db.get_conversation_history(client_id, lead['id'], limit=1)
-            if not history:
-                return
-            
-            last_msg = history[0] # get_conversation_history returns reverse order? No, usually ordered by desc in query but reversed in python
-            # Wait, get_conversation_history in database.py does: .order("created_at", desc=True) then [::-1]
-            # So the LAST element in the list is the most recent.
-            if not history: return
-            last_msg = history[-1]
-            
-            # Rule: Last message must be from ASSISTANT (Lead is silent)
-            if last_msg['role'] != 'assistant':
-                return
+            await db.run(db.client.table("leads").update({
+                "last_followup_minutes": lead.get('last_followup_minutes')
+            }).eq("id", lead['id']).eq("last_followup_minutes", rule_min))
+        except Exception as e:
+            print(f"[FollowUp] Failed to release lead {lead['id']}: {e}")
 
-            # Calculate silence duration
-            last_time = datetime.fromisoformat(last_msg['created_at'].replace('Z', '+00:00'))
-            now = datetime.now(last_time.tzinfo)
-            delta_minutes = int((now - last_time).total_seconds() / 60)
-            
-            last_triggered = lead.get('last_followup_minutes', 0) or 0
-            
-            # Check rules
-            # We trigger the LARGEST rule that is satisfied and hasn't been triggered yet
-            # Actually, per requirement: "15min, then 2h, then 24h".
-            # So if delta=20min, trigger 15.
-            # If delta=130min (2h10), and last=15, trigger 120.
-            
-            # Sort rules by minutes ascending
-            sorted_rules = sorted(
-                [{**r, 'min': self.normalize_to_minutes(r)} for r in rules], 
-                key=lambda x: x['min']
-            )
-            
-            target_rule = None
-            
-            for rule in sorted_rules:
-                r_min = rule['min']
-                if delta_minutes >= r_min and last_triggered < r_min:
-                    target_rule = rule
-                    # We continue loop? No, usually we trigger the next immediate one.
-                    # If we jumped from 0 to 24h instantly (unlikely if cron runs every 5 min), 
-                    # we might want to trigger the 24h one? Or the skipped ones?
-                    # "Follow-up logic": usually trigger the relevant stage.
-                    # Let's pick the highest valid rule to update state.
-                    # But if user wants sequential messages (msg1, msg2), jumping might skip msg1.
-                    # Given cron runs every 5 min, we usually hit them in order.
-                    # Let's take the first one that qualifies (smallest > last_triggered) 
-                    # to ensure sequence if they represent steps.
-                    break 
-            
+    def _payload(self, client_id: str, lead: dict, minutes: int, rule: dict, key: str) -> dict:
+        return {
+            "event": "inactivity_trigger",
+            "client_id": client_id,
+            "phone": lead['phone'],
+            "lead_name": lead.get('name'),
+            "minutes_inactive": minutes,
+            "rule_unit": rule.get('unit'),
+            "rule_value": rule.get('value'),
+            "idempotency_key": key
+        }
+
+    async def _send(self, client_id: str, db, lead: dict, rule: dict, webhook: str) -> bool:
+        print(f"[FollowUp] Triggering {rule['min']}min notification for {lead['phone']}")
+        key = self.idempotency_key(client_id, lead, rule['min'])
+        payload = self._payload(client_id, lead, rule['min'], rule, key)
+
+        try:
+            if await self.dispatcher.send(client_id, webhook, payload, key):
+                return True
+        except Exception as e:
+            # e.g. httpx.InvalidURL on a misconfigured webhook: release the claim like any failed send
+            print(f"[FollowUp] Send to {lead['phone']} failed: {type(e).__name__}: {e}")
+        await self._release(db, lead, rule['min'])
+        return False
+
+    async def _process_batch(self, client_id: str, db, leads: list, sorted_rules: list, webhook: str) -> int:
+        now = datetime.now(timezone.utc)
+        due_by_rule = {}
+
+        for lead in leads:
+            target_rule = self._due_rule(lead, sorted_rules, now)
             if target_rule:
-                print(f"[FollowUp] Triggering {target_rule['min']}min notification for {lead['phone']}")
-                
-                # Payload
-                payload = {
-                    "event": "inactivity_trigger",
-                    "client_id": client_id,
-                    "phone": lead['phone'],
-                    "lead_name": lead.get('name'),
-                    "minutes_inactive": target_rule['min'],
-                    "rule_unit": target_rule.get('unit'),
-                    "rule_value": target_rule.get('value')
-                }
-                
-                # Fire Webhook
-                try:
-                    requests.post(webhook, json=payload, timeout=5)
-                    
-                    # Update Lead state
-                    db.client.table("leads").update({
-                        "last_followup_minutes": target_rule['min']
-                    }).eq("id", lead['id']).execute()
-                    
-                except Exception as e:
-                    print(f"[FollowUp] Failed to fire webhook: {e}")
+                due_by_rule.setdefault(target_rule['min'], (target_rule, []))[1].append(lead)
+
+        # Claim first (one conditional UPDATE ... WHERE id IN (...) per rule stage), then send
+        sends = []
+        for minutes, (rule, due) in due_by_rule.items():
+            try:
+                claimed = set(await self._claim(db, [lead['id'] for lead in due], minutes, now))
+            except Exception as e:
+                print(f"[FollowUp] Failed to claim {len(due)} leads for the {minutes}min rule: {e}")
+                continue
+            sends.extend(self._send(client_id, db, lead, rule, webhook) for lead in due if lead['id'] in claimed)
+
+        # Fired concurrently; WebhookDispatcher enforces the per-tenant/global/per-URL limits
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        return sum(1 for ok in results if ok is True)
 
+    async def _process_queue(self, client_id: str, db, sorted_rules: list, webhook: str) -> int:
+        """
+        followup_mode = 'queue': lease due follow_ups rows (claim_follow_ups RPC, served by
+        idx_follow_ups_due), send them, mark them sent and chain the next rule. Several
+        workers can run this at once; SKIP LOCKED + the lease keep them on disjoint rows.
+        """
+        rules_by_min = {r['min']: r for r in sorted_rules}
+        triggered = 0
+        while True:
+            jobs = await db.claim_follow_ups(client_id, self.BATCH_SIZE, self.LEASE_SECONDS)
+            if not jobs:
+                break
+            results = await asyncio.gather(
+                *(self._send_job(client_id, job, rules_by_min, webhook) for job in jobs),
+                return_exceptions=True
+            )
+            sent = [job for job, ok in zip(jobs, results) if ok is True]
+            failed = [job for job, ok in zip(jobs, results) if ok is not True]
+            if sent:
+                await self._complete_jobs(db, client_id, sent, sorted_rules)
+            if failed:
+                await self._fail_jobs(db, failed)
+            triggered += len(sent)
+            # Failed jobs stay leased, so the next claim can't return them again this tick
+            if len(jobs) < self.BATCH_SIZE:
+                break
+        return triggered
+
+    async def _send_job(self, client_id: str, job: dict, rules_by_min: dict, webhook: str) -> bool:
+        minutes = job['rule_minutes']
+        print(f"[FollowUp] Triggering {minutes}min notification for {job['phone']} (job {job['id']})")
+        key = f"follow_up:{job['id']}"
+        payload = self._payload(client_id, job, minutes, rules_by_min.get(minutes, {}), key)
+        try:
+            return await self.dispatcher.send(client_id, webhook, payload, key)
+        except Exception as e:
+            # e.g. httpx.InvalidURL on a misconfigured webhook: a failed attempt like any other
+            print(f"[FollowUp] Job {job['id']} failed: {type(e).__name__}: {e}")
+            return False
+
+    async def _complete_jobs(self, db, client_id: str, jobs: list, sorted_rules: list):
+        now = datetime.now(timezone.utc)
+        try:
+            # Jobs cancelled by a user reply while in flight are no longer pending: no next step for them
+            res = await db.run(db.client.table("follow_ups").update({
+                "status": "sent",
+                "sent_at": now.isoformat(),
+                "locked_until": None
+            }).in_("id", [job['id'] for job in jobs]).eq("status", "pending"))
+        except Exception as e:
+            print(f"[FollowUp] Failed to mark {len(jobs)} jobs as sent: {e}")
+            return
+        marked = {row['id'] for row in (res.data or [])}
+        jobs = [job for job in jobs if job['id'] in marked]
+
+        leads_by_rule = {}
+        next_jobs = []
+        for job in jobs:
+            leads_by_rule.setdefault(job['rule_minutes'], []).append(job['lead_id'])
+            next_min = next((r['min'] for r in sorted_rules if r['min'] > job['rule_minutes']), None)
+            if next_min is None:
+                continue
+            # Rules count from the assistant reply the first job was scheduled after
+            anchor = datetime.fromisoformat(job['scheduled_at'].replace('Z', '+00:00')) - timedelta(minutes=job['rule_minutes'])
+            next_jobs.append({
+                "client_id": client_id,
+                "lead_id": job['lead_id'],
+                "rule_minutes": next_min,
+                "scheduled_at": (anchor + timedelta(minutes=next_min)).isoformat()
+            })
+
+        try:
+            for minutes, lead_ids in leads_by_rule.items():
+                await db.run(db.client.table("leads").update({
+                    "last_followup_minutes": minutes
+                }).in_("id", lead_ids))
+            if next_jobs:
+                await db.run(db.client.table("follow_ups").insert(next_jobs))
+        except Exception as e:
+            print(f"[FollowUp] Failed to chain follow-ups for {len(jobs)} leads: {e}")
+
+    async def _fail_jobs(self, db, jobs: list):
+        """Jobs out of attempts are marked failed; the rest are retried once their lease expires."""
+        exhausted = [job['id'] for job in jobs if job['attempts'] >= self.MAX_ATTEMPTS]
+        if not exhausted:
+            return
+        try:
+            await db.run(db.client.table("follow_ups").update({
+                "status": "failed",
+                "locked_until": None
+            }).in_("id", exhausted))
         except Exception as e:
-            print(f"[FollowUp] Error checking lead {lead.get('id')}: {e}")
+            print(f"[FollowUp] Failed to mark {len(exhausted)} jobs as failed: {e}")
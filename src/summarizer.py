@@ -0,0 +1,151 @@
+import os
+import asyncio
+import time
+from typing import Any, Dict, List
+
+from .llm_pool import openai_pool
+
+# Messages the prompt always carries verbatim; only older ones are summarized
+RECENT_WINDOW = 10
+
+
+async def summarize_messages(messages: List[Dict[str, Any]], existing_summary: str, openai_api_key: str, client_id: str) -> str:
+    """
+    Uses a cheap LLM call to summarize older messages into a compact context.
+    Merges with any existing summary.
+    """
+    if not messages:
+        return existing_summary
+
+    msgs_text = "\n".join([f"{m['role']}: {m['content']}" for m in messages])
+
+    prompt = f"""Resuma a conversa abaixo em NO MÁXIMO 3 frases curtas em português.
+Mantenha APENAS informações essenciais: nome do cliente, o que ele quer, decisões tomadas, dados importantes (datas, valores, preferências).
+Não inclua saudações ou conversa trivial.
+
+{f'RESUMO ANTERIOR: {existing_summary}' if existing_summary else ''}
+
+NOVAS MENSAGENS:
+{msgs_text}
+
+RESUMO ATUALIZADO:"""
+
+    client = openai_pool.get(openai_api_key)
+    async with openai_pool.limit(openai_api_key, client_id):
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3,
+            max_tokens=200
+        )
+    return response.choices[0].message.content.strip()
+
+
+class SummaryQueue:
+    """
+    Background conversation summarization, off the reply path.
+
+    The request path only reads leads.conversation_summary and calls schedule().
+    Per lead, jobs are debounced (SUMMARY_DEBOUNCE_SECONDS after the latest turn), so a
+    burst of messages costs one job. A job folds messages older than the last
+    RECENT_WINDOW into the summary incrementally, starting after leads.summary_watermark /
+    summary_watermark_id ((created_at, id) of the last summarized message),
+    SUMMARY_BATCH_SIZE messages per LLM call.
+    Nothing runs until at least SUMMARY_MIN_NEW messages sit past the watermark.
+    """
+
+    def __init__(self, debounce: float = None, batch_size: int = None, min_new: int = None):
+        self.debounce = debounce if debounce is not None else float(os.environ.get("SUMMARY_DEBOUNCE_SECONDS", 30))
+        self.batch_size = batch_size or int(os.environ.get("SUMMARY_BATCH_SIZE", 40))
+        self.min_new = min_new or int(os.environ.get("SUMMARY_MIN_NEW", 10))
+        # lead_id -> {"task", "due", "args", "rerun", "wake"}
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self.completed = 0
+        self.failed = 0
+        self.summarized_messages = 0
+
+    def schedule(self, db, client_id: str, lead_id: str, openai_api_key: str):
+        """Non-blocking. Pushes the lead's job back by `debounce` seconds (or queues a rerun)."""
+        job = self._jobs.get(lead_id)
+        args = (db, client_id, lead_id, openai_api_key)
+        if job:
+            job["due"] = time.monotonic() + self.debounce
+            job["args"] = args
+            job["rerun"] = True
+            return
+        job = {"due": time.monotonic() + self.debounce, "args": args, "rerun": False, "wake": asyncio.Event()}
+        self._jobs[lead_id] = job
+        job["task"] = asyncio.create_task(self._worker(lead_id, job))
+
+    async def _worker(self, lead_id: str, job: dict):
+        try:
+            while True:
+                # Debounce: sleep until no schedule() has moved the deadline
+                while (delay := job["due"] - time.monotonic()) > 0:
+                    try:
+                        await asyncio.wait_for(job["wake"].wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                job["rerun"] = False
+                try:
+                    await self.run_job(*job["args"])
+                    self.completed += 1
+                except Exception as e:
+                    self.failed += 1
+                    print(f"[Summary] Job for lead {lead_id} failed: {e}")
+                if not job["rerun"]:
+                    break
+        finally:
+            self._jobs.pop(lead_id, None)
+
+    async def run_job(self, db, client_id: str, lead_id: str, openai_api_key: str) -> int:
+        """Summarizes everything past the watermark (minus the recent window). Returns messages folded in."""
+        state = await db.get_summary_state(client_id, lead_id)
+        summary = state.get("conversation_summary") or ""
+        watermark = (state["summary_watermark"], state.get("summary_watermark_id")) if state.get("summary_watermark") else None
+        folded = 0
+
+        while True:
+            messages = await db.get_unsummarized_messages(
+                client_id, lead_id, after=watermark, keep_recent=RECENT_WINDOW, limit=self.batch_size
+            )
+            if not messages or (len(messages) < self.min_new and (summary or folded)):
+                break
+            new_summary = await summarize_messages(messages, summary, openai_api_key, client_id)
+            new_watermark = (messages[-1]["created_at"], messages[-1]["id"])
+            if not await db.advance_lead_summary(lead_id, new_summary, new_watermark, previous_watermark=watermark):
+                print(f"[Summary] Lead {lead_id} was summarized elsewhere, stopping")
+                break
+            summary, watermark = new_summary, new_watermark
+            folded += len(messages)
+            if len(messages) < self.batch_size:
+                break
+
+        if folded:
+            self.summarized_messages += folded
+            print(f"[Summary] Lead {lead_id}: folded {folded} messages, watermark {watermark[0]}")
+        return folded
+
+    async def drain(self, timeout: float = 20.0):
+        """Runs debounced jobs now and waits for them (container shutdown)."""
+        for job in self._jobs.values():
+            job["due"] = 0
+            job["wake"].set()
+        tasks = [job["task"] for job in self._jobs.values() if job.get("task")]
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            print(f"[Summary] Drain timed out with {len(pending)} jobs still running")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "scheduled": len(self._jobs),
+            "completed": self.completed,
+            "failed": self.failed,
+            "summarized_messages": self.summarized_messages
+        }
+
+
+# One queue per container
+summary_queue = SummaryQueue()
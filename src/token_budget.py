@@ -0,0 +1,131 @@
+import json
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import tiktoken
+
+# Per-message framing the chat format adds on top of the content (role, separators)
+MESSAGE_OVERHEAD = 4
+REPLY_PRIMING = 2
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model: str):
+    """tiktoken encoders are expensive to build; keep one per model."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        try:
+            return tiktoken.get_encoding("o200k_base") # gpt-4o family
+        except Exception:
+            return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=1024)
+def _count_cached(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Token count of plain text. Repeated texts (tenant prompts, tool schemas) hit an LRU."""
+    if not text:
+        return 0
+    return _count_cached(text, model)
+
+
+def count_message_tokens(messages: List[dict], model: str = "gpt-4o-mini") -> int:
+    return sum(count_tokens(m.get("content") or "", model) + MESSAGE_OVERHEAD for m in messages) + REPLY_PRIMING
+
+
+class ContextBudgeter:
+    """
+    Fits one turn's context into agent_configs.context_token_budget.
+
+    The tenant prompt, tools, the current date and the user message are never cut.
+    When the total is over budget, lower-priority content goes first:
+    1. history older than the last MIN_RECENT_SOFT messages (oldest first)
+    2. learnings (last first)
+    3. RAG chunks beyond the best one (lowest ranked first)
+    4. history down to the last MIN_RECENT_HARD messages
+    5. the summary, truncated to its tail
+    Without a budget it only measures. fit() returns the kept sections and a report
+    with per-section token counts.
+    """
+
+    MIN_RECENT_SOFT = 4
+    MIN_RECENT_HARD = 2
+    MIN_SUMMARY_TOKENS = 64
+
+    def __init__(self, model: str = "gpt-4o-mini", budget: Optional[int] = None):
+        self.model = model
+        self.budget = budget
+
+    def _count(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def _section_tokens(self, system: str, tools: list, summary: str, learnings: List[str], rag: List[str],
+                        recent: List[dict], volatile: str, user_message: str) -> Dict[str, int]:
+        return {
+            "system": self._count(system) + MESSAGE_OVERHEAD,
+            "tools": self._count(json.dumps(tools, ensure_ascii=False, sort_keys=True)) if tools else 0,
+            "summary": self._count(summary) + MESSAGE_OVERHEAD if summary else 0,
+            "learnings": sum(self._count(l) for l in learnings),
+            "rag": sum(self._count(c) for c in rag),
+            "recent_messages": sum(self._count(m.get("content") or "") + MESSAGE_OVERHEAD for m in recent),
+            "volatile": self._count(volatile) + MESSAGE_OVERHEAD if volatile else 0,
+            "user_message": self._count(user_message) + MESSAGE_OVERHEAD + REPLY_PRIMING
+        }
+
+    def fit(self, system: str, user_message: str, tools: list = None, summary: str = "", learnings: List[str] = None,
+            rag: List[str] = None, recent_messages: List[dict] = None, volatile: str = "") -> Dict[str, Any]:
+        tools = tools or []
+        learnings = list(learnings or [])
+        rag = list(rag or [])
+        recent = list(recent_messages or [])
+        dropped = {"recent_messages": 0, "learnings": 0, "rag": 0}
+        summary_trimmed = False
+
+        def sections():
+            return self._section_tokens(system, tools, summary, learnings, rag, recent, volatile, user_message)
+
+        def over() -> int:
+            return sum(sections().values()) - self.budget
+
+        if self.budget:
+            while over() > 0 and len(recent) > self.MIN_RECENT_SOFT:
+                recent.pop(0)
+                dropped["recent_messages"] += 1
+            while over() > 0 and learnings:
+                learnings.pop()
+                dropped["learnings"] += 1
+            while over() > 0 and len(rag) > 1:
+                rag.pop()
+                dropped["rag"] += 1
+            while over() > 0 and len(recent) > self.MIN_RECENT_HARD:
+                recent.pop(0)
+                dropped["recent_messages"] += 1
+            excess = over()
+            if excess > 0 and summary:
+                encoding = get_encoding(self.model)
+                tokens = encoding.encode(summary)
+                keep = max(self.MIN_SUMMARY_TOKENS, len(tokens) - excess)
+                if keep < len(tokens):
+                    summary = encoding.decode(tokens[-keep:])
+                    summary_trimmed = True
+
+        breakdown = sections()
+        total = sum(breakdown.values())
+        return {
+            "summary": summary,
+            "learnings": learnings,
+            "rag": rag,
+            "recent_messages": recent,
+            "report": {
+                "budget": self.budget,
+                "total": total,
+                "over_budget": bool(self.budget and total > self.budget),
+                "sections": breakdown,
+                "dropped": dropped,
+                "summary_trimmed": summary_trimmed
+            }
+        }
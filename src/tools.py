@@ -1,5 +1,5 @@
 import modal
-from .database import SupabaseClient
+from .client_pool import supabase_pool
 import os
 
 # Define dependencies
@@ -12,9 +12,7 @@ async def get_conversation(client_id: str, phone: str, limit: int = 10):
     Busca histórico de conversa.
     Se o lead não existir, retorna vazio ou erro, mas aqui vamos buscar pelo phone.
     """
-    url = os.environ["SUPABASE_URL"]
-    key = os.environ["SUPABASE_SERVICE_KEY"]
-    db = SupabaseClient(url, key)
+    db = supabase_pool.get_admin()
     
     # Precisamos do lead_id. 
     # Se o lead não existe, não tem conversa.
@@ -36,9 +34,7 @@ async def save_message(client_id: str, phone: str, content: str, role: str, toke
     """
     Salva mensagem no histórico. Cria lead se necessário.
     """
-    url = os.environ["SUPABASE_URL"]
-    key = os.environ["SUPABASE_SERVICE_KEY"]
-    db = SupabaseClient(url, key)
+    db = supabase_pool.get_admin()
     
     lead = await db.get_or_create_lead(client_id, phone)
     if not lead:
@@ -1,11 +1,34 @@
 from typing import List, Dict, Any, Callable
 import json
+import asyncio
 from .database import SupabaseClient
+from .rag_engine import RAGEngine
+from .rag_cache import normalize_query
 
 class ToolsRegistry:
-    def __init__(self, db_client: SupabaseClient):
+    def __init__(self, db_client: SupabaseClient, rag: RAGEngine = None, rag_top_k: int = 3):
         self.db = db_client
         self.dynamic_tool_map = {}
+        self.rag = rag or RAGEngine(db_client)
+        self.rag_top_k = rag_top_k
+        # Per-request memo: the registry lives for one turn, so every retrieval of the
+        # same (client_id, query, top_k) in that turn shares one search
+        self._retrievals: Dict[tuple, asyncio.Task] = {}
+
+    async def retrieve(self, query: str, client_id: str, top_k: int = None) -> List[str]:
+        """Knowledge-base retrieval shared by the prompt builder and the search_knowledge_base tool."""
+        top_k = top_k or self.rag_top_k
+        key = (client_id, normalize_query(query), top_k)
+        task = self._retrievals.get(key)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            # First call, or the shared search failed: run it (again)
+            task = asyncio.ensure_future(self.rag.search(query, client_id, top_k))
+            # Marks a failure as retrieved when no caller is left waiting on it
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._retrievals[key] = task
+        # A caller that times out (the orchestrator's RAG stage) cancels only its own wait;
+        # the search keeps running for the search_knowledge_base tool
+        return await asyncio.shield(task)
 
     async def get_conversation_history(self, lead_phone: str, client_id: str, limit: int = 10) -> str:
         """Busca histórico da conversa"""
@@ -25,14 +48,9 @@ class ToolsRegistry:
             formatted.append(f"{role}: {content}")
         return "\n".join(formatted)
 
-    async def search_knowledge_base(self, query: str, client_id: str, top_k: int = 3) -> str:
-        """Busca na base de conhecimento (Wrapper para RAGEngine será injetado ou lógica aqui)"""
-        # For simplicity, we can import RAG here or implement simple query.
-        # Since we have RAGEngine created, let's use it dynamically or implement simple logic here to avoid circular deps if RAG uses tools.
-        # Actually RAG engine is standalone.
-        from .rag_engine import RAGEngine
-        rag = RAGEngine(self.db)
-        results = await rag.search(query, client_id, top_k)
+    async def search_knowledge_base(self, query: str, client_id: str, top_k: int = None) -> str:
+        """Busca na base de conhecimento (reusa a busca já feita neste turno, se houver)"""
+        results = await self.retrieve(query, client_id, top_k)
         if not results:
             return "Nenhuma informação relevante encontrada na base de conhecimento."
         return "\n\n".join(results)
@@ -0,0 +1,122 @@
+import os
+import time
+import random
+import asyncio
+from typing import Any, Dict, Optional
+
+import httpx
+
+
+class TokenBucket:
+    """`rate` requests per second on average, bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class WebhookDispatcher:
+    """
+    Async fan-out of webhook POSTs (follow-ups to n8n).
+
+    - WEBHOOK_GLOBAL_CONCURRENCY requests in flight overall, WEBHOOK_TENANT_CONCURRENCY per tenant
+    - token bucket per URL: WEBHOOK_RATE_PER_SECOND, bursts of WEBHOOK_BURST
+    - retries on network errors, 429 and 5xx with exponential backoff + full jitter
+      (Retry-After is honored up to WEBHOOK_MAX_RETRY_AFTER seconds, longer asks give up);
+      other 4xx fail fast
+    - every request carries an Idempotency-Key header, identical across its retries
+    """
+
+    def __init__(self, global_concurrency: int = None, tenant_concurrency: int = None, rate_per_second: float = None,
+                 burst: int = None, max_retries: int = None, timeout: float = None):
+        self.global_limit = asyncio.Semaphore(global_concurrency or int(os.environ.get("WEBHOOK_GLOBAL_CONCURRENCY", 50)))
+        self.tenant_concurrency = tenant_concurrency or int(os.environ.get("WEBHOOK_TENANT_CONCURRENCY", 5))
+        self.rate = rate_per_second or float(os.environ.get("WEBHOOK_RATE_PER_SECOND", 10))
+        self.burst = burst or int(os.environ.get("WEBHOOK_BURST", 20))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("WEBHOOK_MAX_RETRIES", 3))
+        self.max_retry_after = float(os.environ.get("WEBHOOK_MAX_RETRY_AFTER", 30))
+        self.client = httpx.AsyncClient(timeout=timeout or float(os.environ.get("WEBHOOK_TIMEOUT", 5)))
+        self._tenant_limits: Dict[str, asyncio.Semaphore] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def _tenant_limit(self, tenant: str) -> asyncio.Semaphore:
+        if tenant not in self._tenant_limits:
+            self._tenant_limits[tenant] = asyncio.Semaphore(self.tenant_concurrency)
+        return self._tenant_limits[tenant]
+
+    def _bucket(self, url: str) -> TokenBucket:
+        if url not in self._buckets:
+            self._buckets[url] = TokenBucket(self.rate, self.burst)
+        return self._buckets[url]
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> Optional[float]:
+        """Seconds to wait before the next attempt; None when Retry-After asks for more than we hold a slot for."""
+        if response is not None and response.headers.get("retry-after"):
+            try:
+                retry_after = float(response.headers["retry-after"])
+            except ValueError:
+                retry_after = None
+            if retry_after is not None:
+                return retry_after if retry_after <= self.max_retry_after else None
+        return random.uniform(0, min(30, 0.5 * 2 ** attempt))
+
+    async def send(self, tenant: str, url: str, payload: Dict[str, Any], idempotency_key: str) -> bool:
+        """True once the endpoint answered 2xx."""
+        headers = {"Idempotency-Key": idempotency_key}
+        async with self._tenant_limit(tenant):
+            for attempt in range(self.max_retries + 1):
+                await self._bucket(url).acquire()
+                response = None
+                try:
+                    async with self.global_limit:
+                        response = await self.client.post(url, json=payload, headers=headers)
+                    if response.is_success:
+                        self.sent += 1
+                        return True
+                    if response.status_code != 429 and response.status_code < 500:
+                        print(f"[Webhook] {url} rejected {idempotency_key}: HTTP {response.status_code}")
+                        break
+                    error = f"HTTP {response.status_code}"
+                except httpx.HTTPError as e:
+                    error = f"{type(e).__name__}: {e}"
+
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    delay = self._backoff(attempt, response)
+                    if delay is None:
+                        print(f"[Webhook] {url} asked to retry {idempotency_key} after {response.headers['retry-after']}s, giving up")
+                        break
+                    print(f"[Webhook] {url} failed ({error}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+        self.failed += 1
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        return {"sent": self.sent, "failed": self.failed, "retries": self.retries}
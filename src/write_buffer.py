@@ -0,0 +1,247 @@
+import os
+import time
+import uuid
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+
+def is_data_error(e: Exception) -> bool:
+    """
+    True for errors caused by the rows themselves (constraint violation, bad value, unknown
+    column): retrying the same rows can't succeed. Network errors, timeouts and 5xx are not.
+    """
+    code = getattr(e, "code", None)
+    if code is None and e.args and isinstance(e.args[0], dict):
+        code = e.args[0].get("code")
+    if not isinstance(code, str):
+        return False
+    # SQLSTATE 22 (data exception), 23 (integrity), 42 (syntax/undefined), PostgREST schema errors
+    return code[:2] in ("22", "23", "42") or code.startswith("PGRST2")
+
+
+class WriteBehindBuffer:
+    """
+    Write-behind buffer for post-reply bookkeeping (assistant messages + token_usage).
+
+    Rows are queued per tenant database and flushed as bulk inserts when a queue
+    reaches WRITE_BUFFER_MAX_BATCH rows or every WRITE_BUFFER_FLUSH_INTERVAL seconds,
+    whichever comes first. Tenants flush concurrently and independently: a queue whose
+    flush failed waits for its own next_attempt_at (exponential backoff) while the others
+    keep flushing, and is given up after WRITE_BUFFER_MAX_RETRIES attempts.
+    A bulk insert rejected because of its rows is retried row by row, so only the bad
+    rows are dropped. drain() flushes everything on shutdown.
+
+    A tenant's queue is removed once a flush leaves it empty, so the database client it
+    holds (and keeps alive, which keeps its id() from being reused) isn't pinned forever.
+    """
+
+    TABLES = ("messages", "token_usage")
+
+    def __init__(self, max_batch: int = None, flush_interval: float = None, max_retries: int = None):
+        self.max_batch = max_batch or int(os.environ.get("WRITE_BUFFER_MAX_BATCH", 50))
+        self.flush_interval = flush_interval or float(os.environ.get("WRITE_BUFFER_FLUSH_INTERVAL", 0.5))
+        self.max_retries = max_retries or int(os.environ.get("WRITE_BUFFER_MAX_RETRIES", 5))
+        # id(db) -> {"db", "messages": [...], "token_usage": [...], "inflight": [...],
+        #            "attempts": int, "next_attempt_at": monotonic, "task": asyncio.Task}
+        self._queues: Dict[int, Dict[str, Any]] = {}
+        self._worker: asyncio.Task = None
+        self._wakeup: asyncio.Event = None
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+
+    # --- Producers ---
+
+    def add_message(self, db, client_id: str, lead_id: str, content: str, role: str, tokens: int = 0):
+        self._enqueue(db, "messages", {
+            # Generated here so a reader can tell a buffered row from the same row once flushed
+            "id": str(uuid.uuid4()),
+            "client_id": client_id,
+            "lead_id": lead_id,
+            "content": content,
+            "role": role,
+            "tokens_used": tokens,
+            # Same clock as SupabaseClient.save_message, so history order reflects when
+            # the reply happened, not when it was flushed
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
+
+    def add_token_usage(self, db, client_id: str, lead_id: str, model: str, tokens_in: int, tokens_out: int, cost: float = 0.0, tokens_cached: int = 0):
+        self._enqueue(db, "token_usage", {
+            "client_id": client_id,
+            "lead_id": lead_id,
+            "model": model,
+            "tokens_in": tokens_in,
+            "tokens_out": tokens_out,
+            "cost": cost,
+            "tokens_cached": tokens_cached # Requires update_token_usage_cached.sql
+        })
+
+    def pending_messages(self, db, lead_id: str = None) -> List[Dict[str, Any]]:
+        """
+        Messages (of one lead, or all) that were accepted but not flushed yet: read-your-writes
+        for the next turn. Rows in a flush that is running are included; they may already be stored.
+        """
+        queue = self._queues.get(id(db))
+        if not queue:
+            return []
+        rows = queue["inflight"] + queue["messages"]
+        return [row for row in rows if lead_id is None or row["lead_id"] == lead_id]
+
+    def _enqueue(self, db, table: str, row: dict):
+        queue = self._queues.setdefault(id(db), {
+            "db": db, "messages": [], "token_usage": [], "inflight": [],
+            "attempts": 0, "next_attempt_at": 0.0, "task": None
+        })
+        queue[table].append(row)
+        self._ensure_worker()
+        if len(queue["messages"]) + len(queue["token_usage"]) >= self.max_batch:
+            self._wakeup.set()
+
+    # --- Flushing ---
+
+    def _ensure_worker(self):
+        if self._worker and not self._worker.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Starts due flushes and moves on; a slow tenant doesn't hold up the others
+            self._start_flushes()
+
+    def _start_flushes(self, force: bool = False) -> List[asyncio.Task]:
+        """One flush task per tenant queue that has rows, is idle and is past its backoff."""
+        now = time.monotonic()
+        for queue in self._queues.values():
+            if queue["task"] and not queue["task"].done():
+                continue
+            if not any(queue[table] for table in self.TABLES):
+                continue
+            if not force and queue["next_attempt_at"] > now:
+                continue
+            queue["task"] = asyncio.get_running_loop().create_task(self._flush_queue(queue))
+        return [q["task"] for q in self._queues.values() if q["task"] and not q["task"].done()]
+
+    async def flush(self, force: bool = False):
+        """Flushes every due queue concurrently and waits for them."""
+        tasks = self._start_flushes(force)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _insert(self, db, table: str, rows: List[dict]):
+        if table == "messages":
+            await db.insert_messages(rows)
+        else:
+            await db.insert_token_usage(rows)
+
+    async def _insert_rows(self, db, table: str, rows: List[dict]) -> List[dict]:
+        """
+        Bulk insert; if the rows themselves are rejected, inserts them one by one and drops
+        only the offending ones. Returns the rows still to retry (transient failure).
+        """
+        try:
+            await self._insert(db, table, rows)
+            self.flushed_rows += len(rows)
+            return []
+        except Exception as e:
+            if not is_data_error(e):
+                raise
+            if len(rows) == 1:
+                self.dropped_rows += 1
+                print(f"[WriteBuffer] Dropping 1 {table} row rejected by the database: {e}")
+                return []
+
+        for i, row in enumerate(rows):
+            try:
+                await self._insert(db, table, [row])
+                self.flushed_rows += 1
+            except Exception as e:
+                if not is_data_error(e):
+                    # The database went away mid-way: keep the rest for the next attempt
+                    return rows[i:]
+                self.dropped_rows += 1
+                print(f"[WriteBuffer] Dropping 1 {table} row rejected by the database: {e}")
+        return []
+
+    async def _flush_queue(self, queue: dict):
+        db = queue["db"]
+        batch = {table: queue[table] for table in self.TABLES}
+        for table in self.TABLES:
+            queue[table] = []
+        queue["inflight"] = batch["messages"]
+
+        try:
+            # Messages first: token_usage rows reference the same leads
+            for table in self.TABLES:
+                if batch[table]:
+                    batch[table] = await self._insert_rows(db, table, batch[table])
+                    if batch[table]:
+                        raise RuntimeError(f"{len(batch[table])} {table} rows left after a connection failure")
+            queue["attempts"] = 0
+            queue["next_attempt_at"] = 0.0
+        except Exception as e:
+            self.failed_flushes += 1
+            queue["attempts"] += 1
+            pending = sum(len(batch[table]) for table in self.TABLES)
+            if queue["attempts"] >= self.max_retries:
+                self.dropped_rows += pending
+                queue["attempts"] = 0
+                queue["next_attempt_at"] = 0.0
+                print(f"[WriteBuffer] Dropping {pending} rows ({len(batch['messages'])} messages, "
+                      f"{len(batch['token_usage'])} token_usage) after {self.max_retries} failed flushes: {e}")
+                return
+            delay = min(0.2 * (2 ** queue["attempts"]), 5)
+            print(f"[WriteBuffer] Flush of {pending} rows failed (attempt {queue['attempts']}/{self.max_retries}), "
+                  f"retrying in {delay:.1f}s: {e}")
+            # Put the batch back in front of anything queued meanwhile; only this queue backs off
+            for table in self.TABLES:
+                queue[table] = batch[table] + queue[table]
+            queue["next_attempt_at"] = time.monotonic() + delay
+        finally:
+            queue["inflight"] = []
+            key = id(db)
+            if self._queues.get(key) is queue and not queue["attempts"] and not any(queue[t] for t in self.TABLES):
+                del self._queues[key]
+
+    async def drain(self, timeout: float = 20.0):
+        """Stops the background worker and flushes everything still queued."""
+        if self._worker:
+            # The worker only starts flush tasks, so cancelling it never interrupts a batch
+            self._worker.cancel()
+            try:
+                await self._worker
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._worker = None
+
+        async def _drain():
+            while any(q[t] for q in self._queues.values() for t in self.TABLES) or \
+                    any(q["task"] and not q["task"].done() for q in self._queues.values()):
+                await self.flush(force=True)
+                await asyncio.sleep(0.1)
+
+        try:
+            await asyncio.wait_for(_drain(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pending = sum(len(q[t]) for q in self._queues.values() for t in self.TABLES)
+            print(f"[WriteBuffer] Drain timed out with {pending} rows still queued")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_rows": sum(len(q[t]) for q in self._queues.values() for t in self.TABLES),
+            "flushed_rows": self.flushed_rows,
+            "failed_flushes": self.failed_flushes,
+            "dropped_rows": self.dropped_rows
+        }
+
+
+# One buffer per container
+write_buffer = WriteBehindBuffer()
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from src.cache import TTLCache
+from src.cache_sync import InvalidationBus
+from src.config_cache import AgentConfigCache
+
+
+def test_ttl_cache_hit_miss_and_expiry():
+    cache = TTLCache(maxsize=4, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=0)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None # Expired on arrival
+    assert cache.get("missing", "default") == "default"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert cache.evictions == 1
+
+
+def test_ttl_cache_invalidate_where():
+    cache = TTLCache()
+    cache.set(("pousada", "q1"), 1)
+    cache.set(("pousada", "q2"), 2)
+    cache.set(("outro", "q1"), 3)
+
+    assert cache.invalidate_where(lambda key: key[0] == "pousada") == 2
+    assert len(cache) == 1
+
+
+def _config_cache(**kwargs):
+    return AgentConfigCache(bus=InvalidationBus(interval=0), **kwargs)
+
+
+def test_config_cache_single_flight():
+    cache = _config_cache(ttl=60)
+    calls = []
+
+    async def loader(client_id):
+        calls.append(client_id)
+        await asyncio.sleep(0.01)
+        return {"client_id": client_id, "rules": []}
+
+    async def main():
+        return await asyncio.gather(*(cache.get("pousada", loader) for _ in range(10)))
+
+    results = asyncio.run(main())
+    assert calls == ["pousada"]
+    assert cache.shared_fetches == 9
+    assert all(r == {"client_id": "pousada", "rules": []} for r in results)
+    # Every caller gets its own copy
+    results[0]["rules"].append("mutated")
+    assert results[1]["rules"] == []
+
+
+def test_config_cache_negative_entries_and_errors():
+    cache = _config_cache(ttl=60, negative_ttl=60)
+    calls = []
+
+    async def missing(client_id):
+        calls.append(client_id)
+        return None
+
+    async def failing(client_id):
+        raise RuntimeError("admin db down")
+
+    async def main():
+        assert await cache.get("ghost", missing) is None
+        assert await cache.get("ghost", missing) is None
+        with pytest.raises(RuntimeError):
+            await cache.get("pousada", failing)
+        return await cache.get("pousada", lambda c: _value({"client_id": c}))
+
+    assert asyncio.run(main()) == {"client_id": "pousada"}
+    assert calls == ["ghost"] # Cached as not found
+    assert cache.negative_hits == 1
+
+
+def test_config_cache_invalidate_during_load_is_not_cached():
+    cache = _config_cache(ttl=60)
+    loads = []
+
+    async def loader(client_id):
+        loads.append(client_id)
+        cache.invalidate(client_id) # An admin update lands while we read the old row
+        return {"version": len(loads)}
+
+    async def main():
+        first = await cache.get("pousada", loader)
+        second = await cache.get("pousada", loader)
+        return first, second
+
+    assert asyncio.run(main()) == ({"version": 1}, {"version": 2})
+
+
+def test_config_cache_invalidation_across_containers():
+    class Store(dict):
+        async def get(self, key):
+            return dict.get(self, key)
+
+        async def put(self, key, value):
+            self[key] = value
+
+    store = Store()
+    here = AgentConfigCache(ttl=60, bus=InvalidationBus(store=store, interval=0))
+    there = AgentConfigCache(ttl=60, bus=InvalidationBus(store=store, interval=0))
+    rows = {"pousada": {"model": "old"}}
+
+    async def loader(client_id):
+        return dict(rows[client_id])
+
+    async def main():
+        assert (await there.get("pousada", loader))["model"] == "old"
+        rows["pousada"]["model"] = "new"
+        await here.broadcast_invalidate("pousada")
+        return await there.get("pousada", loader)
+
+    assert asyncio.run(main())["model"] == "new"
+
+
+async def _value(value):
+    return value
@@ -0,0 +1,89 @@
+import asyncio
+
+from src.coalescer import TurnCoalescer
+from src.lead_locks import lead_key
+
+
+def test_burst_is_answered_by_one_turn():
+    coalescer = TurnCoalescer(window=0.05, max_wait=1)
+    turns = []
+
+    async def run(message):
+        turns.append(message)
+        return {"success": True, "type": "message", "response": "ok"}
+
+    async def main():
+        first = asyncio.create_task(coalescer.submit("lead", "oi", run))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(coalescer.submit("lead", "tudo bem?", run))
+        return await first, await second
+
+    first, second = asyncio.run(main())
+    assert turns == ["oi\ntudo bem?"]
+    assert first["type"] == "coalesced"
+    assert second["response"] == "ok"
+    assert second["coalesced_messages"] == 2
+
+
+def test_turns_of_one_lead_never_overlap():
+    coalescer = TurnCoalescer(window=0, max_wait=1)
+    running = 0
+    overlaps = 0
+
+    async def run(message):
+        nonlocal running, overlaps
+        running += 1
+        overlaps += running > 1
+        await asyncio.sleep(0.02)
+        running -= 1
+        return {"success": True, "response": message}
+
+    async def main():
+        first = asyncio.create_task(coalescer.submit("lead", "a", run))
+        await asyncio.sleep(0.005) # "a" is running
+        rest = [asyncio.create_task(coalescer.submit("lead", m, run)) for m in ("b", "c")]
+        return await asyncio.gather(first, *rest)
+
+    results = asyncio.run(main())
+    assert overlaps == 0
+    assert results[0]["response"] == "a"
+    assert results[1]["type"] == "coalesced"
+    assert results[2]["response"] == "b\nc"
+    assert coalescer.stats()["active_leads"] == 0
+
+
+def test_errors_reach_the_last_caller():
+    coalescer = TurnCoalescer(window=0, max_wait=1)
+
+    async def run(message):
+        raise RuntimeError("llm down")
+
+    async def main():
+        try:
+            await coalescer.submit("lead", "oi", run)
+        except RuntimeError as e:
+            return str(e)
+
+    assert asyncio.run(main()) == "llm down"
+
+
+def test_merge_skips_blank_messages():
+    assert TurnCoalescer.merge([" oi ", "", "  ", "quero reservar"]) == "oi\nquero reservar"
+
+
+def test_one_bucket_per_lead_however_the_phone_is_formatted():
+    coalescer = TurnCoalescer(window=0.05, max_wait=1)
+    turns = []
+
+    async def run(message):
+        turns.append(message)
+        return {"success": True, "response": "ok"}
+
+    async def main():
+        first = asyncio.create_task(coalescer.submit(lead_key("pousada", "+55 11 99999-0000"), "oi", run))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(coalescer.submit(lead_key("pousada", "5511999990000"), "tudo bem?", run))
+        return await first, await second
+
+    asyncio.run(main())
+    assert turns == ["oi\ntudo bem?"]
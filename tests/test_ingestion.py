@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("tiktoken")
+pytest.importorskip("openai")
+pytest.importorskip("supabase")
+
+from src.ingestion import chunk_text, content_hash
+from src.token_budget import get_encoding
+
+
+def test_chunks_are_bounded_and_overlap():
+    text = " ".join(f"palavra{i}" for i in range(2000))
+    encoding = get_encoding("text-embedding-3-small")
+
+    chunks = chunk_text(text, max_tokens=100, overlap=20)
+
+    assert len(chunks) > 1
+    assert all(len(encoding.encode(chunk)) <= 100 for chunk in chunks)
+    # The tail of each chunk opens the next one
+    assert chunks[0].split()[-1] in chunks[1]
+
+
+def test_short_and_empty_text():
+    assert chunk_text("") == []
+    assert chunk_text("Check-in às 14h.") == ["Check-in às 14h."]
+
+
+def test_overlap_must_be_smaller_than_window():
+    with pytest.raises(ValueError):
+        chunk_text("texto", max_tokens=10, overlap=10)
+
+
+def test_content_hash_is_scoped_to_tenant_and_source():
+    base = content_hash("pousada", "faq.pdf", "Check-in às 14h.")
+
+    assert base == content_hash("pousada", "faq.pdf", "Check-in às 14h.")
+    assert base != content_hash("pousada", "regras.pdf", "Check-in às 14h.")
+    assert base != content_hash("hotel", "faq.pdf", "Check-in às 14h.")
+    assert base != content_hash("pousada", "faq.pdf", "Check-in às 15h.")
@@ -0,0 +1,61 @@
+import asyncio
+
+from src.lead_locks import LeadLocks, lead_key
+
+
+def test_turns_of_one_lead_are_serialized():
+    locks = LeadLocks(timeout=1)
+    events = []
+
+    async def turn(name, phone):
+        async with locks.hold("pousada", phone):
+            events.append(f"start {name}")
+            await asyncio.sleep(0.01)
+            events.append(f"end {name}")
+
+    async def main():
+        # Same digits, different formatting: same lead
+        await asyncio.gather(turn("a", "+55 (11) 99999-0000"), turn("b", "5511999990000"))
+
+    asyncio.run(main())
+    assert events == ["start a", "end a", "start b", "end b"]
+    assert locks.contended == 1
+    assert locks.stats()["active_leads"] == 0
+
+
+def test_other_leads_are_not_blocked():
+    locks = LeadLocks(timeout=1)
+    events = []
+
+    async def turn(phone):
+        async with locks.hold("pousada", phone):
+            events.append(f"start {phone}")
+            await asyncio.sleep(0.01)
+            events.append(f"end {phone}")
+
+    async def main():
+        await asyncio.gather(turn("5511"), turn("5522"))
+
+    asyncio.run(main())
+    assert events[:2] == ["start 5511", "start 5522"]
+    assert locks.contended == 0
+
+
+def test_timeout_runs_unlocked():
+    locks = LeadLocks(timeout=0.01)
+    ran = []
+
+    async def main():
+        async with locks.hold("pousada", "5511"):
+            async with locks.hold("pousada", "5511"):
+                ran.append(True)
+
+    asyncio.run(main())
+    assert ran == [True]
+    assert locks.timeouts == 1
+    assert locks.stats()["active_leads"] == 0
+
+
+def test_lead_key_ignores_formatting():
+    assert lead_key("pousada", "+55 11 99999-0000") == lead_key("pousada", "5511999990000")
+    assert lead_key("pousada", "5511999990000") != lead_key("hotel", "5511999990000")
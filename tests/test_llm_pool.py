@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("openai")
+
+from src.llm_pool import OpenAIClientPool
+
+
+def test_tenants_sharing_a_key_keep_their_own_limit():
+    async def main():
+        pool = OpenAIClientPool(max_concurrency=16)
+        first = pool.limit("sk-shared", "pousada", 2)
+        second = pool.limit("sk-shared", "hotel", 5)
+
+        # Alternating calls don't rebuild each other's semaphore
+        assert pool.limit("sk-shared", "pousada", 2) is first
+        assert pool.limit("sk-shared", "hotel", 5) is second
+        assert first is not second
+        # Callers without a limit (summaries) share the tenant's
+        assert pool.limit("sk-shared", "pousada") is first
+        # A changed tenant config takes effect
+        assert pool.limit("sk-shared", "pousada", 3) is not first
+
+    asyncio.run(main())
+
+
+def test_default_limit_without_tenant_config():
+    async def main():
+        pool = OpenAIClientPool(max_concurrency=4)
+        semaphore = pool.limit("sk-key", "pousada")
+        for _ in range(4):
+            await semaphore.acquire()
+        assert semaphore.locked()
+
+    asyncio.run(main())
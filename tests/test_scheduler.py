@@ -0,0 +1,189 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("modal")
+pytest.importorskip("httpx")
+pytest.importorskip("supabase")
+
+from src.scheduler import FollowUpScheduler
+
+RULES = [{"min": 15}, {"min": 120}, {"min": 1440}]
+NOW = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class Query:
+    """Records a PostgREST builder chain: every call returns self."""
+
+    def __init__(self, table):
+        self.table = table
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name,) + args)
+            return self
+        return call
+
+    def called(self, name):
+        return [c[1:] for c in self.calls if c[0] == name]
+
+
+class FakeDB:
+    """db.client.table(...) builds a Query; db.run(query) answers with respond(query)."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.queries = []
+        self.client = SimpleNamespace(table=self._table)
+
+    def _table(self, name):
+        query = Query(name)
+        self.queries.append(query)
+        return query
+
+    async def run(self, query):
+        return SimpleNamespace(data=self.respond(query))
+
+
+def _lead(silent_minutes, last_followup=None, lead_id="lead-1"):
+    last = NOW - timedelta(minutes=silent_minutes)
+    return {
+        "id": lead_id,
+        "phone": "5511999990000",
+        "last_message_at": last.isoformat().replace("+00:00", "Z"),
+        "last_followup_minutes": last_followup
+    }
+
+
+@pytest.fixture
+def scheduler():
+    return FollowUpScheduler(admin_db=None)
+
+
+def test_nothing_due_before_first_rule(scheduler):
+    assert scheduler._due_rule(_lead(10), RULES, NOW) is None
+
+
+def test_first_rule_after_its_silence(scheduler):
+    assert scheduler._due_rule(_lead(20), RULES, NOW)["min"] == 15
+
+
+def test_rules_fire_in_order_without_skipping(scheduler):
+    # Silent for a day but nothing sent yet: the 15min message goes first
+    assert scheduler._due_rule(_lead(1500), RULES, NOW)["min"] == 15
+    assert scheduler._due_rule(_lead(1500, last_followup=15), RULES, NOW)["min"] == 120
+    assert scheduler._due_rule(_lead(1500, last_followup=120), RULES, NOW)["min"] == 1440
+
+
+def test_nothing_after_last_rule(scheduler):
+    assert scheduler._due_rule(_lead(5000, last_followup=1440), RULES, NOW) is None
+
+
+def test_candidate_query_is_set_based(scheduler):
+    db = FakeDB(lambda query: [])
+
+    asyncio.run(scheduler._fetch_candidates(db, RULES))
+
+    query = db.queries[0]
+    assert query.table == "leads"
+    assert ("status", "active") in query.called("eq")
+    assert ("last_message_role", "assistant") in query.called("eq")
+    assert query.called("or_") == [("last_followup_minutes.is.null,last_followup_minutes.lt.1440",)]
+    assert query.called("order") == [("id",)]
+    assert query.called("limit") == [(scheduler.BATCH_SIZE,)]
+    assert query.called("gt") == [] # First page
+
+
+def test_scan_pages_by_id(scheduler, monkeypatch):
+    monkeypatch.setattr(scheduler, "BATCH_SIZE", 2)
+    pages = [
+        [_lead(20, lead_id="a"), _lead(20, lead_id="b")],
+        [_lead(20, lead_id="c"), _lead(20, lead_id="d")],
+        [_lead(20, lead_id="e")]
+    ]
+    db = FakeDB(lambda query: pages[len(db.queries) - 1])
+    batches = []
+
+    async def process_batch(client_id, db, leads, sorted_rules, webhook):
+        batches.append([lead["id"] for lead in leads])
+        return len(leads)
+
+    monkeypatch.setattr(scheduler, "_process_batch", process_batch)
+    triggered = asyncio.run(scheduler._process_scan("pousada", db, RULES, "https://n8n/webhook"))
+
+    assert triggered == 5
+    assert batches == [["a", "b"], ["c", "d"], ["e"]]
+    # Each page starts after the last id of the previous one; a short page ends the scan
+    assert [q.called("gt") for q in db.queries] == [[], [("id", "b")], [("id", "d")]]
+
+
+class Dispatcher:
+    def __init__(self, outcome):
+        self.outcome = outcome
+        self.sent = []
+
+    async def send(self, tenant, url, payload, key):
+        self.sent.append(payload["phone"])
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return self.outcome
+
+
+def _claim_db(claimed_ids):
+    def respond(query):
+        if query.called("in_"):
+            return [{"id": lead_id} for lead_id in claimed_ids]
+        return [] # Release
+    return FakeDB(respond)
+
+
+def test_claim_is_a_conditional_bulk_update(scheduler):
+    db = _claim_db(["a"])
+
+    claimed = asyncio.run(scheduler._claim(db, ["a", "b"], 120, NOW))
+
+    query = db.queries[0]
+    assert claimed == ["a"]
+    assert query.called("update") == [({"last_followup_minutes": 120},)]
+    assert query.called("in_") == [("id", ["a", "b"])]
+    assert query.called("eq") == [("last_message_role", "assistant")]
+    assert query.called("lte") == [("last_message_at", (NOW - timedelta(minutes=120)).isoformat())]
+    assert query.called("or_") == [("last_followup_minutes.is.null,last_followup_minutes.lt.120",)]
+
+
+def test_only_claimed_leads_are_sent(scheduler):
+    scheduler.dispatcher = Dispatcher(True)
+    db = _claim_db(["a"])
+    leads = [_lead(20, lead_id="a"), {**_lead(20, lead_id="b"), "phone": "5522"}]
+
+    sent = asyncio.run(scheduler._process_batch("pousada", db, leads, RULES, "https://n8n/webhook"))
+
+    assert sent == 1
+    assert scheduler.dispatcher.sent == ["5511999990000"]
+    assert len(db.queries) == 1 # No release
+
+
+@pytest.mark.parametrize("outcome", [False, ValueError("invalid webhook URL")])
+def test_failed_send_releases_the_claim(scheduler, outcome):
+    scheduler.dispatcher = Dispatcher(outcome)
+    db = _claim_db(["a"])
+
+    sent = asyncio.run(scheduler._process_batch("pousada", db, [_lead(20, last_followup=None, lead_id="a")], RULES, "https://n8n/webhook"))
+
+    assert sent == 0
+    release = db.queries[1]
+    # Back to what the lead had, but only if nobody moved it past this rule meanwhile
+    assert release.called("update") == [({"last_followup_minutes": None},)]
+    assert release.called("eq") == [("id", "a"), ("last_followup_minutes", 15)]
+
+
+def test_idempotency_key_is_stable_per_silence(scheduler):
+    lead = _lead(20)
+    key = scheduler.idempotency_key("pousada", lead, 15)
+
+    assert key == scheduler.idempotency_key("pousada", dict(lead), 15)
+    assert key != scheduler.idempotency_key("pousada", lead, 120)
+    assert key != scheduler.idempotency_key("pousada", _lead(30), 15)
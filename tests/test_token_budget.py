@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("tiktoken")
+
+from src.token_budget import ContextBudgeter, count_tokens
+
+
+def _fit(budget, **kwargs):
+    return ContextBudgeter(budget=budget).fit(system="Você é um assistente.", user_message="Tem vaga amanhã?", **kwargs)
+
+
+def _history(n):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"mensagem número {i} " * 20} for i in range(n)]
+
+
+def test_without_budget_only_measures():
+    result = _fit(None, recent_messages=_history(10), learnings=["a"], rag=["chunk"])
+
+    assert len(result["recent_messages"]) == 10
+    assert result["report"]["over_budget"] is False
+    assert result["report"]["dropped"] == {"recent_messages": 0, "learnings": 0, "rag": 0}
+
+
+def test_old_history_goes_before_learnings_and_rag():
+    learnings = ["Cliente prefere quartos térreos."]
+    rag = ["Check-in às 14h.", "Café da manhã incluso."]
+    unbounded = _fit(None, recent_messages=_history(10), learnings=learnings, rag=rag)["report"]
+    # Room for everything except part of the history
+    budget = unbounded["total"] - unbounded["sections"]["recent_messages"] // 2
+
+    result = _fit(budget, recent_messages=_history(10), learnings=learnings, rag=rag)
+
+    assert result["learnings"] == learnings
+    assert result["rag"] == rag
+    assert ContextBudgeter.MIN_RECENT_SOFT <= len(result["recent_messages"]) < 10
+    assert result["recent_messages"][-1] == _history(10)[-1] # Newest kept
+    assert result["report"]["total"] <= budget
+
+
+def test_tight_budget_keeps_floor_and_trims_summary():
+    summary = "O cliente perguntou sobre preços e datas. " * 100
+    result = _fit(50, recent_messages=_history(10), learnings=["x"], rag=["a", "b"], summary=summary)
+
+    assert len(result["recent_messages"]) == ContextBudgeter.MIN_RECENT_HARD
+    assert result["learnings"] == []
+    assert result["rag"] == ["a"]
+    assert result["report"]["summary_trimmed"]
+    assert count_tokens(result["summary"]) >= ContextBudgeter.MIN_SUMMARY_TOKENS
+    assert summary.endswith(result["summary"].strip())
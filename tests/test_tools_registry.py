@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("supabase")
+pytest.importorskip("httpx")
+pytest.importorskip("openai")
+
+from src.tools_registry import ToolsRegistry
+
+
+class SlowRAG:
+    def __init__(self, fail_first=False):
+        self.calls = 0
+        self.fail_first = fail_first
+
+    async def search(self, query, client_id, top_k):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        if self.fail_first and self.calls == 1:
+            raise RuntimeError("embedding failed")
+        return [f"chunk for {query}"]
+
+
+def test_prompt_and_tool_share_one_search():
+    rag = SlowRAG()
+    registry = ToolsRegistry(db_client=None, rag=rag)
+
+    async def main():
+        return await asyncio.gather(
+            registry.retrieve("Qual o horário do café?", "pousada"),
+            registry.retrieve("qual o horário do café", "pousada")
+        )
+
+    first, second = asyncio.run(main())
+    assert first == second
+    assert rag.calls == 1
+
+
+def test_timed_out_caller_does_not_cancel_the_search():
+    rag = SlowRAG()
+    registry = ToolsRegistry(db_client=None, rag=rag)
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(registry.retrieve("café", "pousada"), timeout=0.01)
+        # The tool asks the same question later in the turn
+        return await registry.search_knowledge_base("café", "pousada")
+
+    assert asyncio.run(main()) == "chunk for café"
+    assert rag.calls == 1
+
+
+def test_failed_search_is_retried():
+    rag = SlowRAG(fail_first=True)
+    registry = ToolsRegistry(db_client=None, rag=rag)
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await registry.retrieve("café", "pousada")
+        return await registry.retrieve("café", "pousada")
+
+    assert asyncio.run(main()) == ["chunk for café"]
+    assert rag.calls == 2
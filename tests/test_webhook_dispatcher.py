@@ -0,0 +1,62 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from src.webhook_dispatcher import TokenBucket, WebhookDispatcher
+
+
+def test_burst_passes_immediately():
+    bucket = TokenBucket(rate=1, capacity=5)
+
+    async def main():
+        start = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) < 0.05
+
+
+def test_rate_is_enforced_after_the_burst():
+    bucket = TokenBucket(rate=50, capacity=1)
+
+    async def main():
+        start = time.monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # One token up front, then 5 more at 50/s
+    assert asyncio.run(main()) >= 0.09
+
+
+def _response(retry_after):
+    return SimpleNamespace(headers={"retry-after": retry_after})
+
+
+def test_retry_after_is_capped():
+    async def main():
+        async with WebhookDispatcher() as dispatcher:
+            dispatcher.max_retry_after = 30
+            return [
+                dispatcher._backoff(0, _response("5")),
+                dispatcher._backoff(0, _response("30")),
+                dispatcher._backoff(0, _response("3600")), # Give up
+                dispatcher._backoff(3, _response("soon")) # Unparseable: regular backoff
+            ]
+
+    delays = asyncio.run(main())
+    assert delays[:3] == [5.0, 30.0, None]
+    assert 0 <= delays[3] <= 4
+
+
+def test_backoff_is_bounded_without_retry_after():
+    async def main():
+        async with WebhookDispatcher() as dispatcher:
+            return [dispatcher._backoff(attempt) for attempt in range(20)]
+
+    assert all(0 <= delay <= 30 for delay in asyncio.run(main()))
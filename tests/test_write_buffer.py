@@ -0,0 +1,138 @@
+import asyncio
+
+from src.write_buffer import WriteBehindBuffer, is_data_error
+
+
+class DataError(Exception):
+    def __init__(self, code):
+        super().__init__({"code": code, "message": "rejected"})
+        self.code = code
+
+
+class FakeDB:
+    def __init__(self, fail_times=0, bad_content=None):
+        self.fail_times = fail_times
+        self.bad_content = bad_content
+        self.messages = []
+        self.token_usage = []
+        self.calls = 0
+
+    async def _insert(self, table, rows):
+        self.calls += 1
+        if self.fail_times:
+            self.fail_times -= 1
+            raise ConnectionError("connection reset")
+        if self.bad_content and any(row.get("content") == self.bad_content for row in rows):
+            raise DataError("23503")
+        table.extend(rows)
+
+    async def insert_messages(self, rows):
+        await self._insert(self.messages, rows)
+
+    async def insert_token_usage(self, rows):
+        await self._insert(self.token_usage, rows)
+
+
+def test_is_data_error():
+    assert is_data_error(DataError("23505"))
+    assert is_data_error(DataError("PGRST204"))
+    assert not is_data_error(DataError("08006"))
+    assert not is_data_error(ConnectionError("reset"))
+
+
+def test_transient_failure_is_retried():
+    buffer = WriteBehindBuffer(max_batch=100, flush_interval=60, max_retries=5)
+    db = FakeDB(fail_times=1)
+
+    async def main():
+        buffer.add_message(db, "pousada", "lead-1", "oi", "assistant")
+        buffer.add_token_usage(db, "pousada", "lead-1", "gpt-4o-mini", 10, 5)
+        await buffer.flush()
+        assert buffer.stats()["pending_rows"] == 2 # Backing off
+        await buffer.drain(timeout=5)
+
+    asyncio.run(main())
+    assert [m["content"] for m in db.messages] == ["oi"]
+    assert len(db.token_usage) == 1
+    assert buffer.failed_flushes == 1
+    assert buffer.dropped_rows == 0
+
+
+def test_bad_rows_are_dropped_alone():
+    buffer = WriteBehindBuffer(max_batch=100, flush_interval=60)
+    db = FakeDB(bad_content="bad")
+
+    async def main():
+        for content in ("a", "bad", "c"):
+            buffer.add_message(db, "pousada", "lead-1", content, "assistant")
+        await buffer.drain(timeout=5)
+
+    asyncio.run(main())
+    assert [m["content"] for m in db.messages] == ["a", "c"]
+    assert buffer.dropped_rows == 1
+
+
+def test_rows_are_dropped_after_max_retries():
+    buffer = WriteBehindBuffer(max_batch=100, flush_interval=60, max_retries=2)
+    db = FakeDB(fail_times=10)
+
+    async def main():
+        buffer.add_message(db, "pousada", "lead-1", "oi", "assistant")
+        await buffer.drain(timeout=5)
+
+    asyncio.run(main())
+    assert db.messages == []
+    assert buffer.dropped_rows == 1
+    assert buffer.stats()["pending_rows"] == 0
+
+
+def test_failing_tenant_does_not_block_others():
+    buffer = WriteBehindBuffer(max_batch=100, flush_interval=60, max_retries=5)
+    down, up = FakeDB(fail_times=10), FakeDB()
+
+    async def main():
+        buffer.add_message(down, "a", "lead-1", "oi", "assistant")
+        buffer.add_message(up, "b", "lead-2", "olá", "assistant")
+        await buffer.flush()
+        buffer.add_message(up, "b", "lead-2", "tudo bem?", "assistant")
+        await buffer.flush()
+        pending = buffer.pending_messages(down, "lead-1")
+        if buffer._worker:
+            buffer._worker.cancel()
+        return pending
+
+    pending = asyncio.run(main())
+    assert [m["content"] for m in up.messages] == ["olá", "tudo bem?"]
+    assert [m["content"] for m in pending] == ["oi"]
+
+
+def test_buffered_rows_carry_their_id_and_queue_is_released():
+    buffer = WriteBehindBuffer(max_batch=100, flush_interval=60)
+    db = FakeDB()
+
+    async def main():
+        buffer.add_message(db, "pousada", "lead-1", "oi", "assistant")
+        pending = buffer.pending_messages(db, "lead-1")
+        assert buffer.pending_messages(db) == pending
+        await buffer.drain(timeout=5)
+        return pending
+
+    pending = asyncio.run(main())
+    # The stored row keeps the id the reader saw while it was buffered
+    assert db.messages[0]["id"] == pending[0]["id"]
+    assert buffer._queues == {}
+    assert buffer.pending_messages(db, "lead-1") == []
+
+
+def test_queue_is_kept_while_backing_off():
+    buffer = WriteBehindBuffer(max_batch=100, flush_interval=60, max_retries=5)
+    db = FakeDB(fail_times=1)
+
+    async def main():
+        buffer.add_message(db, "pousada", "lead-1", "oi", "assistant")
+        await buffer.flush()
+        assert len(buffer._queues) == 1
+        await buffer.drain(timeout=5)
+
+    asyncio.run(main())
+    assert buffer._queues == {}
@@ -61,6 +61,60 @@ BEGIN
     EXCEPTION
         WHEN duplicate_column THEN NULL;
     END;
+
+    -- RAG retrieval mode: 'keyword' (ILIKE) or 'vector' (pgvector, see update_knowledge_base_vector.sql)
+    BEGIN
+        ALTER TABLE agent_configs ADD COLUMN rag_mode TEXT DEFAULT 'keyword';
+    EXCEPTION
+        WHEN duplicate_column THEN NULL;
+    END;
+
+    BEGIN
+        ALTER TABLE agent_configs ADD COLUMN rag_match_threshold FLOAT DEFAULT 0.5;
+    EXCEPTION
+        WHEN duplicate_column THEN NULL;
+    END;
+
+    -- Max in-flight OpenAI calls per API key (NULL = OPENAI_MAX_CONCURRENCY_PER_KEY)
+    BEGIN
+        ALTER TABLE agent_configs ADD COLUMN llm_max_concurrency INTEGER;
+    EXCEPTION
+        WHEN duplicate_column THEN NULL;
+    END;
+
+    -- Agent loop bounds: model calls per turn and total tokens before tools are disabled (NULL = no budget)
+    BEGIN
+        ALTER TABLE agent_configs ADD COLUMN max_tool_steps INTEGER DEFAULT 4;
+    EXCEPTION
+        WHEN duplicate_column THEN NULL;
+    END;
+
+    BEGIN
+        ALTER TABLE agent_configs ADD COLUMN tool_token_budget INTEGER;
+    EXCEPTION
+        WHEN duplicate_column THEN NULL;
+    END;
+
+    -- Prompt token budget per turn (src/token_budget.py); NULL = measure only, never trim
+    BEGIN
+        ALTER TABLE agent_configs ADD COLUMN context_token_budget INTEGER;
+    EXCEPTION
+        WHEN duplicate_column THEN NULL;
+    END;
+
+    -- 'scan' = cron scans leads for due rules; 'queue' = replies schedule follow_ups jobs (update_follow_ups_queue.sql)
+    BEGIN
+        ALTER TABLE agent_configs ADD COLUMN followup_mode TEXT DEFAULT 'scan';
+    EXCEPTION
+        WHEN duplicate_column THEN NULL;
+    END;
+
+    -- Quiet window before a burst of messages from one lead is answered as one turn (src/coalescer.py); NULL = COALESCE_WINDOW_SECONDS
+    BEGIN
+        ALTER TABLE agent_configs ADD COLUMN coalesce_window_ms INTEGER;
+    EXCEPTION
+        WHEN duplicate_column THEN NULL;
+    END;
 END $$;
 
 -- Ensure enabled_tools is JSONB if table already exists (and it wasn't jsonb)
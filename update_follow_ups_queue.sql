@@ -0,0 +1,82 @@
+-- Event-driven follow-ups (agent_configs.followup_mode = 'queue', src/followup_queue.py + src/scheduler.py)
+-- Run this in the SQL Editor of your Agent Supabase project.
+-- Leads already waiting when a tenant switches to 'queue' get their first job on the next assistant reply.
+
+alter table follow_ups add column if not exists rule_minutes int; -- follow-up rule this job fires (NULL = not a rule job)
+alter table follow_ups add column if not exists locked_until timestamp with time zone; -- lease of the worker sending it
+alter table follow_ups add column if not exists attempts int not null default 0;
+alter table follow_ups add column if not exists sent_at timestamp with time zone;
+
+-- Due jobs of a tenant: the claim reads only the head of this index
+create index if not exists idx_follow_ups_due on follow_ups(client_id, scheduled_at) where status = 'pending';
+-- Cancel/replace a lead's pending job
+create index if not exists idx_follow_ups_lead_pending on follow_ups(lead_id) where status = 'pending';
+
+-- Assistant reply: the lead's pending job is replaced by the first rule's
+create or replace function schedule_follow_up(
+    p_client_id text,
+    p_lead_id uuid,
+    p_rule_minutes int,
+    p_scheduled_at timestamp with time zone
+)
+returns void
+language plpgsql
+as $$
+begin
+    update follow_ups set status = 'cancelled'
+    where lead_id = p_lead_id and status = 'pending';
+
+    insert into follow_ups (client_id, lead_id, rule_minutes, scheduled_at)
+    values (p_client_id, p_lead_id, p_rule_minutes, p_scheduled_at);
+end;
+$$;
+
+-- Leases up to p_limit due jobs. SKIP LOCKED lets concurrent workers claim disjoint rows;
+-- the lease hides claimed rows until they are marked sent/failed or the worker dies.
+create or replace function claim_follow_ups(
+    p_client_id text,
+    p_limit int default 100,
+    p_lease_seconds int default 300
+)
+returns table (id uuid, lead_id uuid, rule_minutes int, scheduled_at timestamp with time zone, attempts int, phone text, name text)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+    -- Leads closed or converted since the job was scheduled get no follow-up (same rule as scan mode)
+    update follow_ups f
+    set status = 'cancelled', locked_until = null
+    from leads l
+    where l.id = f.lead_id
+      and f.client_id = p_client_id
+      and f.status = 'pending'
+      and f.scheduled_at <= now()
+      and l.status is distinct from 'active';
+
+    return query
+    with due as (
+        select f.id
+        from follow_ups f
+        join leads l on l.id = f.lead_id
+        where f.client_id = p_client_id
+          and f.status = 'pending'
+          and f.rule_minutes is not null
+          and f.scheduled_at <= now()
+          and (f.locked_until is null or f.locked_until < now())
+          and l.status = 'active'
+        order by f.scheduled_at
+        limit p_limit
+        for update of f skip locked
+    ), claimed as (
+        update follow_ups f
+        set locked_until = now() + make_interval(secs => p_lease_seconds),
+            attempts = f.attempts + 1
+        from due
+        where f.id = due.id
+        returning f.id, f.lead_id, f.rule_minutes, f.scheduled_at, f.attempts
+    )
+    select c.id, c.lead_id, c.rule_minutes, c.scheduled_at, c.attempts, l.phone, l.name
+    from claimed c
+    join leads l on l.id = c.lead_id;
+end;
+$$;
@@ -0,0 +1,11 @@
+-- Idempotent ingestion for knowledge_base (src/ingestion.py)
+-- Run this in the SQL Editor of your Agent Supabase project.
+
+alter table knowledge_base add column if not exists content_hash text;
+
+-- Upsert target: one row per (tenant, source document, chunk content); the source is part of content_hash.
+-- Rows hashed before the source was included are re-embedded once and replaced on their next ingestion.
+create unique index if not exists idx_kb_client_content_hash on knowledge_base(client_id, content_hash);
+
+-- Re-ingestion looks up chunks of the same source document
+create index if not exists idx_kb_client_source on knowledge_base(client_id, (metadata->>'source'));
@@ -0,0 +1,42 @@
+-- Vector retrieval for RAGEngine (rag_mode = 'vector')
+-- Run this in the SQL Editor of your Agent Supabase project.
+
+create extension if not exists vector;
+
+create index if not exists idx_knowledge_base_embedding
+    on knowledge_base using ivfflat (embedding vector_cosine_ops);
+
+-- The original search_knowledge_base had no tenant filter; replace it.
+drop function if exists search_knowledge_base(vector, float, int);
+
+create or replace function search_knowledge_base(
+    query_embedding vector(1536),
+    filter_client_id text,
+    match_threshold float default 0.5,
+    match_count int default 5
+)
+returns table (
+    id uuid,
+    title text,
+    content text,
+    metadata jsonb,
+    similarity float
+)
+language plpgsql
+as $$
+begin
+    return query
+    select
+        kb.id,
+        kb.title,
+        kb.content,
+        kb.metadata,
+        1 - (kb.embedding <=> query_embedding) as similarity
+    from knowledge_base kb
+    where kb.client_id = filter_client_id
+      and kb.embedding is not null
+      and 1 - (kb.embedding <=> query_embedding) > match_threshold
+    order by kb.embedding <=> query_embedding
+    limit match_count;
+end;
+$$;
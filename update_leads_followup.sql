@@ -4,3 +4,9 @@ ADD COLUMN IF NOT EXISTS last_followup_minutes INT DEFAULT 0;
 -- Optional: Add index for performance
 CREATE INDEX IF NOT EXISTS idx_leads_last_msg_followup 
 ON leads (status, last_followup_minutes);
+
+-- Set-based candidate query of FollowUpScheduler (src/scheduler.py):
+-- status = 'active' AND last_message_role = 'assistant' AND last_message_at BETWEEN ...
+-- Requires the message tracking columns from update_schema_phase4.py.
+CREATE INDEX IF NOT EXISTS idx_leads_followup_candidates
+ON leads (status, last_message_role, last_message_at);
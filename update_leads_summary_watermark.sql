@@ -0,0 +1,35 @@
+-- Incremental background summarization (src/summarizer.py)
+-- Run this in the SQL Editor of your Agent Supabase project.
+
+-- Watermark = (created_at, id) of the last summarized message; id breaks created_at ties
+alter table leads add column if not exists summary_watermark timestamp with time zone;
+alter table leads add column if not exists summary_watermark_id uuid;
+
+-- Serves the (created_at, id) keyset scans of the summarizer
+create index if not exists idx_messages_lead_created on messages(lead_id, created_at, id);
+
+-- Existing summaries covered everything before the last 10 messages
+update leads l
+set (summary_watermark, summary_watermark_id) = (
+    select m.created_at, m.id
+    from messages m
+    where m.lead_id = l.id
+    order by m.created_at desc, m.id desc
+    offset 10
+    limit 1
+)
+where l.conversation_summary is not null
+  and l.summary_watermark is null;
+
+-- Watermarks stored before summary_watermark_id existed: every message at that instant was already skipped
+update leads l
+set summary_watermark_id = (
+    select m.id
+    from messages m
+    where m.lead_id = l.id
+      and m.created_at = l.summary_watermark
+    order by m.id desc
+    limit 1
+)
+where l.summary_watermark is not null
+  and l.summary_watermark_id is null;
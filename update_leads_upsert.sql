@@ -0,0 +1,37 @@
+-- Atomic get-or-create for leads (SupabaseClient.get_or_create_lead)
+-- Run this in the SQL Editor of your Agent Supabase project.
+-- Without it the client falls back to select + PostgREST upsert (on_conflict=client_id,phone).
+
+-- ON CONFLICT needs the unique key. setup_agent_db.sql creates it; older databases may lack it.
+-- If this fails, merge the duplicate leads first (see fix_data_and_restore_fk.py).
+create unique index if not exists idx_leads_client_phone_unique on leads(client_id, phone);
+
+-- Existing lead: one index lookup, no write. New lead: INSERT ... ON CONFLICT DO NOTHING,
+-- and a concurrent insert that won the race is read back. Always one round trip.
+create or replace function upsert_lead(
+    p_client_id text,
+    p_phone text,
+    p_name text default null
+)
+returns leads
+language plpgsql
+as $$
+declare
+    v_lead leads;
+begin
+    select * into v_lead from leads where client_id = p_client_id and phone = p_phone;
+    if found then
+        return v_lead;
+    end if;
+
+    insert into leads (client_id, phone, name, status)
+    values (p_client_id, p_phone, p_name, 'active')
+    on conflict (client_id, phone) do nothing
+    returning * into v_lead;
+
+    if not found then
+        select * into v_lead from leads where client_id = p_client_id and phone = p_phone;
+    end if;
+    return v_lead;
+end;
+$$;
@@ -0,0 +1,108 @@
+import psycopg2
+import os
+import sys
+
+# Direct Connection (Port 5432) to the TENANT (Agent) database.
+# Usage: python update_schema_phase4.py [postgres_uri]   (defaults to $POSTGRES_DIRECT_URL)
+POSTGRES_URI = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("POSTGRES_DIRECT_URL")
+
+def run_migration():
+    if not POSTGRES_URI:
+        print("Missing database URI (argument or POSTGRES_DIRECT_URL).")
+        return
+
+    print(f"Connecting to database (Direct - Port 5432)...")
+    try:
+        conn = psycopg2.connect(POSTGRES_URI)
+        conn.autocommit = True
+        cur = conn.cursor()
+        print("Connected successfully.")
+
+        commands = [
+            # Denormalized per-lead message counter (replaces count="exact" scans on messages)
+            "ALTER TABLE leads ADD COLUMN IF NOT EXISTS message_count INT NOT NULL DEFAULT 0;",
+            "ALTER TABLE leads ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMPTZ;",
+            "ALTER TABLE leads ADD COLUMN IF NOT EXISTS last_message_role TEXT;",
+
+            # Kept up to date atomically by the database on every insert/delete in messages
+            """
+            CREATE OR REPLACE FUNCTION leads_track_messages() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    UPDATE leads SET
+                        message_count = message_count + 1,
+                        last_message_at = GREATEST(COALESCE(last_message_at, NEW.created_at), NEW.created_at),
+                        last_message_role = CASE
+                            WHEN last_message_at IS NULL OR NEW.created_at >= last_message_at THEN NEW.role
+                            ELSE last_message_role
+                        END
+                    WHERE id = NEW.lead_id;
+                    RETURN NEW;
+                ELSIF TG_OP = 'DELETE' THEN
+                    UPDATE leads SET message_count = GREATEST(message_count - 1, 0)
+                    WHERE id = OLD.lead_id;
+                    RETURN OLD;
+                END IF;
+                RETURN NULL;
+            END;
+            $$;
+            """,
+            "DROP TRIGGER IF EXISTS trg_leads_track_messages ON messages;",
+            """
+            CREATE TRIGGER trg_leads_track_messages
+            AFTER INSERT OR DELETE ON messages
+            FOR EACH ROW EXECUTE FUNCTION leads_track_messages();
+            """,
+
+            # Backfill from existing history (one pass over messages)
+            """
+            UPDATE leads l SET
+                message_count = s.total,
+                last_message_at = s.last_at,
+                last_message_role = s.last_role
+            FROM (
+                SELECT DISTINCT ON (lead_id)
+                    lead_id,
+                    COUNT(*) OVER (PARTITION BY lead_id) AS total,
+                    created_at AS last_at,
+                    role AS last_role
+                FROM messages
+                WHERE lead_id IS NOT NULL
+                ORDER BY lead_id, created_at DESC
+            ) s
+            WHERE l.id = s.lead_id;
+            """,
+
+            # Follow-up candidate scan (FollowUpScheduler._fetch_candidates)
+            "CREATE INDEX IF NOT EXISTS idx_leads_followup_candidates ON leads (status, last_message_role, last_message_at);"
+        ]
+
+        for i, cmd in enumerate(commands):
+            try:
+                print(f"Executing command {i+1}...")
+                cur.execute(cmd)
+            except Exception as e:
+                print(f"Error executing command {i+1}: {e}")
+
+        # Verification
+        print("\n--- VALIDATION ---")
+        cur.execute("""
+            SELECT COUNT(*) FROM leads l
+            WHERE l.message_count <> (SELECT COUNT(*) FROM messages m WHERE m.lead_id = l.id);
+        """)
+        mismatches = cur.fetchone()[0]
+        if mismatches == 0:
+            print("✅ message_count matches messages for every lead.")
+        else:
+            print(f"❌ {mismatches} leads with a mismatched message_count.")
+
+        cur.close()
+        conn.close()
+        print("Schema update finished.")
+
+    except Exception as e:
+        print(f"CRITICAL ERROR: {e}")
+
+if __name__ == "__main__":
+    run_migration()
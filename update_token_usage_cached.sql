@@ -0,0 +1,6 @@
+-- Prompt-cache accounting for token_usage (src/prompt_builder.py)
+-- Run this in the SQL Editor of your Agent Supabase project.
+-- Required: the write-behind buffer always sends tokens_cached with token_usage rows.
+
+-- Part of tokens_in served from the provider's prompt cache (billed at the cached input rate)
+alter table token_usage add column if not exists tokens_cached int default 0;
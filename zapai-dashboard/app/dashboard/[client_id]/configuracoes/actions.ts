@@ -8,6 +8,33 @@ const supabaseServiceKey = process.env.SUPABASE_SERVICE_ROLE_KEY || process.env.
 // Use Service Role to bypass RLS for Admin Configs
 const supabase = createClient(supabaseUrl, supabaseServiceKey)
 
+// Base URL of the Modal agent API (optional). Used to drop cached configs after an edit.
+const agentApiUrl = process.env.AGENT_API_URL
+// Must match ADMIN_API_TOKEN on the agent API; /admin/* rejects requests without it
+const agentAdminToken = process.env.AGENT_ADMIN_TOKEN
+
+async function invalidateAgentCache(cache: 'config-cache' | 'rag-cache', clientId: string) {
+    if (!agentApiUrl) return
+
+    try {
+        await fetch(`${agentApiUrl}/admin/${cache}/invalidate`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'X-Admin-Token': agentAdminToken ?? '' },
+            body: JSON.stringify({ client_id: clientId })
+        })
+    } catch (error: any) {
+        // Best-effort: other agent containers pick the change up within CACHE_SYNC_INTERVAL,
+        // and every entry expires on its own (TTL) anyway
+        console.error(`Error invalidating agent ${cache}:`, error)
+    }
+}
+
+// Called by KnowledgeBaseManager after documents are added or removed
+export async function invalidateKnowledgeCache(clientId: string) {
+    if (!clientId) return
+    await invalidateAgentCache('rag-cache', clientId)
+}
+
 export async function getAgentConfig(clientId: string) {
     if (!clientId) return { error: 'Client ID required' }
 
@@ -73,6 +100,7 @@ export async function updateAgentConfig(clientId: string, config: any) {
         }
 
         if (error) throw error
+        await invalidateAgentCache('config-cache', clientId)
         return { success: true }
     } catch (error: any) {
         console.error('Error updating config:', error)
@@ -12,6 +12,7 @@ import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from
 import { toast } from 'sonner'
 import { Plus, Trash2, FileText, UploadCloud, Search, Database, Upload } from 'lucide-react'
 import { parseFile } from '@/lib/fileParser'
+import { invalidateKnowledgeCache } from '@/app/dashboard/[client_id]/configuracoes/actions'
 
 interface KnowledgeDoc {
     id: string
@@ -180,6 +181,7 @@ export default function KnowledgeBaseManager({
             }
         }
 
+        invalidateKnowledgeCache(clientId)
         toast.success('Documento adicionado!')
         setNewDoc({ title: '', content: '', category: '' })
         setShowDialog(false)
@@ -196,6 +198,7 @@ export default function KnowledgeBaseManager({
         if (error) {
             toast.error(error.message)
         } else {
+            invalidateKnowledgeCache(clientId)
             toast.success('Documento removido!')
             loadDocs()
         }